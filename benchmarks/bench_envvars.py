@@ -0,0 +1,122 @@
+"""Benchmark the activation of a view from its description in meta/env.json.
+
+Creates the variables of a view with many packages, where every package
+prepends its own directories and those of the view to the list variables, and
+the recipe appends to them, as meta/env.json described them before: one update
+for every activation of a package. Reports the number of updates and the size
+of the JSON for that description (version 1) and for the compacted description
+(version 2), and times how long it takes to compute the values of the list
+variables from their updates, when the variables are set and when they are not,
+for which version 2 gives the clean values without applying the updates.
+
+    python benchmarks/bench_envvars.py --packages 500
+"""
+
+import argparse
+import importlib.util
+import json
+import pathlib
+import time
+
+script = pathlib.Path(__file__).parent.parent / "stackinator" / "etc" / "envvars.py"
+
+# the directories of a package that it adds to each list variable
+DIRECTORIES = {
+    "PATH": ["bin"],
+    "LD_LIBRARY_PATH": ["lib", "lib64"],
+    "LIBRARY_PATH": ["lib", "lib64"],
+    "CPATH": ["include"],
+    "MANPATH": ["share/man"],
+    "PKG_CONFIG_PATH": ["lib/pkgconfig", "lib64/pkgconfig", "share/pkgconfig"],
+    "CMAKE_PREFIX_PATH": [""],
+    "ACLOCAL_PATH": ["share/aclocal"],
+}
+
+
+def load_script():
+    spec = importlib.util.spec_from_file_location("envvars", script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_values(envvars, packages: int) -> dict:
+    """The version 1 values of a view with packages, as meta_impl wrote them."""
+    env = envvars.EnvVarSet()
+    view = "/user-environment/env/default"
+    for i in range(packages):
+        prefix = f"/user-environment/linux-sles15-neoverse_v2/package-{i}-1.0-{i:032x}"
+        for name, directories in DIRECTORIES.items():
+            env.set_list(
+                name, [f"{root}/{d}" for root in (prefix, view) for d in directories], envvars.EnvVarOp.PREPEND
+            )
+    env.make_dirty()
+    # the view:uenv:env_vars of the recipe
+    env.set_list("PATH", ["/user-environment/bin"], envvars.EnvVarOp.APPEND)
+    env.set_list("MODULEPATH", [], envvars.EnvVarOp.SET)
+    env.set_list("MODULEPATH", ["/user-environment/modules"], envvars.EnvVarOp.PREPEND)
+    return env.as_dict()
+
+
+def best_of(repeat, func):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--packages", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    envvars = load_script()
+    v1 = {"version": 1, "values": make_values(envvars, args.packages)}
+    v2 = envvars.env_description(envvars.EnvVarSet.from_dict(v1["values"]))
+
+    current = {name: "/usr/local/bin:/usr/bin:/bin" for name in v1["values"]["list"]}
+
+    def updates(description):
+        return sum(len(u) for u in description["values"]["list"].values())
+
+    def paths(description):
+        return sum(len(op["value"]) for u in description["values"]["list"].values() for op in u)
+
+    def activate(description, environment):
+        """The values of the list variables after the view is activated in environment."""
+        clean = description.get("clean", {})
+        values = {}
+        for name, ops in description["values"]["list"].items():
+            value = environment.get(name)
+            if value is None and name in clean:
+                values[name] = clean[name]
+            else:
+                var = envvars.EnvVarSet.from_dict({"list": {name: ops}, "scalar": {}}).lists[name]
+                values[name] = var.get_value(value)
+        return values
+
+    print(f"view with {args.packages} packages and {len(v1['values']['list'])} list variables")
+    print(f"{'':12} {'updates':>8} {'paths':>8} {'JSON KiB':>9} {'set (ms)':>9} {'not set (ms)':>13}")
+    for label, description in [("version 1", v1), ("version 2", v2)]:
+        size = len(json.dumps(description)) / 1024
+        set_time = best_of(args.repeat, lambda: activate(description, current))
+        unset_time = best_of(args.repeat, lambda: activate(description, {}))
+        print(
+            f"{label:12} {updates(description):8} {paths(description):8} {size:9.1f} "
+            f"{set_time * 1000:9.3f} {unset_time * 1000:13.3f}"
+        )
+
+    # the compacted updates give the same values as the original updates, without the repeated paths
+    for environment in (current, {}):
+        for name, value in activate(v1, environment).items():
+            assert ":".join(dict.fromkeys(value.split(":"))) == activate(v2, environment)[name], name
+
+    compact = best_of(args.repeat, lambda: envvars.env_description(envvars.EnvVarSet.from_dict(v1["values"])))
+    print(f"compacting the updates when the uenv is built: {compact * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
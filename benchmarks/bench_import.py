@@ -0,0 +1,80 @@
+"""Benchmark the startup time of stack-config.
+
+Measures the cumulative import time of stackinator.main reported by
+python -X importtime, and the wall time of `stack-config --version`, as the
+best of several runs. Exits with a non-zero status if the import time exceeds
+the budget, or if one of the modules that are only needed to generate a
+configuration (jinja2, jsonschema, magic, yaml) is imported at startup.
+
+    python benchmarks/bench_import.py --budget-ms 100
+"""
+
+import argparse
+import pathlib
+import re
+import subprocess
+import sys
+import time
+
+root = pathlib.Path(__file__).parent.parent
+
+# modules that must not be loaded by `import stackinator.main`
+DEFERRED = ["jinja2", "jsonschema", "magic", "yaml", "stackinator.builder", "stackinator.recipe", "stackinator.schema"]
+
+
+def import_times():
+    """The cumulative import time of each module in microseconds, from python -X importtime."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import stackinator.main"],
+        cwd=root,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)", line)
+        if match:
+            times[match.group(4)] = int(match.group(2))
+    return times
+
+
+def version_wall_time():
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, "-m", "stackinator.main", "--version"], cwd=root, capture_output=True, check=True)
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument(
+        "--budget-ms", type=float, default=100, help="maximum import time of stackinator.main (default 100ms)"
+    )
+    args = parser.parse_args()
+
+    runs = [import_times() for _ in range(args.repeat)]
+    best = min(run["stackinator.main"] for run in runs) / 1000
+    stackinator = {
+        name: min(run.get(name, 0) for run in runs) / 1000 for name in runs[0] if name.startswith("stackinator")
+    }
+    version = min(version_wall_time() for _ in range(args.repeat))
+
+    print(f"import stackinator.main   {best:7.1f} ms (budget {args.budget_ms:.0f} ms)")
+    for name, ms in sorted(stackinator.items(), key=lambda item: -item[1]):
+        print(f"  {name:<24}{ms:7.1f} ms")
+    print(f"stack-config --version    {version * 1000:7.1f} ms (wall, including the interpreter)")
+
+    status = 0
+    loaded = [name for name in DEFERRED if name in runs[0]]
+    if loaded:
+        print(f"error: modules that should be deferred are imported at startup: {', '.join(loaded)}")
+        status = 1
+    if best > args.budget_ms:
+        print(f"error: the import time of stackinator.main exceeds the budget of {args.budget_ms:.0f} ms")
+        status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
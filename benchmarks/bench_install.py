@@ -0,0 +1,93 @@
+"""Benchmark the installation of a package repository into the store.
+
+Creates a synthetic spack package repository with 10k packages, and times how
+long it takes to install it with the previous implementation (shutil.copytree
+followed by a chmod walk), and with stackinator.builder.install() with one or
+more threads, copying or hard linking the files.
+
+    python benchmarks/bench_install.py --packages 10000 --jobs 8 --path /scratch/bench
+"""
+
+import argparse
+import os
+import pathlib
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+from stackinator.builder import install  # noqa: E402
+
+
+def make_repo(root: pathlib.Path, packages: int):
+    """A repository with the shape of spack-packages: one directory per package, some with patches."""
+    rng = random.Random(0)
+    packages_path = root / "repos" / "spack_repo" / "builtin" / "packages"
+    for i in range(packages):
+        pkg = packages_path / f"py_package_{i}"
+        pkg.mkdir(parents=True)
+        (pkg / "package.py").write_bytes(rng.randbytes(rng.randint(1000, 8000)))
+        for j in range(rng.choice([0, 0, 0, 1, 2, 4])):
+            (pkg / f"fix-{j}.patch").write_bytes(rng.randbytes(rng.randint(500, 20000)))
+    (packages_path.parent / "repo.yaml").write_text("repo:\n  namespace: builtin\n  api: v2.0\n")
+    return packages_path.parent
+
+
+def copytree_then_chmod(src, dst):
+    """The implementation of install() before the single-pass installer."""
+
+    def set_permissions(path):
+        mode = os.stat(path).st_mode
+        new_mode = mode | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+        if stat.S_ISDIR(mode) or mode & (stat.S_IXUSR | stat.S_IXGRP):
+            new_mode |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+        os.chmod(path, new_mode)
+
+    shutil.copytree(src, dst)
+    set_permissions(dst)
+    for dirpath, dirnames, filenames in os.walk(dst):
+        for name in dirnames + filenames:
+            set_permissions(os.path.join(dirpath, name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--packages", type=int, default=10000)
+    parser.add_argument("--jobs", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--path", type=str, default=None, help="directory for the repository (default: a tmpdir)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.path) as tmp:
+        tmp = pathlib.Path(tmp)
+        t0 = time.perf_counter()
+        src = make_repo(tmp / "clone", args.packages)
+        nfiles = sum(len(files) for _, _, files in os.walk(src))
+        print(f"created {args.packages} packages ({nfiles} files) in {time.perf_counter() - t0:.1f}s")
+
+        methods = {
+            "copytree + chmod walk": copytree_then_chmod,
+            "install, 1 thread": lambda s, d: install(s, d),
+            f"install, {args.jobs} threads": lambda s, d: install(s, d, jobs=args.jobs),
+            f"install, {args.jobs} threads, link": lambda s, d: install(s, d, jobs=args.jobs, link=True),
+        }
+        baseline = None
+        for label, method in methods.items():
+            times = []
+            for i in range(args.repeat):
+                dst = tmp / "store" / f"{len(times)}"
+                t0 = time.perf_counter()
+                method(src, dst)
+                times.append(time.perf_counter() - t0)
+                shutil.rmtree(tmp / "store")
+            best = min(times)
+            baseline = baseline or best
+            print(f"  {label:<32} {best:7.2f}s  {baseline / best:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Benchmark the critical path of the task graph of a build.
+
+Computes the longest path through the task graph of a build path, weighted by
+the time of every step, for the graph in which the setup steps, the views and
+the upstream config were chained, and for the current graph. The wall time of
+`make -j` is then measured on a Makefile with each graph, in which every step
+sleeps for its time multiplied by --scale.
+
+The times of the steps are taken from the ledger of a real build (--ledger),
+and default to those of a typical build from a warm build cache. The install
+step is the same in both graphs, and is left out with --without-install.
+
+    python benchmarks/bench_pipeline.py --ledger $BUILD_PATH/ledger.jsonl --scale 0.005
+"""
+
+import argparse
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+from stackinator import pipeline, render, report  # noqa: E402
+
+VIEWS = ["default", "develop"]
+MODULE_TYPES = ["tcl"]
+
+# seconds, from a build of a recipe with two views and tcl modules from a warm build cache
+DEFAULT_TIMES = {
+    "spack-query": 3,
+    "spack-setup": 60,
+    "pre-install": 2,
+    "gpg-trust": 20,
+    "mirror-setup": 8,
+    "env/spack.lock": 120,
+    "prefetch": 60,
+    "install": 1800,
+    "fetch-sources": 90,
+    "cache-push": 60,
+    "cleanup": 30,
+    "compiler-config.yaml": 25,
+    "install-query": 25,
+    "view-default": 15,
+    "view-develop": 15,
+    "views": 0,
+    "generate-config/.done": 3,
+    "modules-tcl": 60,
+    "modules-done": 0,
+    "env-meta": 5,
+    "post-install": 10,
+    "prune-repos": 5,
+    "store.squashfs": 180,
+}
+
+
+def current_pipeline(views, module_types):
+    """The task graph of the Makefile that stack-config generates."""
+    makefile = (
+        render.environment()
+        .get_template("Makefile")
+        .render(
+            modules=bool(module_types),
+            module_types=module_types,
+            environments={"env": {"views": [{"name": view, "extra": {"prefix_string": ""}} for view in views]}},
+            spack_meta={"url": "", "ref": "", "commit": "", "packages": []},
+            gpg_keys=[],
+            exclude_from_cache=[],
+            cleanup=None,
+        )
+    )
+    return pipeline.make_pipeline(makefile)["tasks"]
+
+
+def chained_pipeline(views, module_types):
+    """The task graph before the independent setup and post-install steps were separated."""
+    tasks = {
+        "spack-setup": [],
+        "pre-install": ["spack-setup"],
+        "gpg-trust": [],
+        "mirror-setup": ["pre-install", "gpg-trust"],
+        "env/spack.lock": ["mirror-setup"],
+        "prefetch": ["env/spack.lock"],
+        "install": ["env/spack.lock", "prefetch"],
+        "fetch-sources": ["env/spack.lock"],
+        "cache-push": ["install"],
+        "cleanup": ["fetch-sources", "cache-push"],
+        "compiler-config.yaml": ["cleanup"],
+        "generate-config/.done": ["install", "compiler-config.yaml"],
+    }
+    for view in views:
+        tasks[f"view-{view}"] = ["install", "compiler-config.yaml"]
+    tasks["views"] = ["install", "compiler-config.yaml"] + [f"view-{view}" for view in views]
+    for module_type in module_types:
+        tasks[f"modules-{module_type}"] = ["generate-config/.done"]
+    tasks["modules-done"] = ["generate-config/.done"] + [f"modules-{module_type}" for module_type in module_types]
+    tasks["env-meta"] = ["generate-config/.done", "views", "modules-done"]
+    tasks["post-install"] = ["env-meta"]
+    tasks["prune-repos"] = ["env-meta", "post-install", "cache-push"]
+    tasks["store.squashfs"] = ["env-meta", "post-install", "cache-push", "prune-repos"]
+    return {name: {"deps": deps} for name, deps in tasks.items()}
+
+
+def critical_path(tasks, times, target="store.squashfs"):
+    """The length of the longest path to target, and the tasks on it."""
+    finish = {}
+    for name in pipeline.required_tasks(tasks, target):
+        deps = tasks[name]["deps"]
+        start, path = max(((finish[dep][0], finish[dep][1]) for dep in deps), default=(0, []))
+        finish[name] = (start + times.get(name, 0), path + [name])
+    return finish[target]
+
+
+def measure(tasks, times, scale, jobs, target="store.squashfs"):
+    """The wall time of make -j on a Makefile of the graph, where every step sleeps for its scaled time."""
+
+    def stamp(name):
+        return name.replace("/", "_")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        lines = []
+        for name, task in tasks.items():
+            lines.append(f"{stamp(name)}: {' '.join(stamp(dep) for dep in task['deps'])}")
+            lines.append(f"\tsleep {times.get(name, 0) * scale:.3f}")
+            lines.append("\ttouch $@")
+        pathlib.Path(tmp, "Makefile").write_text("\n".join(lines) + "\n")
+        start = time.perf_counter()
+        subprocess.run(["make", "-s", f"-j{jobs}", "-C", tmp, stamp(target)], check=True)
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ledger", type=pathlib.Path, help="the ledger of a build, for the times of the steps")
+    parser.add_argument("--scale", type=float, default=0.005, help="the time of the sleep of a step per second")
+    parser.add_argument("--jobs", type=int, default=8, help="the number of steps that make runs concurrently")
+    parser.add_argument("--without-install", action="store_true", help="do not count the time of the install")
+    args = parser.parse_args()
+
+    times = dict(DEFAULT_TIMES)
+    if args.ledger is not None:
+        for build in report.summarise(report.load_ledgers([args.ledger])).values():
+            times.update({target: summary["wall"] for target, summary in build["targets"].items()})
+    if args.without_install:
+        times["install"] = 0
+
+    graphs = {
+        "chained": chained_pipeline(VIEWS, MODULE_TYPES),
+        "current": current_pipeline(VIEWS, MODULE_TYPES),
+    }
+    for name, tasks in graphs.items():
+        print(f"{name:>7}: {sum(times.get(task, 0) for task in tasks):8.0f}s serial")
+    results = {}
+    for name, tasks in graphs.items():
+        length, path = critical_path(tasks, times)
+        wall = measure(tasks, times, args.scale, args.jobs)
+        results[name] = (length, wall)
+        print(f"{name:>7}: {length:8.0f}s critical path, make -j{args.jobs} {wall / args.scale:8.0f}s")
+        print(f"         {' -> '.join(path)}")
+    saved = results["chained"][0] - results["current"][0]
+    print(f"the critical path is {saved:.0f}s ({100 * saved / results['chained'][0]:.1f}%) shorter")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
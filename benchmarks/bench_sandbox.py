@@ -0,0 +1,61 @@
+"""Benchmark the overhead of running a command in the sandbox of a build path.
+
+Measures the wall time of running `true` directly, with a new sandbox for
+every command (BUILD_PATH/sandbox), and in a sandbox session that is shared
+by the commands (BUILD_PATH/sandbox-session), as the median of several runs,
+and the time to start the session. The build path must have been configured
+without --no-bwrap, and bwrap and nsenter must be installed.
+
+    python benchmarks/bench_sandbox.py -b $BUILD_PATH -n 200
+"""
+
+import argparse
+import pathlib
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+from stackinator import pipeline  # noqa: E402
+
+
+def median_ms(command, env, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return 1000 * statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-b", "--build", type=pathlib.Path, required=True, help="a build path")
+    parser.add_argument("-n", "--repeat", type=int, default=100, help="the number of runs of each command")
+    args = parser.parse_args()
+
+    path = args.build.absolute()
+    scheduler = pipeline.Scheduler(path)
+    sandbox = [str(path / "sandbox"), "true"]
+
+    direct = median_ms(["true"], scheduler.env, args.repeat)
+    print(f"direct:      {direct:8.2f} ms")
+    per_command = median_ms(sandbox, scheduler.env, args.repeat)
+    print(f"per command: {per_command:8.2f} ms")
+
+    start = time.perf_counter()
+    with scheduler.sandbox_session():
+        started = 1000 * (time.perf_counter() - start)
+        if "STACKINATOR_SANDBOX_SESSION" not in scheduler.env:
+            print("the sandbox session could not be started")
+            return 1
+        session = median_ms(sandbox, scheduler.env, args.repeat)
+    print(f"session:     {session:8.2f} ms (started in {started:.1f} ms)")
+    print(f"{per_command / session:.1f}x faster, {per_command - session:.2f} ms saved per command")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
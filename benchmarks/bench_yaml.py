@@ -0,0 +1,96 @@
+"""Benchmark loading a large system packages.yaml.
+
+Creates a packages.yaml with several hundred externals, the shape of the
+packages.yaml of an HPC system configuration, and times how long it takes to
+load it with the pure python yaml.Loader that was used before, with the libyaml
+loader, and with stackinator.schema.DocumentCache on the first (cold) and later
+(warm) runs. The validated config.yaml of a recipe is timed the same way.
+
+    python benchmarks/bench_yaml.py --externals 500
+"""
+
+import argparse
+import pathlib
+import random
+import sys
+import tempfile
+import time
+
+import yaml
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+from stackinator import schema  # noqa: E402
+
+
+def make_packages(path: pathlib.Path, externals: int):
+    rng = random.Random(0)
+    packages = {}
+    for i in range(externals):
+        name = f"package-{i // 3}"
+        entry = packages.setdefault(name, {"buildable": False, "externals": []})
+        version = f"{rng.randint(1, 20)}.{rng.randint(0, 9)}.{rng.randint(0, 9)}"
+        entry["externals"].append(
+            {
+                "spec": f"{name}@{version} +shared ~static target=neoverse_v2 os=sles15",
+                "prefix": f"/opt/cray/pe/{name}/{version}",
+                "modules": [f"{name}/{version}", "craype-arm-grace"],
+                "extra_attributes": {"environment": {"prepend_path": {"LD_LIBRARY_PATH": f"/opt/{name}/lib64"}}},
+            }
+        )
+    path.write_text(yaml.dump({"packages": packages}))
+
+
+def best_of(repeat, func):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--externals", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    recipe = pathlib.Path(__file__).parent.parent / "unittests" / "recipes" / "host-recipe" / "config.yaml"
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        packages = tmp / "packages.yaml"
+        make_packages(packages, args.externals)
+        print(f"packages.yaml with {args.externals} externals ({packages.stat().st_size / 1024:.0f} KiB)")
+
+        for label, path, validator in [
+            ("packages.yaml", packages, None),
+            ("config.yaml (validated)", recipe, schema.ConfigValidator),
+        ]:
+
+            def load(loader):
+                document = yaml.load(path.read_bytes(), Loader=loader)
+                if validator is not None:
+                    validator.validate(document)
+
+            def cold():
+                schema.DocumentCache(pathlib.Path(tempfile.mkdtemp(dir=tmp))).load(path, validator)
+
+            warm_cache = schema.DocumentCache(tmp / "warm")
+            warm_cache.load(path, validator)
+            methods = {
+                "yaml.Loader": lambda: load(yaml.Loader),
+                f"yaml.{schema.Loader.__name__}": lambda: load(schema.Loader),
+                "DocumentCache, cold": cold,
+                "DocumentCache, warm": lambda: warm_cache.load(path, validator),
+            }
+            print(label)
+            baseline = None
+            for name, method in methods.items():
+                best = best_of(args.repeat, method)
+                baseline = baseline or best
+                print(f"  {name:<24} {best * 1000:8.2f}ms  {baseline / best:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+import argparse
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import pathlib
+import sys
+import time
+import traceback
+from typing import Dict, List, Optional
+
+import yaml
+
+from . import VERSION, render, root_logger, schema, trace
+from .cache import GitCache, default_git_cache, user_cache_dir
+from .main import configure_logging, generate_logfile_name
+
+# the files of a system configuration that are read by the recipe and the builder
+SYSTEM_FILES = ["packages.yaml", "network.yaml", "repos.yaml"]
+
+# the validators that are used by every recipe
+VALIDATORS = [
+    schema.ConfigValidator,
+    schema.CompilersValidator,
+    schema.EnvironmentsValidator,
+    schema.ModulesValidator,
+    schema.MirrorsValidator,
+    schema.CacheValidator,
+]
+
+
+def load_matrix(path: pathlib.Path) -> List[Dict]:
+    """The list of (recipe, system) jobs described by a matrix file.
+
+    Relative paths in the matrix are relative to the matrix file. Every recipe is
+    combined with every system, except for the pairs that match an entry of
+    exclude, which is matched against the paths as written in the matrix and
+    against the directory names of the recipe and system.
+    """
+
+    with path.open() as fid:
+        raw = yaml.load(fid, Loader=yaml.SafeLoader)
+    schema.BatchValidator.validate(raw)
+
+    def matches(value, entry):
+        return value is None or value == entry or value == pathlib.Path(entry).name
+
+    jobs = []
+    names = set()
+    for recipe in raw["recipes"]:
+        for system in raw["systems"]:
+            if any(matches(e.get("recipe"), recipe) and matches(e.get("system"), system) for e in raw["exclude"]):
+                continue
+            recipe_path = (path.parent / recipe).resolve()
+            system_path = (path.parent / system).resolve()
+            name = f"{recipe_path.name}@{system_path.name}"
+            # recipes or systems in different directories can share a name
+            if name in names:
+                name = f"{name}-{len(jobs)}"
+            names.add(name)
+            jobs.append({"name": name, "recipe": recipe_path, "system": system_path})
+    return jobs
+
+
+def _repositories(recipe_path: pathlib.Path) -> List[tuple]:
+    """The (url, ref) of spack and the package repositories in the config.yaml of
+    a recipe. Errors are ignored: they are reported by the job of the recipe."""
+
+    try:
+        with (recipe_path / "config.yaml").open() as fid:
+            spack = yaml.load(fid, Loader=yaml.SafeLoader)["spack"]
+        repos = [(spack["repo"], spack.get("commit"))]
+        packages = spack.get("packages", {})
+        if isinstance(packages.get("repo"), str):
+            repos.append((packages["repo"], packages.get("commit")))
+        else:
+            repos += [(val["repo"], val.get("commit")) for val in packages.values()]
+        return repos
+    except (OSError, yaml.YAMLError, KeyError, TypeError, AttributeError):
+        return []
+
+
+def warm(jobs: List[Dict], git_cache: Optional[GitCache], threads: int):
+    """Load everything that is shared by the jobs once, before the worker processes
+    are forked, so that the workers inherit it: the schema validators, the compiled
+    templates and the system configurations, and, if git_cache is set, the git
+    mirrors of the repositories of all recipes."""
+
+    from .builder import Builder
+    from .recipe import load_system_yaml
+
+    with trace.span("schemas"):
+        for validator in VALIDATORS:
+            validator._validator
+    with trace.span("templates"):
+        env = render.environment()
+        for name in env.list_templates():
+            env.get_template(name)
+    with trace.span("systems"):
+        for system in {job["system"] for job in jobs}:
+            for name in SYSTEM_FILES:
+                try:
+                    load_system_yaml(system / name)
+                except (OSError, yaml.YAMLError) as err:
+                    root_logger.debug(f"unable to load {system / name}: {err}")
+
+    if git_cache is None:
+        return
+
+    repos = set()
+    for recipe in {job["recipe"] for job in jobs}:
+        repos.update(_repositories(recipe))
+
+    def update(url, ref):
+        with trace.span(f"git: {url}", ref=ref):
+            try:
+                with git_cache.mirror(url, ref, lambda args: Builder._run_git(args, root_logger)):
+                    pass
+            except Exception as err:
+                root_logger.warning(f"unable to update the git cache for {url} {ref or ''}: {err}")
+
+    with trace.span("git"), concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        context = trace.tracer.context()
+        futures = [pool.submit(_attached, context, update, url, ref) for url, ref in sorted(repos, key=str)]
+        concurrent.futures.wait(futures)
+
+
+def _attached(context, func, *args):
+    with trace.tracer.attach(context):
+        return func(*args)
+
+
+# the directory of the logs of the jobs, in the worker processes
+_log_path = None
+
+
+def _init_worker(log_path: pathlib.Path):
+    global _log_path
+    # the handlers of the parent write to the terminal and its log: each job
+    # logs to a file of its own instead.
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.setLevel(logging.DEBUG)
+    _log_path = log_path
+
+
+def run_job(job: Dict, options: argparse.Namespace) -> Dict:
+    """Validate the recipe of a job for its system, and if options.configure is
+    set, generate its build path. Runs in a worker process."""
+
+    from .builder import Builder
+    from .recipe import Recipe
+
+    log = _log_path / f"{job['name']}.log"
+    handler = logging.FileHandler(log, mode="w")
+    handler.setFormatter(logging.Formatter("%(asctime)s : %(levelname)-7s : %(message)s"))
+    root_logger.addHandler(handler)
+    # the timings of each job are reported separately
+    trace.tracer = trace.Tracer()
+
+    result = {
+        "name": job["name"],
+        "recipe": str(job["recipe"]),
+        "system": str(job["system"]),
+        "status": "pass",
+        "error": None,
+        "log": str(log),
+        "build": None,
+    }
+    args = argparse.Namespace(
+        recipe=str(job["recipe"]),
+        system=str(job["system"]),
+        mount=options.mount,
+        mirror=options.mirror,
+        cache=None,
+        develop=options.develop,
+        no_bwrap=options.no_bwrap,
+        jobs=options.jobs,
+        git_cache=None,
+        image_cache=None,
+        image_cache_max_size=None,
+        build=None,
+    )
+    start = time.perf_counter()
+    try:
+        recipe = Recipe(args)
+        with trace.span("spack.yaml"):
+            recipe.spack_yaml
+        if options.configure is not None:
+            args.build = str(options.configure / job["name"].replace("@", "-"))
+            result["build"] = args.build
+            builder = Builder(args)
+            if options.git_cache is not None:
+                # the mirrors were updated by warm()
+                builder.git_cache = GitCache(options.git_cache, refresh=False)
+            builder.generate(recipe)
+    except Exception as err:
+        root_logger.debug(traceback.format_exc())
+        root_logger.error(str(err))
+        result["status"] = "fail"
+        result["error"] = f"{type(err).__name__}: {err}"
+    finally:
+        root_logger.removeHandler(handler)
+        handler.close()
+    result["elapsed"] = round(time.perf_counter() - start, 3)
+    result["phases"] = [
+        {"name": name, "depth": depth, "count": count, "time": round(duration / 1e9, 3)}
+        for (depth, name), (count, duration) in trace.tracer.totals().items()
+    ]
+    return result
+
+
+def make_argparser():
+    parser = argparse.ArgumentParser(
+        prog="stack-config batch",
+        description="Validate, or configure, every recipe of a matrix for every system configuration.",
+    )
+    parser.add_argument("--version", action="version", version=f"stackinator version {VERSION}")
+    parser.add_argument("matrix", type=pathlib.Path, help="yaml file with the lists of recipes and systems")
+    parser.add_argument(
+        "-o",
+        "--report",
+        type=pathlib.Path,
+        default=pathlib.Path("stackinator-batch.json"),
+        help="Where to write the json report (default: stackinator-batch.json).",
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of recipes that are processed concurrently (default: the number of cpus).",
+    )
+    parser.add_argument(
+        "--configure",
+        type=pathlib.Path,
+        metavar="BUILD_ROOT",
+        help="Also generate the build path of every job, in BUILD_ROOT/RECIPE-SYSTEM.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Maximum number of concurrent workers used to configure each recipe, e.g. to clone repositories.",
+    )
+    parser.add_argument(
+        "--git-cache",
+        default=default_git_cache(),
+        type=str,
+        help="Path of the git cache shared by the jobs with --configure "
+        "(default: $STACKINATOR_GIT_CACHE, or the git directory in the user cache).",
+    )
+    parser.add_argument("-m", "--mount", type=str, help="The mount point of all recipes.")
+    parser.add_argument("--mirror", type=str, help="Path to a mirrors.yaml file describing build caches and mirrors.")
+    parser.add_argument("--develop", action="store_true")
+    parser.add_argument("--no-bwrap", action="store_true")
+    return parser
+
+
+def main(argv: List[str]) -> int:
+    args = make_argparser().parse_args(argv)
+
+    logfile = generate_logfile_name("_batch")
+    configure_logging(logfile)
+    log_path = pathlib.Path(f"{logfile}.jobs")
+    log_path.mkdir()
+
+    try:
+        jobs = load_matrix(args.matrix)
+    except Exception as err:
+        root_logger.error(f"invalid matrix {args.matrix}: {err}")
+        return 1
+
+    git_cache = None
+    if args.configure is not None:
+        args.configure = args.configure.absolute()
+        args.git_cache = pathlib.Path(args.git_cache or user_cache_dir() / "git").absolute()
+        git_cache = GitCache(args.git_cache)
+
+    root_logger.info(f"stack-config batch: {len(jobs)} jobs from {args.matrix}, logs in {log_path}")
+    start = time.perf_counter()
+    with trace.span("warm"):
+        warm(jobs, git_cache, args.jobs or 8)
+
+    results = []
+    # the workers are forked, so that they inherit the state loaded by warm()
+    context = multiprocessing.get_context("fork")
+    with (
+        trace.span("jobs"),
+        concurrent.futures.ProcessPoolExecutor(
+            max_workers=max(1, min(args.processes, len(jobs))),
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(log_path,),
+        ) as pool,
+    ):
+        futures = [pool.submit(run_job, job, args) for job in jobs]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if result["status"] == "pass":
+                root_logger.info(f"  pass  {result['name']} ({result['elapsed']:.2f}s)")
+            else:
+                root_logger.error(f"  fail  {result['name']} ({result['elapsed']:.2f}s): {result['error']}")
+
+    order = {job["name"]: i for i, job in enumerate(jobs)}
+    results.sort(key=lambda r: order[r["name"]])
+    failed = sum(r["status"] != "pass" for r in results)
+    report = {
+        "stackinator": VERSION,
+        "matrix": str(args.matrix.absolute()),
+        "mode": "configure" if args.configure is not None else "validate",
+        "elapsed": round(time.perf_counter() - start, 3),
+        "warm": [
+            {"name": name, "depth": depth, "count": count, "time": round(duration / 1e9, 3)}
+            for (depth, name), (count, duration) in trace.tracer.totals().items()
+            if depth > 0
+        ],
+        "passed": len(results) - failed,
+        "failed": failed,
+        "results": results,
+    }
+    with args.report.open("w") as fid:
+        json.dump(report, fid, indent=2)
+        fid.write("\n")
+
+    root_logger.info(f"{len(results) - failed} passed, {failed} failed in {report['elapsed']:.1f}s")
+    root_logger.info(f"report: {args.report}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
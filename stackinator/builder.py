@@ -1,17 +1,25 @@
+import concurrent.futures
+import errno
+import fcntl
+import hashlib
 import json
 import os
 import pathlib
 import platform
+import queue
 import shutil
 import stat
 import subprocess
 import sys
+import threading
+import time
 from datetime import datetime
+from typing import Callable, Dict, Optional, Tuple, Union
 
-import jinja2
 import yaml
 
-from . import VERSION, root_logger, spack_util
+from . import VERSION, pipeline, render, root_logger, schema, spack_util, trace
+from .cache import GitCache, ImageCache, parse_size
 
 _REPO_YAML = """\
 repo:
@@ -20,34 +28,503 @@ repo:
 """
 
 
-def install(src, dst, *, ignore=None, symlinks=False):
-    """Call shutil.copytree or shutil.copy2, then apply chmod a+rX to dst."""
+# the ioctl that shares the extents of a file with another (a "reflink"), from linux/fs.h
+_FICLONE = getattr(fcntl, "FICLONE", 0x40049409)
+# (source, destination) devices on which reflinks or copy_file_range are not supported
+_no_reflink = set()
+_no_copy_range = set()
+# errors that mean a copy or link method is not supported between two files
+_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EPERM, errno.EBADF}
 
-    def apply_permissions_recursive(directory):
-        def set_permissions(path):
-            mode = os.stat(path).st_mode
-            new_mode = mode | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
-            if stat.S_ISDIR(mode) or mode & (stat.S_IXUSR | stat.S_IXGRP):
-                new_mode |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
-            os.chmod(path, new_mode)
 
-        set_permissions(directory)
-        for dirpath, dirnames, filenames in os.walk(directory):
-            for dirname in dirnames:
-                set_permissions(os.path.join(dirpath, dirname))
-            for filename in filenames:
-                set_permissions(os.path.join(dirpath, filename))
+def _makefile_recipes(text: str) -> Dict[str, str]:
+    """The recipe of every rule in a generated Makefile, by target."""
 
-    if stat.S_ISDIR(os.stat(src).st_mode):
-        shutil.copytree(src, dst, ignore=ignore, symlinks=symlinks)
-    else:
-        shutil.copy2(src, dst, follow_symlinks=symlinks)
-    apply_permissions_recursive(dst)
+    return {target: recipe for target, (_, recipe) in pipeline.makefile_rules(text).items()}
+
+
+def _installed_mode(mode):
+    """The permissions of mode with a+r added, and a+x for directories and executables."""
+
+    new_mode = stat.S_IMODE(mode) | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+    if stat.S_ISDIR(mode) or mode & (stat.S_IXUSR | stat.S_IXGRP):
+        new_mode |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+    return new_mode
+
+
+def _copy_file(src, dst, st, link):
+    """Copy the file src with stat st to dst, applying the install permissions.
+
+    The cheapest method that the file systems support is used: a hard link if
+    link is set and the permissions of src are already correct, a reflink, a
+    copy_file_range in the kernel, and finally a copy in user space.
+    """
+
+    mode = _installed_mode(st.st_mode)
+    if link and mode == stat.S_IMODE(st.st_mode):
+        try:
+            os.link(src, dst)
+            return
+        except OSError as err:
+            if err.errno not in _UNSUPPORTED:
+                raise
+
+    with open(src, "rb") as fsrc:
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            devices = (st.st_dev, os.fstat(fd).st_dev)
+            copied = False
+            if devices not in _no_reflink:
+                try:
+                    fcntl.ioctl(fd, _FICLONE, fsrc.fileno())
+                    copied = True
+                except OSError as err:
+                    if err.errno not in _UNSUPPORTED:
+                        raise
+                    _no_reflink.add(devices)
+            if not copied and st.st_size and hasattr(os, "copy_file_range") and devices not in _no_copy_range:
+                try:
+                    while os.copy_file_range(fsrc.fileno(), fd, 1 << 30):
+                        pass
+                    copied = True
+                except OSError as err:
+                    if err.errno not in _UNSUPPORTED or os.lseek(fd, 0, os.SEEK_CUR) != 0:
+                        raise
+                    _no_copy_range.add(devices)
+            if not copied:
+                with os.fdopen(os.dup(fd), "wb") as fdst:
+                    shutil.copyfileobj(fsrc, fdst, 1 << 20)
+            os.fchmod(fd, mode)
+        finally:
+            os.close(fd)
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def _install_dir(src, dst, ignore, symlinks, link):
+    """Copy the contents of the directory src into the existing directory dst.
+
+    Returns the list of subdirectories that were created, as arguments for
+    further calls, so that the caller can copy them in parallel.
+    """
+
+    with os.scandir(src) as it:
+        entries = list(it)
+    if ignore is not None:
+        ignored = ignore(src, [entry.name for entry in entries])
+        entries = [entry for entry in entries if entry.name not in ignored]
+
+    subdirs = []
+    for entry in entries:
+        target = os.path.join(dst, entry.name)
+        if symlinks and entry.is_symlink():
+            os.symlink(os.readlink(entry.path), target)
+        elif entry.is_dir():
+            os.mkdir(target)
+            os.chmod(target, _installed_mode(entry.stat().st_mode))
+            subdirs.append((entry.path, target, ignore, symlinks, link))
+        else:
+            _copy_file(entry.path, target, entry.stat(), link)
+    return subdirs
+
+
+def install_trees(trees, jobs=1):
+    """Install a list of (src, dst, ignore, symlinks, link) trees, see install().
+
+    The directories of all trees are copied by a pool of jobs threads: each
+    directory is a task that creates its subdirectories and copies its files,
+    and the subdirectories are submitted as new tasks. The time from the start
+    of the first task of a tree to the end of its last task is traced.
+    """
+
+    starts = {}
+
+    def install_root(index, src, dst, ignore, symlinks, link):
+        starts[index] = trace.tracer.now()
+        st = os.stat(src)
+        if not stat.S_ISDIR(st.st_mode):
+            _copy_file(src, dst, st, link)
+            return []
+        os.makedirs(dst)
+        os.chmod(dst, _installed_mode(st.st_mode))
+        return _install_dir(src, dst, ignore, symlinks, link)
+
+    if not trees:
+        return
+    # finished tasks are put on a queue by a callback, because waiting on the
+    # set of pending futures would cost O(pending) for every directory.
+    finished = queue.SimpleQueue()
+
+    def submit(pool, index, func, *args):
+        pool.submit(func, *args).add_done_callback(lambda future: finished.put((index, future)))
+
+    # the number of tasks of each tree that have not finished
+    remaining = [1] * len(trees)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for index, tree in enumerate(trees):
+            submit(pool, index, install_root, index, *map(os.fspath, tree[:2]), *tree[2:])
+        pending = len(trees)
+        while pending:
+            index, future = finished.get()
+            try:
+                subdirs = future.result()
+            except Exception:
+                pool.shutdown(cancel_futures=True)
+                raise
+            for subdir in subdirs:
+                submit(pool, index, _install_dir, *subdir)
+            pending += len(subdirs) - 1
+            remaining[index] += len(subdirs) - 1
+            if remaining[index] == 0:
+                trace.tracer.add_async("install tree", starts[index], trace.tracer.now(), dst=trees[index][1])
+
+
+def install(src, dst, *, ignore=None, symlinks=False, link=False, jobs=1):
+    """Copy the file or directory src to dst, applying chmod a+rX to everything copied.
+
+    Permissions are applied as each file and directory is created, instead of
+    in a second walk over dst. ignore has the same meaning as for
+    shutil.copytree. If link is set, files that already have the right
+    permissions are hard linked instead of copied, which is only safe when src
+    is not modified in place afterwards, e.g. a git clone in the build path.
+    """
+
+    install_trees([(src, dst, ignore, symlinks, link)], jobs=jobs)
+
+
+class BuildOutputs:
+    """The complete set of files and directory trees generated by a configure run.
+
+    Outputs are first collected in memory with add_file() and add_tree(), then
+    written in a single pass by write(). A file is only written when its bytes
+    differ from those already on disk, and a tree is only copied again when the
+    files in its source have changed, so the mtimes of unchanged outputs never
+    move and make only reruns the steps whose inputs actually changed.
+
+    A manifest of the content hash of every output is kept in the build path.
+    It makes the check for unchanged outputs cheap, and lets write() remove
+    outputs of a previous configure that are no longer generated (e.g. a hook
+    or a package that was removed from the recipe).
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, manifest_path: pathlib.Path, jobs: int = 1):
+        self._logger = root_logger
+        self._manifest_path = manifest_path
+        self._jobs = jobs
+        self._files: Dict[pathlib.Path, Tuple[bytes, bool]] = {}
+        self._trees: Dict[pathlib.Path, Tuple[pathlib.Path, Optional[Callable], bool, str]] = {}
+        self._dirs = set()
+
+    def add_file(self, path: pathlib.Path, content: Union[str, bytes], executable: bool = False):
+        """Add a file with the given content; text is encoded as utf-8."""
+
+        if isinstance(content, str):
+            content = content.encode()
+        self._files[path] = (content, executable)
+
+    def content(self, path: pathlib.Path) -> Optional[bytes]:
+        """The content of a file that has been added, or None."""
+
+        entry = self._files.get(path)
+        return entry[0] if entry is not None else None
+
+    def add_tree(self, src: pathlib.Path, dst: pathlib.Path, *, ignore: Optional[Callable] = None, link: bool = False):
+        """Add a copy of the directory src (or a single file) at dst, see install()."""
+
+        with trace.span("scan tree", src=src):
+            self._trees[dst] = (src, ignore, link, self._tree_signature(src, ignore))
+
+    def add_dir(self, path: pathlib.Path):
+        """Add an (empty) directory, which replaces a tree installed at path by a previous configure."""
+
+        self._dirs.add(path)
+
+    def fingerprint(self, *paths: pathlib.Path, **values) -> str:
+        """A hash of the outputs that have been added at or below paths, and of values.
+
+        Files are hashed by content, and trees by the signature of their source,
+        so the fingerprint only changes when an output would be written again.
+        """
+
+        h = hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode())
+
+        def selected(path):
+            return any(path == p or p in path.parents for p in paths)
+
+        for path, (content, executable) in sorted(self._files.items()):
+            if selected(path):
+                h.update(f"f:{path}:{hashlib.sha256(content).hexdigest()}:{executable}\n".encode())
+        for path, (_, _, _, signature) in sorted(self._trees.items()):
+            if selected(path):
+                h.update(f"t:{path}:{signature}\n".encode())
+        return h.hexdigest()
+
+    def digest(self, exclude: Tuple[pathlib.Path, ...] = (), **values) -> str:
+        """A hash of the content of every output that is not at or below exclude, and of values.
+
+        Unlike fingerprint(), the hash does not depend on where the build path is,
+        or when the sources of the trees were modified: the build path is replaced
+        by a placeholder in paths and in the content of files, and trees are hashed
+        by the content of their files. Linked trees are clones of git repositories,
+        which are identified by their path only: their commits have to be in values.
+        """
+
+        root = str(self._manifest_path.parent)
+        h = hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode())
+
+        def excluded(path):
+            return any(path == p or p in path.parents for p in exclude)
+
+        for path, (content, executable) in sorted(self._files.items()):
+            if not excluded(path):
+                content = content.replace(root.encode(), b"$(BUILD_ROOT)")
+                h.update(f"f:{str(path).replace(root, '$(BUILD_ROOT)')}:{executable}\n".encode())
+                h.update(hashlib.sha256(content).digest())
+        for path, (src, ignore, link, _) in sorted(self._trees.items()):
+            if not excluded(path):
+                h.update(f"t:{str(path).replace(root, '$(BUILD_ROOT)')}\n".encode())
+                if not link:
+                    with trace.span("hash tree", src=src):
+                        h.update(self._tree_digest(src, ignore).encode())
+        return h.hexdigest()
+
+    @staticmethod
+    def _tree_digest(src: pathlib.Path, ignore: Optional[Callable]) -> str:
+        """A hash of the relative path, content and executable bit of every file in src."""
+
+        h = hashlib.sha256()
+        if not src.is_dir():
+            h.update(src.read_bytes())
+            h.update(str(os.access(src, os.X_OK)).encode())
+            return h.hexdigest()
+
+        for dirpath, dirnames, filenames in os.walk(src, followlinks=True):
+            if ignore is not None:
+                ignored = ignore(dirpath, dirnames + filenames)
+                dirnames[:] = [d for d in dirnames if d not in ignored]
+                filenames = [f for f in filenames if f not in ignored]
+            dirnames.sort()
+            rel = os.path.relpath(dirpath, src)
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                if not os.path.exists(path):
+                    # a dangling symlink
+                    h.update(f"l:{rel}/{name}\n".encode())
+                    continue
+                with open(path, "rb") as fid:
+                    h.update(f"f:{rel}/{name}:{os.access(path, os.X_OK)}:".encode())
+                    h.update(hashlib.file_digest(fid, "sha256").digest())
+        return h.hexdigest()
+
+    @staticmethod
+    def _tree_signature(src: pathlib.Path, ignore: Optional[Callable]) -> str:
+        """A hash of the path, size, mtime and mode of every file in src.
+
+        Only the metadata is hashed, which is enough to detect a changed source
+        (git writes a new file on checkout) without reading every file.
+        """
+
+        h = hashlib.sha256(str(src).encode())
+        if not src.is_dir():
+            st = os.stat(src)
+            h.update(f"{st.st_size}:{st.st_mtime_ns}:{st.st_mode}".encode())
+            return h.hexdigest()
+
+        for dirpath, dirnames, filenames in os.walk(src, followlinks=True):
+            if ignore is not None:
+                ignored = ignore(dirpath, dirnames + filenames)
+                dirnames[:] = [d for d in dirnames if d not in ignored]
+                filenames = [f for f in filenames if f not in ignored]
+            dirnames.sort()
+            rel = os.path.relpath(dirpath, src)
+            h.update(f"d:{rel}\n".encode())
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    # a dangling symlink, which copytree would fail on
+                    h.update(f"l:{rel}/{name}\n".encode())
+                    continue
+                h.update(f"f:{rel}/{name}:{st.st_size}:{st.st_mtime_ns}:{st.st_mode}\n".encode())
+        return h.hexdigest()
+
+    def _load_manifest(self) -> dict:
+        try:
+            with self._manifest_path.open() as fid:
+                manifest = json.load(fid)
+        except (OSError, ValueError):
+            return {}
+        return manifest.get("outputs", {}) if isinstance(manifest, dict) else {}
+
+    @staticmethod
+    def _atomic_write(path: pathlib.Path, content: bytes):
+        tmp = path.with_name(f".{path.name}.tmp")
+        tmp.write_bytes(content)
+        os.replace(tmp, path)
+
+    def write(self, missing_ok: Tuple[pathlib.Path, ...] = ()) -> Dict[str, int]:
+        """Write every changed output to disk and update the manifest.
+
+        A tree at or below missing_ok that has been removed since the last write,
+        e.g. a package pruned by the build, is not installed again if its source
+        is unchanged. Returns the number of outputs that were written, unchanged
+        and removed.
+        """
+
+        old = self._load_manifest()
+        new = {}
+        stats = {"written": 0, "unchanged": 0, "removed": 0}
+
+        for path in sorted(self._dirs):
+            key = str(path)
+            # a tree that was installed at path by the last configure is replaced by an empty directory
+            if "tree" in old.get(key, {}) and path.is_dir() and not path.is_symlink():
+                self._logger.debug(f"emptying {path}")
+                shutil.rmtree(path)
+                stats["written"] += 1
+            path.mkdir(parents=True, exist_ok=True)
+            new[key] = {"dir": True}
+
+        for path, (content, executable) in sorted(self._files.items()):
+            key = str(path)
+            digest = hashlib.sha256(content).hexdigest()
+
+            # the file on disk is only read when the manifest can't vouch for it:
+            # it was not written by the last configure, or was modified since.
+            unchanged = False
+            if path.is_file():
+                st = path.stat()
+                previous = old.get(key, {})
+                if bool(st.st_mode & stat.S_IXUSR) != executable:
+                    unchanged = False
+                elif previous.get("sha256") == digest and previous.get("mtime") == st.st_mtime_ns:
+                    unchanged = True
+                else:
+                    unchanged = st.st_size == len(content) and path.read_bytes() == content
+
+            if unchanged:
+                stats["unchanged"] += 1
+            else:
+                self._logger.debug(f"writing {path}")
+                path.parent.mkdir(parents=True, exist_ok=True)
+                self._atomic_write(path, content)
+                if executable:
+                    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+                stats["written"] += 1
+            new[key] = {"sha256": digest, "mtime": path.stat().st_mtime_ns, "executable": executable}
+
+        # the trees that changed are all copied together by a pool of threads
+        trees = []
+        for dst, (src, ignore, link, signature) in sorted(self._trees.items()):
+            key = str(dst)
+            new[key] = {"tree": signature}
+            kept = dst.exists() or any(dst == p or p in dst.parents for p in missing_ok)
+            if old.get(key, {}).get("tree") == signature and kept:
+                stats["unchanged"] += 1
+                continue
+
+            self._logger.debug(f"installing {src} to {dst}")
+            if dst.is_dir() and not dst.is_symlink():
+                shutil.rmtree(dst)
+            elif dst.exists():
+                dst.unlink()
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            trees.append((src, dst, ignore, False, link))
+            stats["written"] += 1
+        with trace.span("install trees", count=len(trees)):
+            install_trees(trees, jobs=self._jobs)
+
+        # remove the outputs of a previous configure that are no longer generated.
+        # outputs nested inside a tree that is still generated are left alone.
+        for key, entry in old.items():
+            if key in new:
+                continue
+            path = pathlib.Path(key)
+            if any(parent in self._trees for parent in path.parents):
+                continue
+            self._logger.debug(f"removing stale output {path}")
+            if "tree" in entry and path.is_dir() and not path.is_symlink():
+                shutil.rmtree(path)
+                stats["removed"] += 1
+            elif "dir" in entry and path.is_dir() and not any(path.iterdir()):
+                path.rmdir()
+                stats["removed"] += 1
+            elif path.is_file() or path.is_symlink():
+                path.unlink()
+                stats["removed"] += 1
+
+        self._manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        self._atomic_write(
+            self._manifest_path,
+            (json.dumps({"version": 1, "outputs": new}, sort_keys=True, indent=1) + "\n").encode(),
+        )
+
+        return stats
+
+
+def _write_outputs(outputs: BuildOutputs, build_path: pathlib.Path, repos_path: pathlib.Path, prune_digest: str):
+    """Write the outputs of a configure run, with the package repos that the build may have pruned.
+
+    If packages were removed from the package repos in the store by a previous
+    build (they were moved to repos-pruned in the build path), the pruned packages are left out
+    while the inputs of prune-repos are unchanged, so that the repos stay as the
+    build left them. Otherwise the repos are removed, so that they are installed
+    again in full, and pruned again by the build.
+    """
+
+    pruned = build_path / "repos-pruned"
+    if not pruned.exists():
+        return outputs.write()
+    previous = build_path / "fingerprints" / "prune-repos"
+    if previous.is_file() and previous.read_text().strip() == prune_digest:
+        return outputs.write(missing_ok=(repos_path,))
+    root_logger.debug("restoring the package repos in the store, which were pruned")
+    shutil.rmtree(repos_path, ignore_errors=True)
+    shutil.rmtree(pruned)
+    return outputs.write()
+
+
+class _GitCancelled(Exception):
+    """Raised in a clone that was cancelled because another clone failed."""
+
+
+class _RepoLog:
+    """Buffers the log messages of one repository until flush() is called."""
+
+    _lock = threading.Lock()
+
+    def __init__(self, logger):
+        self._logger = logger
+        self._records = []
+
+    def debug(self, msg):
+        self._records.append((self._logger.debug, msg))
+
+    def info(self, msg):
+        self._records.append((self._logger.info, msg))
+
+    def error(self, msg):
+        self._records.append((self._logger.error, msg))
+
+    def flush(self):
+        with self._lock:
+            for emit, msg in self._records:
+                emit(msg)
+        self._records = []
 
 
 class Builder:
+    # the default number of concurrent workers used during configuration
+    DEFAULT_JOBS = 8
+
     def __init__(self, args):
         self._logger = root_logger
+        self.jobs = args.jobs or self.DEFAULT_JOBS
+        self.git_cache = GitCache(pathlib.Path(args.git_cache)) if args.git_cache else None
+        self.image_cache = ImageCache(pathlib.Path(args.image_cache)) if args.image_cache else None
+        self.image_cache_size = parse_size(args.image_cache_max_size or ImageCache.DEFAULT_MAX_SIZE)
         path = pathlib.Path(args.build)
         if not path.is_absolute():
             path = pathlib.Path.cwd() / path
@@ -114,6 +591,7 @@ class Builder:
         meta["modules"] = modules
         self._environment_meta = meta
 
+    @trace.traced("generate")
     def generate(self, recipe):
         self.path.mkdir(exist_ok=True, parents=True)
 
@@ -133,12 +611,21 @@ class Builder:
         # Clone spack
         spack = recipe.config["spack"]
         spack_path = self.path / "spack"
-        spack_git_commit = self._git_clone("spack", spack["repo"], spack["commit"], spack_path)
-
         package_repos = recipe.spack_package_repos
         for pkg_repo in package_repos:
             pkg_repo["path"] = self.path / "repos" / pkg_repo["name"]
-            pkg_repo["commit"] = self._git_clone(pkg_repo["name"], pkg_repo["url"], pkg_repo["ref"], pkg_repo["path"])
+
+        # clone spack and all of the package repositories concurrently. Only the
+        # repo_path of a package repository is copied to the store, so the work
+        # tree of its clone is limited to that path with a sparse checkout.
+        with trace.span("git"):
+            commits = self._git_clone_all(
+                [("spack", spack["repo"], spack["commit"], spack_path)]
+                + [(r["name"], r["url"], r["ref"], r["path"], r["repo_path"]) for r in package_repos]
+            )
+        spack_git_commit = commits[0]
+        for pkg_repo, commit in zip(package_repos, commits[1:]):
+            pkg_repo["commit"] = commit
 
         spack_meta = {
             "url": spack["repo"],
@@ -147,27 +634,23 @@ class Builder:
             "packages": package_repos,
         }
 
+        # Every output is first generated in memory, and only written at the end
+        # if its content has changed, so that re-running the configuration on an
+        # existing build path does not invalidate the make targets of the build.
+        outputs = BuildOutputs(self.path / BuildOutputs.MANIFEST, jobs=self.jobs)
+
         # Jinja environment for templates
-        template_path = self.root / "templates"
-        jinja_env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(template_path),
-            trim_blocks=True,
-            lstrip_blocks=True,
-        )
+        jinja_env = render.environment()
 
         # --- Write the unified spack.yaml ---
-        with (env_path / "spack.yaml").open("w") as f:
-            f.write(recipe.spack_yaml)
-            f.write("\n")
+        outputs.add_file(env_path / "spack.yaml", recipe.spack_yaml + "\n")
 
         # Write the spack mirror config artifacts (mirrors.yaml, bootstrap config,
         # and the relocated gpg keys) into the config scope. These were fully
-        # resolved and validated by the recipe, so we just write the bytes. This
-        # must precede the Makefile render, which references the gpg key paths.
+        # resolved and validated by the recipe, so we just write the bytes.
         self._logger.debug(f"Writing the spack mirror configs to '{config_path}'")
         for dest, content in recipe.mirrors.config_files(config_path).items():
-            dest.parent.mkdir(parents=True, exist_ok=True)
-            dest.write_bytes(content)
+            outputs.add_file(dest, content)
 
         # --- Write Makefile ---
         makefile_template = jinja_env.get_template("Makefile")
@@ -179,9 +662,12 @@ class Builder:
             module_types = list(roots.keys())
 
         has_views = any(env_cfg["views"] for env_cfg in recipe.environments.values())
+        add_compilers = any(
+            view["extra"]["add_compilers"] for env_cfg in recipe.environments.values() for view in env_cfg["views"]
+        )
 
-        with (self.path / "Makefile").open("w") as f:
-            f.write(
+        def render_makefile(image_cache=None):
+            return (
                 makefile_template.render(
                     modules=recipe.with_modules,
                     module_types=module_types,
@@ -190,47 +676,73 @@ class Builder:
                     spack_meta=spack_meta,
                     environments=recipe.environments,
                     compiler_names=recipe.compiler_names,
+                    add_compilers=add_compilers,
                     gpg_keys=recipe.mirrors.gpg_key_paths(config_path),
                     buildcache=recipe.build_cache_mirror,
                     buildcache_push=recipe.push_to_build_cache,
+                    buildcache_autopush=recipe.autopush_to_build_cache,
+                    buildcache_unsigned=not recipe.sign_build_cache,
+                    prefetch=recipe.mirrors.prefetch_mirror(config_path),
                     exclude_from_cache=["nvhpc", "cuda", "perl"],
                     has_views=has_views,
                     cleanup=recipe.config["cleanup"],
+                    prune_repos=recipe.config["prune-repos"],
                     system_gcc=recipe.system_gcc,
+                    image_cache=image_cache,
                 )
+                + "\n"
             )
-            f.write("\n")
+
+        makefile = render_makefile()
+        outputs.add_file(self.path / "Makefile", makefile)
+
+        # --- Write the task graph of the build, for stack-build ---
+        outputs.add_file(self.path / pipeline.PIPELINE, json.dumps(pipeline.make_pipeline(makefile), indent=2) + "\n")
 
         # --- Write Make.user ---
         make_user_template = jinja_env.get_template("Make.user")
-        with (self.path / "Make.user").open("w") as f:
-            f.write(
-                make_user_template.render(
-                    build_path=self.path,
-                    store=recipe.mount,
-                    no_bwrap=recipe.no_bwrap,
-                    verbose=False,
-                )
+        outputs.add_file(
+            self.path / "Make.user",
+            make_user_template.render(
+                build_path=self.path,
+                store=recipe.mount,
+                no_bwrap=recipe.no_bwrap,
+                spack_commit=spack_git_commit,
+                verbose=False,
             )
-            f.write("\n")
-
-        # --- Write the sandbox wrapper (binds baked in, self-labelling) ---
-        sandbox_template = jinja_env.get_template("sandbox")
-        sandbox_dst = self.path / "sandbox"
-        with sandbox_dst.open("w") as f:
-            f.write(
-                sandbox_template.render(
+            + "\n",
+        )
+
+        # --- Write the sandbox wrapper (binds baked in, self-labelling) and the sandbox session ---
+        for name in ["sandbox", "sandbox-session"]:
+            outputs.add_file(
+                self.path / name,
+                jinja_env.get_template(name).render(
                     build_path=self.path,
                     store=recipe.mount,
                     no_bwrap=recipe.no_bwrap,
-                )
+                ),
+                executable=True,
             )
-        os.chmod(sandbox_dst, os.stat(sandbox_dst).st_mode | stat.S_IEXEC)
 
         # --- Copy static files from etc/ ---
         etc_path = self.root / "etc"
-        for f_etc in ["Make.inc", "bwrap-mutable-root.sh", "envvars.py", "compiler-config.py"]:
-            shutil.copy2(etc_path / f_etc, self.path / f_etc)
+        for f_etc in [
+            "Make.inc",
+            "bwrap-mutable-root.sh",
+            "envvars.py",
+            "compiler-config.py",
+            "prune-repos.py",
+            "ledger.py",
+            "image-cache.py",
+            "autopush.py",
+            "cache-push.py",
+            "prefetch.py",
+            "fetch-sources.py",
+            "spack-query.py",
+        ]:
+            src = etc_path / f_etc
+            outputs.add_file(self.path / f_etc, src.read_bytes(), executable=os.access(src, os.X_OK))
 
         # --- Install hooks if provided ---
         hook_env = {
@@ -246,29 +758,24 @@ class Builder:
         ]:
             if hook_src is not None:
                 self._logger.debug(f"installing {hook_name} script")
-                jinja_recipe_env = jinja2.Environment(loader=jinja2.FileSystemLoader(recipe.path))
-                hook_template = jinja_recipe_env.get_template(hook_src.name)
-                hook_dst = store_path / f"{hook_name}-hook"
-                with hook_dst.open("w") as f:
-                    f.write(hook_template.render(env=hook_env, verbose=False))
-                    f.write("\n")
-                os.chmod(hook_dst, os.stat(hook_dst).st_mode | stat.S_IEXEC)
+                hook_template = render.hook_environment(recipe.path).get_template(hook_src.name)
+                outputs.add_file(
+                    store_path / f"{hook_name}-hook",
+                    hook_template.render(env=hook_env, verbose=False) + "\n",
+                    executable=True,
+                )
 
         # the packages.yaml configuration that will be used when building all environments
         # - the system packages.yaml with gcc removed
         # - plus additional packages provided by the recipe
-        with (config_path / "packages.yaml").open("w") as f:
-            f.write(yaml.dump(recipe.packages["build"]))
+        outputs.add_file(config_path / "packages.yaml", yaml.dump(recipe.packages["build"], Dumper=schema.Dumper))
 
-        # Merge install_tree into any config.yaml the mirror layer already wrote
-        # (e.g. config:source_cache from mirrors.yaml at lines 167-170 above).
+        # Merge install_tree into any config.yaml the mirror layer already generated
+        # (e.g. config:source_cache from mirrors.yaml).
         config_file = config_path / "config.yaml"
-        config_yaml = {}
-        if config_file.exists():
-            config_yaml = yaml.safe_load(config_file.read_text()) or {}
+        config_yaml = yaml.safe_load(outputs.content(config_file) or b"") or {}
         config_yaml.setdefault("config", {})["install_tree"] = {"root": str(recipe.mount)}
-        with config_file.open("w") as f:
-            f.write(yaml.dump(config_yaml))
+        outputs.add_file(config_file, yaml.dump(config_yaml, Dumper=schema.Dumper))
 
         # Add custom spack package recipes, configured via Spack repos.
         # Build a list of repos with packages to install from system config.
@@ -281,9 +788,8 @@ class Builder:
 
         # look for repos.yaml file in the system configuration
         repo_yaml_path = recipe.system_config_path / "repos.yaml"
-        if repo_yaml_path.exists() and repo_yaml_path.is_file():
-            with repo_yaml_path.open() as fid:
-                raw = yaml.load(fid, Loader=yaml.Loader)
+        raw = recipe.system_yaml("repos.yaml")
+        if raw is not None:
             for rel_path in raw["repos"]:
                 repo_path = (recipe.system_config_path / rel_path).resolve()
                 if spack_util.is_repo(repo_path):
@@ -295,19 +801,18 @@ class Builder:
 
         self._logger.debug(f"full list of system spack package repos: {repos}")
 
-        # Delete the store/repo path, if it already exists.
-        # Do this so that incremental builds (though not officially supported) won't break if a repo is updated.
+        # The store/repo path is regenerated from scratch on every configure:
+        # packages that are no longer provided are removed when the outputs are
+        # written, so that incremental builds (though not officially supported)
+        # won't break if a repo is updated.
         repos_path = store_path / "repos" / "spack_repo"
         repo_dst = repos_path / "alps"
-        if repo_dst.exists():
-            shutil.rmtree(repo_dst)
         pkg_dst = repo_dst / "packages"
-        pkg_dst.mkdir(mode=0o755, parents=True)
+        outputs.add_dir(pkg_dst)
 
         # create the repository step 2: create the repo.yaml file that
         # configures the alps repo
-        with (repo_dst / "repo.yaml").open("w") as f:
-            f.write(_REPO_YAML.format(namespace="alps"))
+        outputs.add_file(repo_dst / "repo.yaml", _REPO_YAML.format(namespace="alps"))
 
         # If the recipe provides a package repo, install it as a separate
         # "recipe" repo in the store with highest precedence.
@@ -315,57 +820,53 @@ class Builder:
         if has_recipe_repo:
             recipe_dst = repos_path / "recipe"
             self._logger.debug(f"creating the recipe spack repo in {recipe_dst}")
-            if recipe_dst.exists():
-                self._logger.debug(f"{recipe_dst} exists ... deleting")
-                shutil.rmtree(recipe_dst)
 
             recipe_pkg_dst = recipe_dst / "packages"
-            recipe_pkg_dst.mkdir(mode=0o755, parents=True)
-
-            with (recipe_dst / "repo.yaml").open("w") as f:
-                f.write(_REPO_YAML.format(namespace="recipe"))
+            outputs.add_dir(recipe_pkg_dst)
+            outputs.add_file(recipe_dst / "repo.yaml", _REPO_YAML.format(namespace="recipe"))
 
             packages_path = recipe.spack_repo / "packages"
             for pkg_path in packages_path.iterdir():
                 dst = recipe_pkg_dst / pkg_path.name
                 if pkg_path.is_dir():
                     self._logger.debug(f"  installing recipe package {pkg_path} to {recipe_pkg_dst}")
-                    install(pkg_path, dst)
+                    outputs.add_tree(pkg_path, dst)
 
         repos_yaml_template = jinja_env.get_template("repos.yaml")
-        with (config_path / "repos.yaml").open("w") as f:
-            repo_path = recipe.mount / "repos" / "spack_repo" / "alps"
-            recipe_repo_path = recipe.mount / "repos" / "spack_repo" / "recipe"
-            package_repos = [
-                {
-                    "name": pkg_repo["name"],
-                    "path": (recipe.mount / "repos" / "spack_repo" / pkg_repo["name"]).as_posix(),
-                }
-                for pkg_repo in spack_meta["packages"]
-            ]
-            f.write(
-                repos_yaml_template.render(
-                    repo_path=repo_path.as_posix(),
-                    package_repos=package_repos,
-                    recipe_repo_path=recipe_repo_path.as_posix(),
-                    has_recipe_repo=has_recipe_repo,
-                    verbose=False,
-                )
+        repo_path = recipe.mount / "repos" / "spack_repo" / "alps"
+        recipe_repo_path = recipe.mount / "repos" / "spack_repo" / "recipe"
+        store_package_repos = [
+            {
+                "name": pkg_repo["name"],
+                "path": (recipe.mount / "repos" / "spack_repo" / pkg_repo["name"]).as_posix(),
+            }
+            for pkg_repo in spack_meta["packages"]
+        ]
+        outputs.add_file(
+            config_path / "repos.yaml",
+            repos_yaml_template.render(
+                repo_path=repo_path.as_posix(),
+                package_repos=store_package_repos,
+                recipe_repo_path=recipe_repo_path.as_posix(),
+                has_recipe_repo=has_recipe_repo,
+                verbose=False,
             )
-            f.write("\n")
+            + "\n",
+        )
 
         # Iterate over the alps and recipe repositories copying their contents
         # to the final repo locations. Because of the order of repos in the
         # repos.yaml config file, recipe packages have precedence.
+        installed_packages = set()
         for repo_src in repos:
             self._logger.debug(f"installing repo {repo_src}")
             packages_path = repo_src / "packages"
             for pkg_path in packages_path.iterdir():
-                dst = pkg_dst / pkg_path.name
-                if pkg_path.is_dir() and not dst.exists():
+                if pkg_path.is_dir() and pkg_path.name not in installed_packages:
                     self._logger.debug(f"  installing package {pkg_path} to {pkg_dst}")
-                    install(pkg_path, dst)
-                elif dst.exists():
+                    outputs.add_tree(pkg_path, pkg_dst / pkg_path.name)
+                    installed_packages.add(pkg_path.name)
+                elif pkg_path.name in installed_packages:
                     self._logger.debug(f"  NOT installing package {pkg_path}")
 
         # Copy all package repos defined in config.yaml to their final repo
@@ -376,119 +877,305 @@ class Builder:
             src_path = clone_path / pkg_repo["repo_path"]
             dst_path = store_path / "repos" / "spack_repo" / name
             self._logger.debug(f"copying repo '{name}' from {src_path} to {dst_path}")
-            if dst_path.exists():
-                self._logger.debug(f"{dst_path} exists ... deleting")
-                shutil.rmtree(dst_path)
-            install(src_path, dst_path)
+            # the clone is private to the build path, so its files can be hard linked
+            outputs.add_tree(src_path, dst_path, link=True)
 
         # --- generate-config subdirectory ---
         generate_config_path = self.path / "generate-config"
-        generate_config_path.mkdir(exist_ok=True)
 
         make_config_template = jinja_env.get_template("Makefile.generate-config")
-        with (generate_config_path / "Makefile").open("w") as f:
-            f.write(
-                make_config_template.render(
-                    modules=recipe.with_modules,
-                    build_path=self.path.as_posix(),
-                    compiler_names=recipe.compiler_names,
-                    system_gcc=recipe.system_gcc,
-                )
+        outputs.add_file(
+            generate_config_path / "Makefile",
+            make_config_template.render(
+                modules=recipe.with_modules,
+                build_path=self.path.as_posix(),
+                compiler_names=recipe.compiler_names,
+                system_gcc=recipe.system_gcc,
             )
-            f.write("\n")
-        with (generate_config_path / "packages.yaml").open("w") as f:
-            f.write(yaml.dump(recipe.packages["install"]))
-        with (generate_config_path / "upstreams.yaml").open("w") as f:
-            yaml.safe_dump(recipe.upstream_config, f, default_flow_style=False, sort_keys=False)
+            + "\n",
+        )
+        outputs.add_file(
+            generate_config_path / "packages.yaml", yaml.dump(recipe.packages["install"], Dumper=schema.Dumper)
+        )
+        outputs.add_file(
+            generate_config_path / "upstreams.yaml",
+            yaml.safe_dump(recipe.upstream_config, default_flow_style=False, sort_keys=False),
+        )
 
         # --- modules ---
         if recipe.with_modules:
             modules_path = self.path / "modules"
-            modules_path.mkdir(exist_ok=True)
-            with (modules_path / "modules.yaml").open("w") as f:
-                yaml.dump(recipe.modules, f)
-            with (modules_path / "packages.yaml").open("w") as f:
-                f.write(yaml.dump(recipe.packages["install"]))
-            with (modules_path / "upstreams.yaml").open("w") as f:
-                yaml.safe_dump(recipe.upstream_config, f, default_flow_style=False, sort_keys=False)
+            outputs.add_file(modules_path / "modules.yaml", yaml.dump(recipe.modules, Dumper=schema.Dumper))
+            outputs.add_file(
+                modules_path / "packages.yaml", yaml.dump(recipe.packages["install"], Dumper=schema.Dumper)
+            )
+            outputs.add_file(
+                modules_path / "upstreams.yaml",
+                yaml.safe_dump(recipe.upstream_config, default_flow_style=False, sort_keys=False),
+            )
 
         # --- metadata ---
         meta_path = store_path / "meta"
-        meta_path.mkdir(exist_ok=True)
-
-        with (meta_path / "configure.json").open("w") as f:
-            f.write(json.dumps(self.configuration_meta, sort_keys=True, indent=2, default=str))
-            f.write("\n")
 
-        with (meta_path / "env.json.in").open("w") as f:
-            f.write(json.dumps(self.environment_meta, sort_keys=True, indent=2, default=str))
-            f.write("\n")
+        outputs.add_file(
+            meta_path / "configure.json",
+            json.dumps(self.configuration_meta, sort_keys=True, indent=2, default=str) + "\n",
+        )
+        outputs.add_file(
+            meta_path / "env.json.in",
+            json.dumps(self.environment_meta, sort_keys=True, indent=2, default=str) + "\n",
+        )
 
-        meta_recipe_path = meta_path / "recipe"
-        if meta_recipe_path.exists():
-            shutil.rmtree(meta_recipe_path)
-        install(recipe.path, meta_recipe_path, ignore=shutil.ignore_patterns(".git"))
+        outputs.add_tree(recipe.path, meta_path / "recipe", ignore=shutil.ignore_patterns(".git"))
 
         meta_extra_path = meta_path / "extra"
-        if meta_extra_path.exists():
-            shutil.rmtree(meta_extra_path)
         if recipe.user_extra is not None:
-            install(recipe.user_extra, meta_extra_path)
+            outputs.add_tree(recipe.user_extra, meta_extra_path)
         else:
-            meta_extra_path.mkdir()
+            outputs.add_dir(meta_extra_path)
 
         # --- debug helper ---
         debug_template = jinja_env.get_template("stack-debug.sh")
-        with (self.path / "stack-debug.sh").open("w") as f:
-            f.write(
-                debug_template.render(
-                    mount_path=recipe.mount,
-                    build_path=str(self.path),
-                    use_bwrap=not recipe.no_bwrap,
+        outputs.add_file(
+            self.path / "stack-debug.sh",
+            debug_template.render(
+                mount_path=recipe.mount,
+                build_path=str(self.path),
+                use_bwrap=not recipe.no_bwrap,
+            )
+            + "\n",
+        )
+
+        # --- image cache ---
+        # The key of the image is a hash of every output, which describe all of the
+        # inputs of the build, apart from the commits of the clones. If the cache
+        # has an image with the same key, the build only restores it.
+        if self.image_cache is not None:
+            with trace.span("image key"):
+                key = outputs.digest(
+                    exclude=(meta_path / "configure.json",),
+                    stackinator=VERSION,
+                    spack=spack_git_commit,
+                    packages=[(r["name"], r["url"], r["commit"]) for r in package_repos],
                 )
+            hit = self.image_cache.lookup(key) is not None
+            if hit:
+                self._logger.info(f"image cache: the image {key} is in the cache, the build restores it")
+            else:
+                self._logger.info(f"image cache: the image {key} is not in the cache, it is added by the build")
+            image_cache = {
+                "root": self.image_cache.root,
+                "key": key,
+                "hit": hit,
+                "max_size": self.image_cache_size,
+                "meta": store_path / "meta",
+            }
+            makefile = render_makefile(image_cache)
+            outputs.add_file(self.path / "Makefile", makefile)
+            outputs.add_file(
+                self.path / pipeline.PIPELINE, json.dumps(pipeline.make_pipeline(makefile), indent=2) + "\n"
             )
-            f.write("\n")
 
-    def _git_clone(self, name, repo, commit, path):
+        # --- fingerprints of the inputs of every step of the build ---
+        # Every step depends on a fingerprint of its recipe in the Makefile and of
+        # the outputs that it reads. A fingerprint is only written when it changes,
+        # so that a change to the recipe only reruns the steps that it affects,
+        # and the steps that depend on them.
+        recipes = _makefile_recipes(outputs.content(self.path / "Makefile").decode())
+        config_files = [config_path / name for name in ("packages.yaml", "config.yaml", "repos.yaml")]
+        mirror_files = list(recipe.mirrors.config_files(config_path))
+        steps = {
+            "spack-query": (
+                "spack-query",
+                [self.path / "spack-query.py", *mirror_files],
+                {"spack": spack_meta["url"], "commit": spack_git_commit},
+            ),
+            "spack-setup": ("spack-setup", [], {"spack": spack_meta["url"], "commit": spack_git_commit}),
+            "pre-install": ("pre-install", [store_path / "pre-install-hook"], {}),
+            "gpg-trust": ("gpg-trust", mirror_files, {}),
+            "mirror-setup": ("mirror-setup", mirror_files, {}),
+            "concretize": (
+                "env/spack.lock",
+                [env_path / "spack.yaml", repos_path, *config_files],
+                {"packages": [(r["name"], r["url"], r["commit"]) for r in package_repos]},
+            ),
+            "prefetch": ("prefetch", [self.path / "prefetch.py"], {}),
+            "fetch-sources": ("fetch-sources", [self.path / "fetch-sources.py"], {}),
+            "cache-push": ("cache-push", [self.path / "cache-push.py"], {}),
+            "cleanup": ("cleanup", [], {}),
+            "install-query": (
+                "install-query",
+                [config_path / "packages.yaml", self.path / "spack-query.py", self.path / "compiler-config.py"],
+                {},
+            ),
+            "generate-config": ("generate-config/.done", [generate_config_path, config_path / "repos.yaml"], {}),
+            "env-meta": ("env-meta", [meta_path / "env.json.in", self.path / "envvars.py"], {}),
+            "post-install": ("post-install", [store_path / "post-install-hook"], {}),
+            # the repos are pruned again when they, or the environment that they are pruned for, change
+            "prune-repos": ("prune-repos", [self.path / "prune-repos.py", store_path / "repos"], {}),
+            # the image contains the recipe and the extra files in the meta data
+            "store.squashfs": ("store.squashfs", [meta_path / "recipe", meta_extra_path], {}),
+        }
+        view_names = [view["name"] for env in recipe.environments.values() for view in env["views"]]
+        for view in view_names:
+            steps[f"view-{view}"] = (f"view-{view}", [self.path / "envvars.py"], {})
+        for module_type in module_types:
+            steps[f"modules-{module_type}"] = (f"modules-{module_type}", [self.path / "modules"], {})
+        digests = {}
+        for name, (target, paths, values) in steps.items():
+            if name == "prune-repos":
+                values = {"concretize": digests["concretize"]}
+            digests[name] = outputs.fingerprint(*paths, recipe=recipes.get(target), **values)
+            outputs.add_file(self.path / "fingerprints" / name, digests[name] + "\n")
+
+        with trace.span("write outputs"):
+            stats = _write_outputs(outputs, self.path, store_path / "repos", digests["prune-repos"])
+        self._logger.info(
+            f"configuration: {stats['written']} outputs written, {stats['unchanged']} unchanged, "
+            f"{stats['removed']} removed"
+        )
+
+    def _git_clone_all(self, repos):
+        """Clone and check out a list of (name, url, commit, path[, sparse]) repositories.
+
+        The repositories are cloned concurrently by a pool of at most self.jobs
+        workers. The log of each repository is buffered and emitted in one block
+        when it finishes, so that the output of different repositories is not
+        interleaved. The first failure cancels the clones that are still running
+        and is raised once every worker has stopped.
+
+        Returns the list of commit hashes, in the same order as repos.
+        """
+
+        cancel = threading.Event()
+        timings = {}
+        start = time.monotonic()
+
+        context = trace.tracer.context()
+
+        def clone(name, url, commit, path, sparse=None):
+            log = _RepoLog(self._logger)
+            t0 = time.monotonic()
+            try:
+                with trace.tracer.attach(context), trace.span(f"git: {name}", url=url, ref=commit):
+                    return self._git_clone(name, url, commit, path, sparse=sparse, log=log, cancel=cancel)
+            finally:
+                timings[name] = time.monotonic() - t0
+                log.flush()
+
+        error = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(self.jobs, len(repos)))) as pool:
+            futures = [pool.submit(clone, *repo) for repo in repos]
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except (_GitCancelled, concurrent.futures.CancelledError):
+                    pass
+                except Exception as err:
+                    if error is None:
+                        error = err
+                        cancel.set()
+                        for f in futures:
+                            f.cancel()
+
+        if error is not None:
+            raise error
+
+        wall = time.monotonic() - start
+        self._logger.info("git: time per repository")
+        width = max(len(name) for name in timings)
+        for name, seconds in sorted(timings.items(), key=lambda item: -item[1]):
+            self._logger.info(f"  {name:<{width}} {seconds:7.1f}s")
+        self._logger.info(f"  {'total':<{width}} {wall:7.1f}s (wall, {min(self.jobs, len(repos))} workers)")
+
+        return [future.result() for future in futures]
+
+    @staticmethod
+    def _run_git(args, log, cancel=None):
+        """Run a git command, terminating it early if cancel is set."""
+
+        command = args[2] if args[0] == "-C" else args[0]
+        with trace.span(f"git {command}", args=" ".join(args)):
+            proc = subprocess.Popen(["git"] + args, shell=False, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            while True:
+                try:
+                    stdout, _ = proc.communicate(timeout=0.2)
+                    break
+                except subprocess.TimeoutExpired:
+                    if cancel is not None and cancel.is_set():
+                        proc.terminate()
+                        proc.communicate()
+                        raise _GitCancelled()
+        log.debug(stdout.decode("utf-8"))
+        return subprocess.CompletedProcess(proc.args, proc.returncode, stdout)
+
+    def _git_clone(self, name, repo, commit, path, sparse=None, log=None, cancel=None):
+        log = log or self._logger
+        if sparse in (None, "", "."):
+            sparse = None
+        if self.git_cache is not None:
+            # the mirror stays locked until the clone has fetched from it
+            with self.git_cache.mirror(repo, commit, lambda args: self._run_git(args, log, cancel)) as mirror:
+                return self._git_checkout(name, repo, commit, path, sparse, log, cancel, source=str(mirror))
+        return self._git_checkout(name, repo, commit, path, sparse, log, cancel)
+
+    def _git_checkout(self, name, repo, commit, path, sparse, log, cancel, source=None):
+        """Clone repo to path and check out commit.
+
+        If source is set, it is a local mirror of repo that the objects are cloned
+        and fetched from, instead of the remote. The objects are copied (or hard
+        linked) rather than borrowed with alternates, so that the clone keeps
+        working if the mirror is pruned.
+
+        If sparse is set, the work tree only contains the sparse directory (and
+        the files at the top level of the repository), and only the blobs that
+        are checked out are fetched.
+        """
+
         if not (path / ".git").is_dir():
-            self._logger.info(f"{name}: clone repository {repo} to {path}")
-            capture = subprocess.run(
-                ["git", "clone", "--filter=tree:0", repo, path],
-                shell=False,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-            )
-            self._logger.debug(capture.stdout.decode("utf-8"))
+            if sparse is not None:
+                # no blobs are fetched until the sparse checkout has been set up
+                flags = ["--no-checkout"] if source else ["--filter=blob:none", "--no-checkout"]
+            else:
+                flags = [] if source else ["--filter=tree:0"]
+            if source is None:
+                log.info(f"{name}: clone repository {repo} to {path}")
+                capture = self._run_git(["clone", *flags, repo, str(path)], log, cancel)
+            else:
+                log.info(f"{name}: clone repository {repo} to {path} from the git cache")
+                capture = self._run_git(["clone", *flags, source, str(path)], log, cancel)
             if capture.returncode != 0:
-                self._logger.error(f"error cloning the repository {repo}")
+                log.error(f"error cloning the repository {repo}")
                 capture.check_returncode()
+            if source is not None:
+                self._run_git(["-C", str(path), "remote", "set-url", "origin", repo], log, cancel).check_returncode()
         else:
-            self._logger.info(f"{name}: {repo} already cloned to {path}")
+            log.info(f"{name}: {repo} already cloned to {path}")
+
+        if sparse is not None:
+            log.info(f"{name}: sparse checkout of {sparse}")
+            capture = self._run_git(["-C", str(path), "sparse-checkout", "set", "--cone", sparse], log, cancel)
+            capture.check_returncode()
+        elif (path / ".git" / "info" / "sparse-checkout").is_file():
+            # a build path that was configured with a sparse checkout previously
+            self._run_git(["-C", str(path), "sparse-checkout", "disable"], log, cancel).check_returncode()
+
+        if sparse is not None and not commit:
+            # populate the work tree, in case the clone was made with --no-checkout
+            self._run_git(["-C", str(path), "checkout", "HEAD"], log, cancel).check_returncode()
 
         if commit:
-            self._logger.info(f"{name}: fetching {commit}")
-            capture = subprocess.run(
-                ["git", "-C", path, "fetch", "origin", commit],
-                shell=False,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-            )
-            self._logger.debug(capture.stdout.decode("utf-8"))
+            log.info(f"{name}: fetching {commit}")
+            capture = self._run_git(["-C", str(path), "fetch", source or "origin", commit], log, cancel)
             if capture.returncode != 0:
                 capture.check_returncode()
 
-            self._logger.info(f"{name}: checking out {commit}")
-            capture = subprocess.run(
-                ["git", "-C", path, "checkout", commit],
-                shell=False,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-            )
-            self._logger.debug(capture.stdout.decode("utf-8"))
+            log.info(f"{name}: checking out {commit}")
+            capture = self._run_git(["-C", str(path), "checkout", commit], log, cancel)
             if capture.returncode != 0:
                 capture.check_returncode()
         else:
-            self._logger.info(f"{name}: no commit set")
+            log.info(f"{name}: no commit set")
 
         git_commit = (
             subprocess.run(
@@ -500,5 +1187,5 @@ class Builder:
             .stdout.strip()
             .decode("utf-8")
         )
-        self._logger.info(f"{name}: commit hash is {git_commit}")
+        log.info(f"{name}: commit hash is {git_commit}")
         return git_commit
@@ -0,0 +1,356 @@
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import os
+import pathlib
+import re
+import shutil
+import sys
+import time
+import urllib.parse
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from . import root_logger, trace
+
+
+class CacheError(RuntimeError):
+    """Exception class for errors thrown by the persistent caches."""
+
+
+@contextlib.contextmanager
+def file_lock(path: pathlib.Path, shared: bool = False, blocking: bool = True) -> Iterator[Optional[int]]:
+    """Hold an flock on path (created if needed) for the duration of the context.
+
+    Yields the file descriptor of the lock, or None if blocking is False and the
+    lock is held by another process.
+    """
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, flags)
+        except BlockingIOError:
+            yield None
+            return
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def parse_size(text: str) -> int:
+    """Parse a size like 500M, 20G or 1.5T (powers of 1024) into a number of bytes."""
+
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*", text, re.IGNORECASE)
+    if match is None:
+        raise CacheError(f"invalid size '{text}': use a number with an optional K, M, G or T suffix")
+    exponent = " KMGT".index(match.group(2).upper() or " ")
+    return int(float(match.group(1)) * 1024**exponent)
+
+
+def format_size(size: int) -> str:
+    for unit in ("B", "K", "M", "G"):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}T"
+
+
+def user_cache_dir() -> pathlib.Path:
+    """The directory for the caches of the current user.
+
+    $STACKINATOR_CACHE_DIR if it is set, otherwise $XDG_CACHE_HOME/stackinator,
+    which defaults to ~/.cache/stackinator.
+    """
+
+    if os.environ.get("STACKINATOR_CACHE_DIR"):
+        return pathlib.Path(os.environ["STACKINATOR_CACHE_DIR"])
+    xdg = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return pathlib.Path(xdg) / "stackinator"
+
+
+def private_dir(path: pathlib.Path) -> bool:
+    """Create the directory path if it does not exist, and check that only the user can write to it.
+
+    The caches in the user cache dir are loaded without being checked again, so
+    they must not be used if other users can modify them.
+    """
+
+    try:
+        path.mkdir(mode=0o700, parents=True, exist_ok=True)
+        st = path.stat()
+    except OSError as err:
+        root_logger.debug(f"the cache {path} can't be used: {err}")
+        return False
+    if st.st_uid != os.getuid() or st.st_mode & 0o022:
+        root_logger.warning(f"the cache {path} is not used, because other users can write to it")
+        return False
+    return True
+
+
+def tree_size(path: pathlib.Path) -> int:
+    """The total size in bytes of the files in a directory tree."""
+
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+            except FileNotFoundError:
+                pass
+    return total
+
+
+class _LruCache:
+    """A directory of cache entries that are deleted least recently used first.
+
+    Every entry has a lock file next to it, with the suffix .lock: it is held
+    shared while the entry is used and exclusively while it is modified, and
+    its mtime records when the entry was last used.
+    """
+
+    # the name of the cache in messages, and the glob pattern of its entries
+    label = "cache"
+    pattern = "*"
+
+    def __init__(self, root: pathlib.Path):
+        self._logger = root_logger
+        self.root = pathlib.Path(root).expanduser().absolute()
+
+    @staticmethod
+    def _lock_path(entry: pathlib.Path) -> pathlib.Path:
+        return entry.with_suffix(".lock")
+
+    def entries(self) -> List[Tuple[pathlib.Path, float, int]]:
+        """All entries in the cache as (path, last used time, size), oldest first."""
+
+        result = []
+        if not self.root.is_dir():
+            return result
+        for entry in self.root.glob(self.pattern):
+            lock = self._lock_path(entry)
+            last_used = lock.stat().st_mtime if lock.exists() else entry.stat().st_mtime
+            result.append((entry, last_used, tree_size(entry)))
+        return sorted(result, key=lambda entry: entry[1])
+
+    def prune(self, max_size: int) -> List[pathlib.Path]:
+        """Delete the least recently used entries until the cache is at most max_size bytes.
+
+        Entries that are locked by a running process are skipped. Returns the
+        list of deleted entries.
+        """
+
+        entries = self.entries()
+        total = sum(size for _, _, size in entries)
+        removed = []
+        for entry, _, size in entries:
+            if total <= max_size:
+                break
+            with file_lock(self._lock_path(entry), blocking=False) as fd:
+                if fd is None:
+                    self._logger.info(f"{self.label}: {entry} is in use, not pruning it")
+                    continue
+                self._logger.info(f"{self.label}: removing {entry} ({format_size(size)})")
+                shutil.rmtree(entry)
+            self._lock_path(entry).unlink(missing_ok=True)
+            total -= size
+            removed.append(entry)
+        return removed
+
+
+class GitCache(_LruCache):
+    """A persistent cache of bare git mirrors, shared by many build paths.
+
+    There is one mirror for every repository url, in a directory named after a
+    hash of the url. Build paths are cloned from the mirror instead of the
+    remote, so that only the objects that the mirror is missing are fetched over
+    the network, and the objects themselves are hard linked into the clone when
+    the cache and the build path are on the same file system.
+
+    Every mirror has a lock file next to it: it is held exclusively while the
+    mirror is updated, and shared while a build path is cloned from it, so that
+    concurrent stack-config runs can share the cache and prune() never deletes
+    a mirror that is in use. The mtime of the lock file records when the mirror
+    was last used.
+
+    If refresh is False, a mirror that already contains the requested ref is not
+    fetched again, even if the ref is a branch or a tag: this is used when the
+    mirrors were updated just before, e.g. by stack-config batch.
+    """
+
+    label = "git cache"
+    pattern = "*.git"
+
+    def __init__(self, root: pathlib.Path, refresh: bool = True):
+        super().__init__(root)
+        self.refresh = refresh
+
+    def mirror_path(self, url: str) -> pathlib.Path:
+        name = pathlib.PurePosixPath(urllib.parse.urlparse(url).path).name.removesuffix(".git") or "repo"
+        digest = hashlib.sha256(url.encode()).hexdigest()[:16]
+        return self.root / f"{name}-{digest}.git"
+
+    @contextlib.contextmanager
+    def mirror(self, url: str, ref: Optional[str], run: Callable) -> Iterator[pathlib.Path]:
+        """Update the mirror of url so that it contains ref, and yield its path.
+
+        run(args) runs a git command and returns a subprocess.CompletedProcess.
+        The mirror is locked while the context is active, so it is safe to clone
+        from it inside the context.
+        """
+
+        mirror = self.mirror_path(url)
+        lock = self._lock_path(mirror)
+        with file_lock(lock) as fd:
+            with trace.span("update mirror", url=url):
+                self._update(mirror, url, ref, run)
+            os.utime(lock)
+            # downgrade to a shared lock, so that other runs can clone concurrently
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            yield mirror
+
+    def _update(self, mirror: pathlib.Path, url: str, ref: Optional[str], run: Callable):
+        """Create or update the mirror of url, which is locked by the caller."""
+
+        if not (mirror / "HEAD").is_file():
+            self._logger.info(f"git cache: creating mirror of {url} in {mirror}")
+            tmp = mirror.with_name(f"{mirror.name}.tmp")
+            if tmp.exists():
+                shutil.rmtree(tmp)
+            capture = run(["clone", "--bare", url, str(tmp)])
+            if capture.returncode != 0:
+                self._logger.error(f"error creating a mirror of the repository {url}")
+                capture.check_returncode()
+            # only branches and tags are mirrored: a refs/* refspec would also
+            # fetch pull request refs, and prune the commits pinned below.
+            run(["-C", str(tmp), "config", "remote.origin.fetch", "+refs/heads/*:refs/heads/*"]).check_returncode()
+            os.replace(tmp, mirror)
+        elif self._needs_update(mirror, ref, run):
+            self._logger.info(f"git cache: updating mirror of {url}")
+            capture = run(["-C", str(mirror), "fetch", "--prune", "--tags", "origin"])
+            capture.check_returncode()
+
+        # a commit that is not on any branch or tag is fetched explicitly, and
+        # pinned with a ref so that it is not garbage collected.
+        if ref is not None and not self._has_commit(mirror, ref, run):
+            capture = run(["-C", str(mirror), "fetch", "origin", f"+{ref}:refs/stackinator/{ref}"])
+            capture.check_returncode()
+
+    def _needs_update(self, mirror: pathlib.Path, ref: Optional[str], run: Callable) -> bool:
+        if not self._has_commit(mirror, ref or "HEAD", run):
+            return True
+        # branches and tags can move, so the mirror is always updated for them:
+        # only a full commit hash that is already present is final.
+        return self.refresh and (ref is None or not re.fullmatch(r"[0-9a-f]{40}", ref))
+
+    @staticmethod
+    def _has_commit(mirror: pathlib.Path, ref: str, run: Callable) -> bool:
+        return run(["-C", str(mirror), "cat-file", "-e", f"{ref}^{{commit}}"]).returncode == 0
+
+
+class ImageCache(_LruCache):
+    """A persistent cache of the images built in build paths, by the key of their inputs.
+
+    The key is a hash of everything that stack-config generates in the build
+    path, and of the commits of spack and the package repositories (see
+    BuildOutputs.digest), so a build with the same key produces the same image.
+    Every entry is a directory KEY.image with store.squashfs, the meta directory
+    of the store and image.json.
+
+    Entries are added at the end of a build, and restored instead of building
+    the image, by the image-cache.py script in the build path.
+    """
+
+    label = "image cache"
+    pattern = "*.image"
+
+    # the default maximum size of the cache, which is pruned when an image is added
+    DEFAULT_MAX_SIZE = "100G"
+
+    def entry_path(self, key: str) -> pathlib.Path:
+        return self.root / f"{key}.image"
+
+    def lookup(self, key: str) -> Optional[pathlib.Path]:
+        """The entry of key if it is in the cache, which is marked as used."""
+
+        entry = self.entry_path(key)
+        # image.json is written last, before the entry is moved into place
+        if not (entry / "image.json").is_file():
+            return None
+        with file_lock(self._lock_path(entry), shared=True):
+            os.utime(self._lock_path(entry))
+        return entry
+
+
+def default_git_cache() -> Optional[str]:
+    """The git cache path set in the environment, if any."""
+
+    return os.environ.get("STACKINATOR_GIT_CACHE") or None
+
+
+def default_image_cache() -> Optional[str]:
+    """The image cache path set in the environment, if any."""
+
+    return os.environ.get("STACKINATOR_IMAGE_CACHE") or None
+
+
+def make_argparser():
+    parser = argparse.ArgumentParser(description="Inspect and prune the persistent caches used by stack-config.")
+    parser.add_argument(
+        "--git-cache",
+        default=default_git_cache(),
+        type=str,
+        help="Path of the git cache (default: $STACKINATOR_GIT_CACHE).",
+    )
+    parser.add_argument(
+        "--image-cache",
+        default=default_image_cache(),
+        type=str,
+        help="Path of the image cache (default: $STACKINATOR_IMAGE_CACHE).",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="list the contents of the caches")
+    prune_parser = subparsers.add_parser("prune", help="delete the least recently used entries of the caches")
+    prune_parser.add_argument("--max-size", required=True, type=str, help="Maximum size of each cache, e.g. 500M, 20G.")
+    return parser
+
+
+def main():
+    import logging
+
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(logging.StreamHandler(stream=sys.stdout))
+
+    args = make_argparser().parse_args()
+    caches = []
+    if args.git_cache is not None:
+        caches.append(GitCache(pathlib.Path(args.git_cache)))
+    if args.image_cache is not None:
+        caches.append(ImageCache(pathlib.Path(args.image_cache)))
+    if not caches:
+        print("error: no cache was given, set --git-cache or --image-cache")
+        return 1
+
+    try:
+        for cache in caches:
+            if args.command == "list":
+                now = time.time()
+                entries = cache.entries()
+                print(f"{cache.label}: {cache.root}")
+                for entry, last_used, size in entries:
+                    print(f"{format_size(size):>8}  {(now - last_used) / 86400:6.1f} days  {entry.name}")
+                print(f"{format_size(sum(size for _, _, size in entries)):>8}  total")
+            elif args.command == "prune":
+                cache.prune(parse_size(args.max_size))
+    except CacheError as err:
+        print(f"error: {err}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
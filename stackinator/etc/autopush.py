@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Run spack install, and push the packages to the build cache while they are
+being installed. Intended to be run in the build sandbox as:
+
+    autopush.py --spack SPACK --env ENV_ROOT --mirror NAME --database STORE/.spack-db/index.json \\
+        [--exclude nvhpc,cuda,perl] [--interval SECONDS] [--gpg-log FILE] [--unsigned] -- SPACK -e ENV_ROOT install ...
+
+The spack database of the store is read every --interval seconds, and the
+packages that were built since the last pass are pushed to the mirror in
+one `spack buildcache create` call. The packages that were installed before
+the install started, and those that were installed from a build cache, are
+never pushed. The packages in --exclude, and those with
+a git version, are never pushed, like in the cache-push target of the Makefile.
+With --unsigned, the packages are pushed without being signed, to a build cache
+that is not signed.
+A last pass is made once the install has finished, whether or not it
+succeeded, so that everything that was built is in the cache.
+
+Returns the exit code of the install: a failure to push is only reported,
+because cache-push pushes the packages that are still missing after the install.
+"""
+
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+
+def installed_packages(database, since=None):
+    """(hash, name, version) of every package built in the store, from the spack database.
+
+    The database is replaced atomically by spack when it is written, so it can
+    be read while spack install is running. Externals are skipped, because they
+    are never pushed, and so are the packages installed before since, and those
+    installed from a build cache, which spack marks with .spack/binary_distribution
+    in their prefix.
+    """
+    try:
+        with open(database) as fid:
+            installs = json.load(fid).get("database", {}).get("installs", {})
+    except (FileNotFoundError, json.JSONDecodeError):
+        return []
+    packages = []
+    for dag_hash, record in installs.items():
+        spec = record.get("spec", {})
+        # older databases nest the spec under the package name
+        if "name" not in spec and len(spec) == 1:
+            spec = next(iter(spec.values()))
+        if not record.get("installed") or "external" in spec:
+            continue
+        if since is not None and record.get("installation_time", since) < since:
+            continue
+        if record.get("path") and os.path.exists(os.path.join(record["path"], ".spack", "binary_distribution")):
+            continue
+        packages.append((dag_hash, spec.get("name", ""), str(spec.get("version", ""))))
+    return packages
+
+
+def pushable(name, version, exclude):
+    """Whether a package may be pushed to the build cache."""
+    return name not in exclude and not version.startswith("git.")
+
+
+class Pusher:
+    def __init__(self, args):
+        self.spack = shlex.split(args.spack)
+        self.env = args.env
+        self.mirror = args.mirror
+        self.database = args.database
+        self.exclude = set(filter(None, args.exclude.split(",")))
+        self.gpg_log = args.gpg_log
+        self.unsigned = args.unsigned
+        # the packages installed before the install started are not pushed
+        self.start = time.time()
+        # every package that was pushed, or that failed to push
+        self.done = set()
+        self.pushed = 0
+
+    def pending(self):
+        return [
+            dag_hash
+            for dag_hash, name, version in installed_packages(self.database, since=self.start)
+            if dag_hash not in self.done and pushable(name, version, self.exclude)
+        ]
+
+    def push(self):
+        """Push the packages that were installed since the last call."""
+        hashes = self.pending()
+        if not hashes:
+            return
+        print(f"==> autopush: pushing {len(hashes)} packages to {self.mirror}", flush=True)
+        command = [*self.spack, "-e", self.env, "buildcache", "create", "--only=package"]
+        command += ["--unsigned"] if self.unsigned else []
+        command += [self.mirror]
+        result = subprocess.run(
+            command + [f"/{dag_hash}" for dag_hash in hashes],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+        # the gpg output is kept out of the build log, like in cache-push
+        gpg = []
+        for line in result.stdout.splitlines():
+            if line.startswith("gpg:"):
+                gpg.append(line)
+            elif not line.startswith("==> Fetching"):
+                print(f"==> autopush: {line}", flush=True)
+        if gpg and self.gpg_log:
+            with open(self.gpg_log, "a") as fid:
+                fid.write("\n".join(gpg) + "\n")
+        if result.returncode != 0:
+            print(f"==> autopush: warning: pushing to {self.mirror} failed, cache-push will try again", flush=True)
+        else:
+            self.pushed += len(hashes)
+        # failed packages are not retried here, so that a package that can't be
+        # pushed is not pushed again on every pass
+        self.done.update(hashes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run spack install, and push packages as soon as they are installed.")
+    parser.add_argument("--spack", default="spack", help="the spack command")
+    parser.add_argument("--env", required=True, help="the spack environment")
+    parser.add_argument("--mirror", required=True, help="the build cache mirror to push to")
+    parser.add_argument("--database", required=True, help="the index.json of the spack database of the store")
+    parser.add_argument("--exclude", default="", help="comma separated names of packages that are not pushed")
+    parser.add_argument("--interval", type=float, default=60, help="seconds between pushes")
+    parser.add_argument("--gpg-log", help="file that the gpg output of the pushes is appended to")
+    parser.add_argument("--unsigned", action="store_true", help="push the packages without signing them")
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="the install command, after --")
+    args = parser.parse_args()
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    if not command:
+        parser.error("no install command was given")
+
+    pusher = Pusher(args)
+    stop = threading.Event()
+
+    def push_periodically():
+        while not stop.wait(args.interval):
+            pusher.push()
+
+    start = time.time()
+    install = subprocess.Popen(command)
+    thread = threading.Thread(target=push_periodically, daemon=True)
+    thread.start()
+    try:
+        returncode = install.wait()
+    except KeyboardInterrupt:
+        install.wait()
+        raise
+    finally:
+        stop.set()
+        thread.join()
+
+    # the packages that were installed since the last pass
+    pusher.push()
+    print(f"==> autopush: pushed {pusher.pushed} packages to {pusher.mirror} in {time.time() - start:.0f}s", flush=True)
+    return returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,5 +7,5 @@ for d in /*; do
         args+=("--dev-bind" "$d" "$d")
     fi
 done
-PS1="\[\e[36;1m\]build-env >>> \[\e[0m\]" bwrap "${args[@]}" "$@"
+PS1="\[\e[36;1m\]build-env >>> \[\e[0m\]" exec bwrap "${args[@]}" "$@"
 
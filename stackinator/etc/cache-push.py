@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Push the packages of a spack environment that are missing from a build cache.
+Intended to be run as:
+
+    spack -e ENV_ROOT python cache-push.py [--exclude nvhpc,cuda,perl] [--jobs N] [--all] [--unsigned] \\
+        [--spack SPACK] MIRROR
+
+The packages that are already in the build cache are looked up in the local
+copy of its index, that spack keeps in its misc cache and downloads again only
+when the index of the mirror has changed, instead of checking every package
+against the mirror. The packages in --exclude, those with a git version and
+externals are never pushed. The missing packages are pushed by one call to
+`spack buildcache create`, which uploads --jobs packages concurrently.
+
+With --all, the index is not read and every package is pushed. With --unsigned,
+the packages are pushed without being signed.
+"""
+
+import argparse
+import shlex
+import subprocess
+import sys
+import time
+
+
+def pushable(spec, exclude):
+    """Whether a package may be pushed to the build cache."""
+    return spec.name not in exclude and not str(spec.version).startswith("git.")
+
+
+def select_missing(specs, cached, exclude):
+    """The specs to push, and the number that were excluded and already cached.
+
+    specs are the installed specs of the environment, and cached is the set of
+    the hashes in the build cache. The specs are returned sorted by name.
+    """
+    missing = {}
+    excluded = in_cache = 0
+    for spec in specs:
+        dag_hash = spec.dag_hash()
+        if dag_hash in missing:
+            continue
+        if not pushable(spec, exclude):
+            excluded += 1
+        elif dag_hash in cached:
+            in_cache += 1
+        else:
+            missing[dag_hash] = spec
+    return sorted(missing.values(), key=lambda spec: spec.name), excluded, in_cache
+
+
+def installed_specs():
+    """The installed specs of the active environment, with their dependencies, except externals."""
+    import spack.environment
+    import spack.store
+
+    env = spack.environment.active_environment()
+    if env is None:
+        raise RuntimeError("cache-push.py must be run in a spack environment: spack -e ENV_ROOT python cache-push.py")
+    with spack.store.STORE.db.read_transaction():
+        return [spec for spec in env.all_specs() if not spec.external and spec.installed]
+
+
+def _normalize_url(url):
+    # the index records the url of the mirror, or a description of it with a url
+    return str(getattr(url, "url", url)).rstrip("/")
+
+
+def cached_hashes(mirror_name, hashes):
+    """The subset of hashes that are in the index of the build cache mirror_name."""
+    import spack.binary_distribution
+    import spack.mirrors.mirror
+
+    mirror = spack.mirrors.mirror.MirrorCollection(binary=True).get(mirror_name)
+    if mirror is None:
+        raise RuntimeError(f"there is no build cache mirror named {mirror_name}")
+    url = _normalize_url(mirror.fetch_url)
+
+    index = spack.binary_distribution.BINARY_INDEX
+    try:
+        # only downloads the index of the mirror if its hash has changed
+        index.update()
+    except spack.binary_distribution.FetchCacheError as err:
+        # spack checks every package against the mirror itself instead
+        print(f"cache-push: warning: the index of {mirror_name} could not be read, pushing every package: {err}")
+        return set()
+    return {
+        dag_hash
+        for dag_hash in hashes
+        if any(_normalize_url(entry["mirror_url"]) == url for entry in index.find_by_hash(dag_hash))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Push the packages that are missing from a build cache.")
+    parser.add_argument("mirror", help="the name of the build cache mirror")
+    parser.add_argument("--spack", default="spack", help="the spack command used to push")
+    parser.add_argument("--exclude", default="", help="comma separated names of packages that are not pushed")
+    parser.add_argument("--jobs", type=int, default=16, help="the number of concurrent uploads")
+    parser.add_argument("--all", action="store_true", help="push every package, without reading the index")
+    parser.add_argument("--unsigned", action="store_true", help="push the packages without signing them")
+    args = parser.parse_args()
+    exclude = set(filter(None, args.exclude.split(",")))
+
+    import spack.environment
+
+    start = time.time()
+    specs = installed_specs()
+    cached = set()
+    if not args.all:
+        cached = cached_hashes(args.mirror, {spec.dag_hash() for spec in specs})
+    missing, excluded, in_cache = select_missing(specs, cached, exclude)
+    print(
+        f"cache-push: {len(specs)} packages installed, {in_cache} in the build cache, {excluded} excluded, "
+        f"{len(missing)} to push ({time.time() - start:.1f}s)",
+        flush=True,
+    )
+    # never call buildcache create without specs: it would push the whole environment
+    if not missing:
+        return 0
+
+    command = [*shlex.split(args.spack), "-e", spack.environment.active_environment().path]
+    command += ["buildcache", "create", "--only=package", "--jobs", str(args.jobs)]
+    command += ["--unsigned"] if args.unsigned else []
+    command += [args.mirror]
+    command += [f"/{spec.dag_hash()}" for spec in missing]
+    result = subprocess.run(command)
+    if result.returncode == 0:
+        print(f"cache-push: pushed {len(missing)} packages in {time.time() - start:.1f}s", flush=True)
+    return result.returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -110,29 +110,23 @@ def load_system_compiler_externals(system_packages_path):
     return packages
 
 
-def main():
-    parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("output", help="Path to packages.yaml to create or update")
-    parser.add_argument("compilers", nargs="*", help="Compiler package names to query")
-    parser.add_argument(
-        "--system-packages",
-        help="Path to a packages.yaml to read system compiler externals from",
-        default=None,
-    )
-    args = parser.parse_args()
-
+def write_compiler_config(output, compiler_names, system_packages=None):
+    """
+    Write the compilers installed in the store, and the system compilers in the
+    system_packages packages.yaml, to the packages.yaml output.
+    """
     # Load existing content if the file already exists (merge mode).
     existing = {}
-    if os.path.isfile(args.output):
-        with open(args.output) as fid:
+    if os.path.isfile(output):
+        with open(output) as fid:
             existing = yaml.safe_load(fid) or {}
 
-    compiler_packages = build_compiler_packages(args.compilers)
+    compiler_packages = build_compiler_packages(compiler_names)
 
     # Pull in any system compiler externals (e.g. system gcc) that carry
     # extra_attributes.compilers but are not in the spack store.
-    if args.system_packages and os.path.isfile(args.system_packages):
-        system_externals = load_system_compiler_externals(args.system_packages)
+    if system_packages and os.path.isfile(system_packages):
+        system_externals = load_system_compiler_externals(system_packages)
         for pkg_name, pkg_data in system_externals.items():
             if pkg_name not in compiler_packages:
                 compiler_packages[pkg_name] = pkg_data
@@ -141,10 +135,25 @@ def main():
     merged = existing.copy()
     merged.setdefault("packages", {}).update(compiler_packages)
 
-    with open(args.output, "w") as fid:
+    with open(output, "w") as fid:
         yaml.dump(merged, fid, default_flow_style=False)
 
-    print(f"  compiler-config: wrote {args.output}", file=sys.stderr)
+    print(f"  compiler-config: wrote {output}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("output", help="Path to packages.yaml to create or update")
+    parser.add_argument("compilers", nargs="*", help="Compiler package names to query")
+    parser.add_argument(
+        "--system-packages",
+        help="Path to a packages.yaml to read system compiler externals from",
+        default=None,
+    )
+    args = parser.parse_args()
+    write_compiler_config(args.output, args.compilers, args.system_packages)
 
 
-main()
+# spack-query.py loads this script to generate the compiler config in its own process
+if __name__ == "__main__":
+    main()
@@ -53,6 +53,16 @@ def is_env_value_list(v):
     return isinstance(v, list) and all(isinstance(item, str) for item in v)
 
 
+# the paths that are not in seen, without repeats, which are added to seen
+def _unique(paths: List[str], seen: set) -> List[str]:
+    unique = []
+    for p in paths:
+        if p not in seen:
+            seen.add(p)
+            unique.append(p)
+    return unique
+
+
 class ListEnvVarUpdate:
     def __init__(self, value: List[str], op: EnvVarOp):
         # clean up paths as they are inserted
@@ -122,6 +132,50 @@ class ListEnvVar(EnvVar):
             paths += u.value
         return paths
 
+    # Replace the updates with the fewest updates that give the same value, for any
+    # current value and dirty flag. A path that is added more than once is only kept
+    # where it takes precedence, i.e. the first time that it occurs in the value.
+    def compact(self):
+        # the paths that the updates add before and after the value that they start
+        # from, which is replaced by the last set.
+        prepends, appends = [], []
+        last_set = None
+        for i, u in enumerate(self._updates):
+            if u.op == EnvVarOp.SET:
+                prepends, appends, last_set = [u.value], [], i
+            elif u.op == EnvVarOp.PREPEND:
+                prepends.append(u.value)
+            else:
+                appends.append(u.value)
+
+        seen = set()
+        before = _unique([p for value in reversed(prepends) for p in value], seen)
+        after = _unique([p for value in appends for p in value], seen)
+
+        if last_set is None:
+            updates = [(before, EnvVarOp.PREPEND), (after, EnvVarOp.APPEND)]
+            updates = [(value, op) for value, op in updates if value]
+            # the updates set a variable that is not set, even if they add no paths
+            if not updates and self._updates:
+                updates = [([], EnvVarOp.PREPEND)]
+        elif last_set == 0:
+            # dirty applies a first set as a prepend, which leaves the current value
+            # between the paths added before it and those appended after it.
+            updates = [(before, EnvVarOp.SET)]
+            if after:
+                updates.append((after, EnvVarOp.APPEND))
+        else:
+            # a later set replaces the current value even if dirty, which only applies
+            # to the first update, so the set must not become the first update.
+            updates = [([], EnvVarOp.PREPEND), (before + after, EnvVarOp.SET)]
+
+        self._updates = [ListEnvVarUpdate(value, op) for value, op in updates]
+
+    # the value of the variable in an environment where it is not set
+    @property
+    def clean_value(self):
+        return self.get_value(None)
+
     # Given the current value, return the value that should be set
     # current is None implies that the variable is not set
     #
@@ -276,6 +330,18 @@ class EnvVarSet:
 
         return env
 
+    # the inverse of as_dict
+    @classmethod
+    def from_dict(cls, values: dict):
+        ops = {str(op): op for op in EnvVarOp}
+        env = EnvVarSet()
+        for name, updates in values["list"].items():
+            for u in updates:
+                env.set_list(name, u["value"], ops[u["op"]])
+        for name, value in values["scalar"].items():
+            env.set_scalar(name, value)
+        return env
+
     @property
     def lists(self):
         return self._lists
@@ -296,6 +362,19 @@ class EnvVarSet:
         for name in self._lists:
             self._lists[name].remove_root(root)
 
+    def compact(self):
+        for name in self._lists:
+            self._lists[name].compact()
+
+    # the values of the list variables in an environment where none of them are set
+    def clean_values(self) -> dict:
+        values = {}
+        for name, var in self._lists.items():
+            value = var.clean_value
+            if value is not None:
+                values[name] = value
+        return values
+
     def set_scalar(self, name: str, value: str):
         self._scalars[name] = ScalarEnvVar(name, value)
 
@@ -424,16 +503,45 @@ class EnvVarSet:
         self._generate_post = value
 
 
+# any prefix_paths that match entries in _IGNORE_PREFIX_PATHS will be dropped.
+# e.g. /user/bin is in PATH in activate.sh scripts because it is in
+# the environment used to build the uenv - but we want to avoid it so that
+# it does not shadow PATH values set when more than 1 uenv is mounted.
+_IGNORE_PREFIX_PATHS = {"PATH": ("/usr/bin", "/usr/local/bin", "/bin")}
+
+
+def _set_variable(env: EnvVarSet, name: str, rhs: str):
+    """Add the value rhs of the variable name, set by the activation of a view, to env."""
+
+    # ignore SPACK environment variables: setting these will interfere with downstream
+    # user spack configuration.
+    if name.startswith("SPACK_"):
+        return
+
+    if name in list_variables:
+        fields = [f for f in rhs.split(":") if len(f.strip()) > 0]
+
+        # filter prefixes
+        ignored_fields = _IGNORE_PREFIX_PATHS.get(name, ())
+        fields = [f for f in fields if f not in ignored_fields]
+
+        # look for $name as one of the fields (only works for append or prepend)
+        if len(fields) == 0:
+            env.set_list(name, fields, EnvVarOp.SET)
+        elif fields[0] == f"${name}":
+            env.set_list(name, fields[1:], EnvVarOp.APPEND)
+        elif fields[-1] == f"${name}":
+            env.set_list(name, fields[:-1], EnvVarOp.PREPEND)
+        else:
+            env.set_list(name, fields, EnvVarOp.SET)
+    else:
+        env.set_scalar(name, rhs)
+
+
 def read_activation_script(filename: str, env: Optional[EnvVarSet] = None) -> EnvVarSet:
     if env is None:
         env = EnvVarSet()
 
-    # any prefix_paths that match entries in _IGNORE_PREFIX_PATHS will be dropped.
-    # e.g. /user/bin is in PATH in activate.sh scripts because it is in
-    # the environment used to build the uenv - but we want to avoid it so that
-    # it does not shadow PATH values set when more than 1 uenv is mounted.
-    _IGNORE_PREFIX_PATHS = {"PATH": ("/usr/bin", "/usr/local/bin", "/bin")}
-
     with open(filename) as fid:
         for line in fid:
             ls = line.strip().rstrip(";")
@@ -449,38 +557,47 @@ def read_activation_script(filename: str, env: Optional[EnvVarSet] = None) -> En
             # handle lines of the form 'export Y'
             if len(fields) > 1 and fields[0] == "export":
                 fields = fields[1].split("=", maxsplit=1)
-                # get the name of the environment variable
-                name = fields[0]
-
-                # ignore SPACK environment variables: setting these will interfere with downstream
-                # user spack configuration.
-                if name.startswith("SPACK_"):
-                    continue
 
                 # if there was only one field, there was no = sign, so pass
                 if len(fields) < 2:
                     continue
 
                 # rhs the value that is assigned to the environment variable
-                rhs = fields[1].lstrip("'").rstrip("'")
-                if name in list_variables:
-                    fields = [f for f in rhs.split(":") if len(f.strip()) > 0]
-
-                    # filter prefixes
-                    ignored_fields = _IGNORE_PREFIX_PATHS.get(name, ())
-                    fields = [f for f in fields if f not in ignored_fields]
-
-                    # look for $name as one of the fields (only works for append or prepend)
-                    if len(fields) == 0:
-                        env.set_list(name, fields, EnvVarOp.SET)
-                    elif fields[0] == f"${name}":
-                        env.set_list(name, fields[1:], EnvVarOp.APPEND)
-                    elif fields[-1] == f"${name}":
-                        env.set_list(name, fields[:-1], EnvVarOp.PREPEND)
-                    else:
-                        env.set_list(name, fields, EnvVarOp.SET)
-                else:
-                    env.set_scalar(name, rhs)
+                _set_variable(env, fields[0], fields[1].lstrip("'").rstrip("'"))
+
+    return env
+
+
+def read_environment(filename: str, env: Optional[EnvVarSet] = None) -> EnvVarSet:
+    """
+    Read the modifications that the activation of a view makes, written by
+    spack-query.py --activate, instead of parsing its activate.sh. Every
+    modification is one update: a prepend or append of a path, or a set or
+    unset, of a list variable if the name is one, and of a scalar otherwise.
+    """
+    if env is None:
+        env = EnvVarSet()
+
+    with open(filename) as fid:
+        data = json.load(fid)
+    if data.get("version") != 2:
+        raise EnvVarError(f"{filename} has version {data.get('version')} instead of 2: run make install-query again")
+
+    ops = {"set": EnvVarOp.SET, "unset": EnvVarOp.SET, "prepend": EnvVarOp.PREPEND, "append": EnvVarOp.APPEND}
+    for modification in data["modifications"]:
+        op, name, value = modification["op"], modification["name"], modification["value"]
+        # as in read_activation_script, the SPACK_ variables are not set by the view
+        if name.startswith("SPACK_"):
+            continue
+        if op not in ops:
+            raise EnvVarError(f"unknown modification '{op}' of {name} in {filename}")
+
+        if op in ("prepend", "append") or name in list_variables:
+            ignored = _IGNORE_PREFIX_PATHS.get(name, ())
+            paths = [p for p in (value or "").split(":") if p.strip() and p not in ignored]
+            env.set_list(name, paths, ops[op])
+        else:
+            env.set_scalar(name, value)
 
     return env
 
@@ -492,7 +609,11 @@ def view_impl(args):
 
     root_path = args.root
     activate_path = root_path + "/activate.sh"
-    if not os.path.isfile(activate_path):
+    if args.environment is not None:
+        if not os.path.isfile(args.environment):
+            print(f"error - environment file {args.environment} does not exist")
+            exit(1)
+    elif not os.path.isfile(activate_path):
         print(f"error - activation script {activate_path} does not exist")
         exit(1)
 
@@ -501,7 +622,10 @@ def view_impl(args):
     if not os.path.exists(bin_path):
         os.makedirs(bin_path)
 
-    envvars = read_activation_script(activate_path)
+    if args.environment is not None:
+        envvars = read_environment(args.environment)
+    else:
+        envvars = read_activation_script(activate_path)
 
     # force all prefix path style variables (list vars) to use PREPEND the first operation.
     envvars.make_dirty()
@@ -575,6 +699,243 @@ def view_impl(args):
         fid.write("\n")
 
 
+# The description of the variables of a view in meta/env.json. Version 2 has the
+# same "values" as version 1, with the updates of each list variable compacted, and
+# adds "clean": the value of each list variable when it is not set before the view
+# is activated, so that it can be set without applying the updates.
+def env_description(envvars: EnvVarSet) -> dict:
+    envvars.compact()
+    return {"version": 2, "values": envvars.as_dict(), "clean": envvars.clean_values()}
+
+
+# The paths that the compacted updates of var add before and after the current value
+# of the variable, or None if they replace the current value with var.clean_value.
+def _activation_paths(var: ListEnvVar):
+    if any(u.op == EnvVarOp.SET for u in var.updates):
+        return None
+    before = [p for u in var.updates if u.op == EnvVarOp.PREPEND for p in u.value]
+    after = [p for u in var.updates if u.op == EnvVarOp.APPEND for p in u.value]
+    return before, after
+
+
+def _sh_quote(s: str) -> str:
+    return "'" + s.replace("'", "'\\''") + "'"
+
+
+def _fish_quote(s: str) -> str:
+    return "'" + s.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def _csh_quote(s: str) -> str:
+    return "'" + s.replace("'", "'\\''").replace("!", "\\!") + "'"
+
+
+# The scripts that activate and deactivate the view for bash and zsh. The paths of the
+# view are unique once compacted, so only the current paths are compared to the others,
+# by a shell function that does not start other processes.
+def _sh_scripts(envvars: EnvVarSet, view: str, mark: str):
+    activate = [
+        f"# Activate the view {view}: the variables that it changes are restored by",
+        "# sourcing deactivate.bash (or deactivate.zsh) from the same shell.",
+        f'if [ -z "${{{mark}+x}}" ]; then',
+        f"{mark}=1",
+        "# the paths $1, which are unique, followed by those of $2 that are not already in the value",
+        "_uenv_dedup() {",
+        "    _uenv_value=$1",
+        '    _uenv_rest="$2:"',
+        '    while [ -n "$_uenv_rest" ]; do',
+        "        _uenv_path=${_uenv_rest%%:*}",
+        "        _uenv_rest=${_uenv_rest#*:}",
+        '        case ":$_uenv_value:$_uenv_path" in',
+        '            *":$_uenv_path:"* | *:) ;;',
+        "            *) _uenv_value=${_uenv_value:+$_uenv_value:}$_uenv_path ;;",
+        "        esac",
+        "    done",
+        "}",
+    ]
+    deactivate = [f"# Deactivate the view {view}.", f'if [ -n "${{{mark}+x}}" ]; then']
+
+    def save(name):
+        saved = f"{mark}_{name}"
+        activate.append(f'if [ -n "${{{name}+x}}" ]; then {saved}=${name}; else unset {saved}; fi')
+        deactivate.append(f'if [ -n "${{{saved}+x}}" ]; then export {name}="${saved}"; else unset {name}; fi')
+        deactivate.append(f"unset {saved}")
+
+    for name, var in envvars.lists.items():
+        save(name)
+        paths = _activation_paths(var)
+        clean = f"export {name}={_sh_quote(var.clean_value)}"
+        if paths is None:
+            activate.append(clean)
+        else:
+            before, after = paths
+            value = f'"${name}"' + (":" + _sh_quote(":".join(after)) if after else "")
+            activate += [
+                f'if [ -n "${{{name}:-}}" ]; then',
+                f"    _uenv_dedup {_sh_quote(':'.join(before))} {value}",
+                f'    export {name}="$_uenv_value"',
+                "else",
+                f"    {clean}",
+                "fi",
+            ]
+    for name, var in envvars.scalars.items():
+        save(name)
+        activate.append(f"unset {name}" if var.is_null else f"export {name}={_sh_quote(var.value)}")
+
+    activate += ["unset -f _uenv_dedup", "unset _uenv_rest _uenv_value _uenv_path", "fi"]
+    deactivate += [f"unset {mark}", "fi"]
+    return activate, deactivate
+
+
+def _fish_scripts(envvars: EnvVarSet, view: str, mark: str):
+    activate = [
+        f"# Activate the view {view}: the variables that it changes are restored by",
+        "# sourcing deactivate.fish from the same shell.",
+        f"if not set -q {mark}",
+        f"    set -g {mark} 1",
+    ]
+    deactivate = [f"# Deactivate the view {view}.", f"if set -q {mark}"]
+
+    def save(name):
+        saved = f"{mark}_{name}"
+        activate.extend([f"    set -e {saved}", f"    set -q {name}; and set -g {saved} ${name}"])
+        deactivate.extend(
+            [
+                f"    if set -q {saved}",
+                f"        set -gx {name} ${saved}",
+                f"        set -e {saved}",
+                "    else",
+                f"        set -e {name}",
+                "    end",
+            ]
+        )
+
+    for name, var in envvars.lists.items():
+        save(name)
+        paths = _activation_paths(var)
+        clean = f"set -gx {name} {' '.join(_fish_quote(p) for p in var.clean_value.split(':') if p)}".rstrip()
+        if paths is None:
+            activate.append(f"    {clean}")
+        else:
+            before, after = paths
+            value = [f'(string split : -- "${name}")']
+            value += [_fish_quote(p) for p in after]
+            activate += [
+                f'    if test -n "${name}"',
+                f"        set -l uenv_value {' '.join(_fish_quote(p) for p in before)}".rstrip(),
+                f"        for p in {' '.join(value)}",
+                '            if test -n "$p"; and not contains -- $p $uenv_value',
+                "                set -a uenv_value $p",
+                "            end",
+                "        end",
+                f"        set -gx {name} $uenv_value",
+                "    else",
+                f"        {clean}",
+                "    end",
+            ]
+    for name, var in envvars.scalars.items():
+        save(name)
+        activate.append(f"    set -e {name}" if var.is_null else f"    set -gx {name} {_fish_quote(var.value)}")
+
+    activate.append("end")
+    deactivate += [f"    set -e {mark}", "end"]
+    return activate, deactivate
+
+
+def _csh_scripts(envvars: EnvVarSet, view: str, mark: str):
+    activate = [
+        f"# Activate the view {view}: the variables that it changes are restored by",
+        "# sourcing deactivate.csh from the same shell.",
+        f"if ( ! $?{mark} ) then",
+        f"    set {mark} = 1",
+        "    unset _uenv_noglob",
+        "    if ( $?noglob ) set _uenv_noglob",
+        "    set noglob",
+    ]
+    deactivate = [f"# Deactivate the view {view}.", f"if ( $?{mark} ) then"]
+
+    def save(name):
+        saved = f"{mark}_{name}"
+        activate.extend([f"    unset {saved}", f'    if ( $?{name} ) set {saved} = "${name}"'])
+        deactivate.extend(
+            [
+                f"    if ( $?{saved} ) then",
+                f'        setenv {name} "${saved}"',
+                f"        unset {saved}",
+                "    else",
+                f"        unsetenv {name}",
+                "    endif",
+            ]
+        )
+
+    for name, var in envvars.lists.items():
+        save(name)
+        paths = _activation_paths(var)
+        clean = f"setenv {name} {_csh_quote(var.clean_value)}"
+        if paths is None:
+            activate.append(f"    {clean}")
+        else:
+            # the current value replaces the clean value if it is set and not empty. It is
+            # split into words by the shell, with a :gs modifier in braces, so that the space
+            # in the modifier is part of the variable reference; noglob keeps a path with
+            # wildcards from being expanded as a file name.
+            before, after = paths
+            value = ["${_uenv_rest:gs/:/ /}"] + [_csh_quote(p) for p in after]
+            activate += [
+                f"    if ( $?{mark}_{name} ) then",
+                f'        set _uenv_rest = "${mark}_{name}"',
+                "    else",
+                '        set _uenv_rest = ""',
+                "    endif",
+                '    if ( "$_uenv_rest" != "" ) then',
+                f"        set _uenv_value = {_csh_quote(':'.join(before))}",
+                f"        foreach _uenv_path ( {' '.join(value)} )",
+                '            if ( ":${_uenv_value}:" !~ *:${_uenv_path}:* ) then',
+                '                if ( "$_uenv_value" == "" ) then',
+                '                    set _uenv_value = "$_uenv_path"',
+                "                else",
+                '                    set _uenv_value = "${_uenv_value}:${_uenv_path}"',
+                "                endif",
+                "            endif",
+                "        end",
+                f'        setenv {name} "$_uenv_value"',
+                "    else",
+                f"        {clean}",
+                "    endif",
+            ]
+    for name, var in envvars.scalars.items():
+        save(name)
+        activate.append(f"    unsetenv {name}" if var.is_null else f"    setenv {name} {_csh_quote(var.value)}")
+
+    activate += [
+        "    if ( ! $?_uenv_noglob ) unset noglob",
+        "    unset _uenv_rest _uenv_value _uenv_path _uenv_noglob",
+        "endif",
+    ]
+    deactivate += [f"    unset {mark}", "endif"]
+    return activate, deactivate
+
+
+# Compile the activation of a view into scripts for the common shells, which set the
+# variables without interpreting env.json, and deactivation scripts that restore the
+# values that the variables had before. Returns the scripts by file name.
+def activation_scripts(envvars: EnvVarSet, view: str) -> dict:
+    envvars.compact()
+    # the shell variable that is set while the view is active
+    mark = "_UENV_VIEW_" + re.sub(r"\W", "_", view).upper()
+    scripts = {}
+    for extension, compile in [
+        ("bash", _sh_scripts),
+        ("zsh", _sh_scripts),
+        ("fish", _fish_scripts),
+        ("csh", _csh_scripts),
+    ]:
+        activate, deactivate = compile(envvars, view, mark)
+        scripts[f"activate.{extension}"] = "\n".join(activate) + "\n"
+        scripts[f"deactivate.{extension}"] = "\n".join(deactivate) + "\n"
+    return scripts
+
+
 def meta_impl(args):
     # verify that the paths exist
     if not os.path.exists(args.mount):
@@ -609,28 +970,27 @@ def meta_impl(args):
         recipe_vars = data["recipe_variables"]
 
         # update the view environment variables by appending variables from the recipe
-        for var_name, value in recipe_vars["scalar"].items():
-            spack_vars["values"]["scalar"][var_name] = value
-        for var_name, updates in recipe_vars["list"].items():
-            spack_vars["values"]["list"].setdefault(var_name, [])
-            spack_vars["values"]["list"][var_name] += updates
+        envvars = EnvVarSet.from_dict(spack_vars["values"])
+        envvars.update(EnvVarSet.from_dict(recipe_vars))
 
         # update the global meta data to include the environment variable state
-        meta["views"][name]["env"] = spack_vars
+        meta["views"][name]["env"] = env_description(envvars)
+
+        for filename, script in activation_scripts(envvars, name).items():
+            with open(os.path.join(env_root, filename), "w") as fid:
+                fid.write(script)
         meta["views"][name]["type"] = "spack-view"
 
     # process spack and modules
     if args.modules:
         module_path = f"{args.mount}/modules"
+        envvars = EnvVarSet()
+        envvars.set_list("MODULEPATH", [module_path], EnvVarOp.PREPEND)
         meta["views"]["modules"] = {
             "activate": "/dev/null",
             "description": "activate modules",
             "root": module_path,
-            "env": {
-                "version": 1,
-                "type": "augment",
-                "values": {"list": {"MODULEPATH": [{"op": "prepend", "value": [module_path]}]}, "scalar": {}},
-            },
+            "env": {"type": "augment", **env_description(envvars)},
         }
 
     if args.spack is not None:
@@ -656,18 +1016,14 @@ def meta_impl(args):
                     scalar_vars["UENV_SPACK_PACKAGES_REF"] = ref
                     scalar_vars["UENV_SPACK_PACKAGES_COMMIT"] = commit
             scalar_vars["UENV_PACKAGE_REPOS"] = ",".join(repo_names)
+        envvars = EnvVarSet()
+        for var_name, value in scalar_vars.items():
+            envvars.set_scalar(var_name, value)
         meta["views"]["spack"] = {
             "activate": "/dev/null",
             "description": "configure spack upstream",
             "root": spack_path,
-            "env": {
-                "version": 1,
-                "type": "augment",
-                "values": {
-                    "list": {},
-                    "scalar": scalar_vars,
-                },
-            },
+            "env": {"type": "augment", **env_description(envvars)},
         }
 
     # update the uenv meta data file with the new env. variable description
@@ -690,6 +1046,13 @@ if __name__ == "__main__":
     view_parser.add_argument(
         "--prefix_paths", help="a list of relative prefix path searchs of the form X=y:z,Y=p:q", default="", type=str
     )
+    view_parser.add_argument(
+        "--environment",
+        help="the variables changed by the activation of the view, written by spack-query.py, "
+        "which are read instead of ROOT/activate.sh",
+        type=str,
+        default=None,
+    )
     # only add compilers if this argument is passed
     view_parser.add_argument("--compilers", help="path of the packages.yaml file", type=str, default=None)
     view_parser.add_argument(
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Fetch the sources of the packages of a spack environment that will be built
+from source, concurrently. Intended to be run as:
+
+    spack -e ENV_ROOT python fetch-sources.py [--jobs N] [--spack SPACK]
+
+The packages that are installed, external, or in a build cache, are skipped.
+The others are fetched by --jobs concurrent `spack fetch` processes, so the
+sources come from the source mirrors first, and fill the source cache
+(config:source_cache), where spack install finds them. It runs alongside spack
+install, which waits on the lock of the stage of a package that is being fetched.
+
+A package whose source can't be fetched is only reported: spack install fetches
+it again, and fails if it can't either.
+"""
+
+import argparse
+import concurrent.futures
+import math
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+
+def batches(items, jobs):
+    """Split items into batches, about four per job, so that the jobs stay busy until the end."""
+    if not items:
+        return []
+    size = math.ceil(len(items) / (jobs * 4))
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def count_hits(output):
+    """The number of sources in the output of spack fetch that were found in the source cache."""
+    return sum(1 for line in output.splitlines() if "Using cached archive" in line)
+
+
+def tree_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def source_specs():
+    """The specs of the active environment that will be built from source, and have sources."""
+    import spack.binary_distribution
+    import spack.environment
+    import spack.store
+
+    env = spack.environment.active_environment()
+    if env is None:
+        raise RuntimeError(
+            "fetch-sources.py must be run in a spack environment: spack -e ENV_ROOT python fetch-sources.py"
+        )
+    index = spack.binary_distribution.BINARY_INDEX
+    try:
+        index.update()
+    except spack.binary_distribution.FetchCacheError as err:
+        print(f"fetch-sources: warning: the build cache index could not be read: {err}")
+
+    specs = {}
+    with spack.store.STORE.db.read_transaction():
+        for spec in env.all_specs():
+            if spec.external or spec.installed or spec.dag_hash() in specs:
+                continue
+            if index.find_by_hash(spec.dag_hash()) or not spec.package.has_code:
+                continue
+            specs[spec.dag_hash()] = spec
+    return sorted(specs.values(), key=lambda spec: spec.name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch the sources of the packages that are built from source.")
+    parser.add_argument("--spack", default="spack", help="the spack command used to fetch")
+    parser.add_argument("--jobs", type=int, default=8, help="the number of concurrent fetches")
+    args = parser.parse_args()
+
+    import spack.config
+    import spack.environment
+    import spack.util.path
+
+    start = time.time()
+    specs = source_specs()
+    source_cache = spack.util.path.canonicalize_path(spack.config.get("config:source_cache"))
+    size_before = tree_size(source_cache)
+    print(f"fetch-sources: fetching the sources of {len(specs)} packages with {args.jobs} jobs", flush=True)
+
+    command = [*shlex.split(args.spack), "-e", spack.environment.active_environment().path, "fetch"]
+
+    def fetch(batch):
+        result = subprocess.run(
+            command + [f"/{spec.dag_hash()}" for spec in batch],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+        return batch, result
+
+    hits = failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        for batch, result in pool.map(fetch, batches(specs, args.jobs)):
+            hits += count_hits(result.stdout)
+            if result.returncode != 0:
+                failed += len(batch)
+                names = ", ".join(spec.name for spec in batch)
+                print(f"fetch-sources: warning: fetching the sources of {names} failed:\n{result.stdout}", flush=True)
+
+    elapsed = time.time() - start
+    downloaded = max(tree_size(source_cache) - size_before, 0) / 2**20
+    print(
+        f"fetch-sources: {len(specs)} packages, {hits} sources in the source cache, "
+        f"{downloaded:.1f} MiB downloaded in {elapsed:.1f}s ({downloaded / max(elapsed, 1e-3):.1f} MiB/s)"
+        + (f", {failed} packages left for spack install to fetch" if failed else "")
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
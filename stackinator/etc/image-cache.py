@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Add the image of a build to the image cache of stack-config, or restore it from
+the cache. Used by the generated Makefile:
+
+    image-cache.py store [--max-size BYTES] CACHE KEY IMAGE META
+    image-cache.py restore CACHE KEY IMAGE META
+
+store copies the squashfs IMAGE and the meta data directory META of the store to
+the entry CACHE/KEY.image, then deletes the least recently used entries until
+the cache is at most --max-size bytes. restore copies them back out of the
+cache, and fails if KEY is no longer in the cache.
+
+Every entry has a lock file CACHE/KEY.lock, whose mtime records when the entry
+was last used. This is the layout of stackinator.cache.ImageCache, which is used
+by stack-config to look up images, and by stack-cache to list and prune them.
+"""
+
+import argparse
+import contextlib
+import datetime
+import fcntl
+import json
+import os
+import pathlib
+import shutil
+import sys
+
+
+@contextlib.contextmanager
+def locked(path, shared=False, blocking=True):
+    """Hold an flock on path, and yield False if blocking is False and it is held elsewhere."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        flags = (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB)
+        try:
+            fcntl.flock(fd, flags)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+    finally:
+        os.close(fd)
+
+
+def tree_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            total += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+    return total
+
+
+def copy_meta(src, dst):
+    if dst.is_dir() and not dst.is_symlink():
+        shutil.rmtree(dst)
+    shutil.copytree(src, dst, symlinks=True)
+
+
+def store(cache, key, image, meta, max_size):
+    cache.mkdir(parents=True, exist_ok=True)
+    entry = cache / f"{key}.image"
+    lock = cache / f"{key}.lock"
+    with locked(lock):
+        if (entry / "image.json").is_file():
+            print(f"the image is already in the cache: {entry}")
+        else:
+            # the entry is assembled next to its final location, and moved into
+            # place once it is complete
+            tmp = cache / f".{key}.{os.getpid()}.tmp"
+            shutil.rmtree(tmp, ignore_errors=True)
+            tmp.mkdir()
+            shutil.copyfile(image, tmp / "store.squashfs")
+            copy_meta(meta, tmp / "meta")
+            info = {
+                "key": key,
+                "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+                "build": os.getcwd(),
+            }
+            (tmp / "image.json").write_text(json.dumps(info, indent=2) + "\n")
+            shutil.rmtree(entry, ignore_errors=True)
+            os.replace(tmp, entry)
+            print(f"added the image to the cache: {entry}")
+        os.utime(lock)
+
+    if max_size is not None:
+        prune(cache, max_size)
+
+
+def prune(cache, max_size):
+    """Delete the least recently used entries, that are not in use, until the cache is at most max_size bytes."""
+    entries = []
+    for entry in cache.glob("*.image"):
+        lock = entry.with_suffix(".lock")
+        last_used = lock.stat().st_mtime if lock.exists() else entry.stat().st_mtime
+        entries.append((last_used, entry, tree_size(entry)))
+    total = sum(size for _, _, size in entries)
+    for _, entry, size in sorted(entries):
+        if total <= max_size:
+            break
+        lock = entry.with_suffix(".lock")
+        with locked(lock, blocking=False) as acquired:
+            if not acquired:
+                continue
+            print(f"removing the least recently used image {entry} from the cache")
+            shutil.rmtree(entry)
+        lock.unlink(missing_ok=True)
+        total -= size
+
+
+def restore(cache, key, image, meta):
+    entry = cache / f"{key}.image"
+    lock = cache / f"{key}.lock"
+    missing = f"error: the image {key} is no longer in the cache {cache}: run stack-config again to build it"
+    # the lock is checked first, so that no lock is created for a missing entry
+    if not lock.exists():
+        print(missing, file=sys.stderr)
+        return 1
+    with locked(lock, shared=True):
+        if not (entry / "image.json").is_file():
+            print(missing, file=sys.stderr)
+            return 1
+        tmp = image.with_name(f".{image.name}.tmp")
+        shutil.copyfile(entry / "store.squashfs", tmp)
+        os.replace(tmp, image)
+        copy_meta(entry / "meta", meta)
+        os.utime(lock)
+    print(f"restored the image from the cache: {entry}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add an image to the image cache, or restore it from the cache.")
+    parser.add_argument("command", choices=["store", "restore"])
+    parser.add_argument("--max-size", type=int, help="the maximum size of the cache in bytes, after store")
+    parser.add_argument("cache", type=pathlib.Path)
+    parser.add_argument("key")
+    parser.add_argument("image", type=pathlib.Path)
+    parser.add_argument("meta", type=pathlib.Path)
+    args = parser.parse_args()
+
+    if args.command == "store":
+        store(args.cache, args.key, args.image, args.meta, args.max_size)
+        return 0
+    return restore(args.cache, args.key, args.image, args.meta)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Run a command and append a record of the resources that it used to a ledger.
+Used by the generated Make.user to wrap the sandbox:
+
+    ledger.py LEDGER TARGET COMMAND [ARGS ...]
+
+One JSON line is appended to LEDGER for every invocation, with the make target,
+the command, the wall time, the user and system CPU time and the peak RSS of
+the command and all of its children (from wait4), and its exit status.
+
+Records of the same make invocation share the build id in the environment
+variable STACKINATOR_BUILD_ID, and the spack commit is taken from
+STACKINATOR_SPACK_COMMIT. The exit status of the command is returned unchanged.
+Use the stack-report tool to summarise the ledger.
+"""
+
+import datetime
+import fcntl
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+
+def append(ledger, record):
+    line = json.dumps(record, sort_keys=True) + "\n"
+    # concurrent make jobs append to the same ledger
+    with open(ledger, "a") as fid:
+        fcntl.flock(fid, fcntl.LOCK_EX)
+        fid.write(line)
+
+
+def main(argv):
+    if len(argv) < 3:
+        print("usage: ledger.py LEDGER TARGET COMMAND [ARGS ...]", file=sys.stderr)
+        return 2
+    ledger, target, command = argv[0], argv[1], argv[2:]
+
+    start = time.time()
+    t0 = time.monotonic()
+    proc = subprocess.Popen(command)
+    # the terminal delivers ctrl-c to the command too: wait for it to exit
+    # so that the interrupted step is recorded, then return its status.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    wall = time.monotonic() - t0
+    returncode = proc.returncode = os.waitstatus_to_exitcode(status)
+
+    try:
+        append(
+            ledger,
+            {
+                "build": os.environ.get("STACKINATOR_BUILD_ID", ""),
+                "spack": os.environ.get("STACKINATOR_SPACK_COMMIT", ""),
+                "target": target,
+                "command": " ".join(command),
+                "start": datetime.datetime.fromtimestamp(start, datetime.timezone.utc).isoformat(),
+                "wall": round(wall, 3),
+                "user": round(rusage.ru_utime, 3),
+                "sys": round(rusage.ru_stime, 3),
+                # ru_maxrss is in kilobytes on linux
+                "maxrss": rusage.ru_maxrss * 1024,
+                "status": returncode,
+            },
+        )
+    except OSError as err:
+        print(f"ledger.py: unable to write to {ledger}: {err}", file=sys.stderr)
+
+    # a command that was killed by a signal has a negative return code
+    return 128 - returncode if returncode < 0 else returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
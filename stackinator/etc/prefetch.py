@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Download the binaries of the packages of a concretized environment from a
+build cache into a local mirror, concurrently. Intended to be run as:
+
+    prefetch.py [--jobs N] [--database STORE/.spack-db/index.json] ENV_ROOT/spack.lock URL PATH
+
+spack install downloads the binaries that it installs from the build cache one
+at a time, when it reaches them. The local mirror in PATH is configured before
+the build cache in mirrors.yaml, so that once its index has been updated with
+`spack buildcache update-index`, spack installs the binaries from it instead.
+
+The build cache at URL (a file:// url, a path or an http(s):// url) has the
+layout of spack 1.0: the manifest of every package is in
+v3/manifests/spec/NAME/NAME-VERSION-HASH.spec.manifest.json, and lists the
+blobs of the package, which are stored by checksum in blobs/ALGORITHM/XX/CHECKSUM.
+They are copied to the same paths in PATH, and the checksum of every blob is
+verified. The manifest is written after the blobs, so that spack never finds
+an incomplete package.
+
+The packages that are already installed in the store (see --database) and the
+externals are skipped. A package that is not in the build cache, or that fails
+to download, is built or fetched from the build cache by spack install as usual,
+so prefetch.py only fails if it is used incorrectly.
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import pathlib
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+CHUNK_SIZE = 1 << 20
+
+
+def lock_specs(lock_path):
+    """(hash, name, version) of the packages in a spack.lock file, except externals."""
+    with open(lock_path) as fid:
+        lock = json.load(fid)
+    specs = []
+    for dag_hash, spec in lock.get("concrete_specs", {}).items():
+        # lockfile v1 nests the spec under the package name
+        if "name" not in spec and len(spec) == 1:
+            spec = next(iter(spec.values()))
+        if "external" in spec:
+            continue
+        specs.append((dag_hash, spec["name"], str(spec["version"])))
+    return specs
+
+
+def installed_hashes(database):
+    """The hashes of the packages installed in the store, from its spack database."""
+    if database is None:
+        return set()
+    try:
+        with open(database) as fid:
+            installs = json.load(fid).get("database", {}).get("installs", {})
+    except (FileNotFoundError, json.JSONDecodeError):
+        return set()
+    return {dag_hash for dag_hash, record in installs.items() if record.get("installed")}
+
+
+def tmp_path(path):
+    """A temporary file next to path, unique to the thread, that is moved to path when complete."""
+    return path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def manifest_path(dag_hash, name, version):
+    return f"v3/manifests/spec/{name}/{name}-{version}-{dag_hash}.spec.manifest.json"
+
+
+def blob_path(algorithm, checksum):
+    return f"blobs/{algorithm}/{checksum[:2]}/{checksum}"
+
+
+def manifest_data(text):
+    """The json data of a manifest, which is clearsigned if the package is signed."""
+    if text.startswith("-----BEGIN PGP SIGNED MESSAGE-----"):
+        # the message starts after the armor headers, which end with an empty line
+        text = text.split("\n\n", 1)[1].split("-----BEGIN PGP SIGNATURE-----", 1)[0]
+    return json.loads(text)
+
+
+class BuildCache:
+    """Read-only access to the files of a build cache, by their path relative to its root."""
+
+    def __init__(self, url):
+        parsed = urllib.parse.urlparse(url)
+        if parsed.scheme in ("", "file"):
+            self.root = pathlib.Path(os.path.expandvars(parsed.path if parsed.scheme else url))
+            self.url = None
+        elif parsed.scheme in ("http", "https"):
+            self.root = None
+            self.url = url.rstrip("/")
+        else:
+            raise ValueError(f"prefetching from {parsed.scheme}:// build caches is not supported")
+
+    def open(self, path):
+        """A binary file object for path, or None if it is not in the build cache."""
+        if self.root is not None:
+            try:
+                return open(self.root / path, "rb")
+            except FileNotFoundError:
+                return None
+        try:
+            return urllib.request.urlopen(f"{self.url}/{path}", timeout=60)
+        except urllib.error.HTTPError as err:
+            if err.code == 404:
+                return None
+            raise
+
+
+def download_blob(cache, dest, algorithm, checksum):
+    """Copy a blob to dest and verify its checksum. Returns the number of bytes copied."""
+    target = dest / blob_path(algorithm, checksum)
+    if target.is_file():
+        return 0
+    source = cache.open(blob_path(algorithm, checksum))
+    if source is None:
+        raise FileNotFoundError(f"the blob {checksum} is not in the build cache")
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = tmp_path(target)
+    h = hashlib.new(algorithm)
+    size = 0
+    try:
+        with source, open(tmp, "wb") as out:
+            while chunk := source.read(CHUNK_SIZE):
+                h.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        if h.hexdigest() != checksum:
+            raise ValueError(f"the checksum of the blob {checksum} does not match its content")
+        os.replace(tmp, target)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return size
+
+
+def prefetch(cache, dest, dag_hash, name, version):
+    """Copy a package from the build cache to dest.
+
+    Returns the number of bytes copied, or None if the package is not in the build cache.
+    """
+    relpath = manifest_path(dag_hash, name, version)
+    target = dest / relpath
+    if target.is_file():
+        return 0
+    source = cache.open(relpath)
+    if source is None:
+        return None
+    with source:
+        content = source.read()
+    size = 0
+    for blob in manifest_data(content.decode()).get("data", []):
+        size += download_blob(cache, dest, blob["checksumAlgorithm"], blob["checksum"])
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = tmp_path(target)
+    tmp.write_bytes(content)
+    os.replace(tmp, target)
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download the binaries of an environment from a build cache.")
+    parser.add_argument("lock", type=pathlib.Path, help="the spack.lock of the environment")
+    parser.add_argument("url", help="the url of the build cache")
+    parser.add_argument("path", type=pathlib.Path, help="the local mirror that the binaries are copied to")
+    parser.add_argument("--jobs", type=int, default=16, help="the maximum number of concurrent downloads")
+    parser.add_argument("--database", help="the index.json of the spack database of the store")
+    args = parser.parse_args()
+
+    try:
+        cache = BuildCache(args.url)
+    except ValueError as err:
+        print(f"prefetch: {err}")
+        return 0
+    args.path.mkdir(parents=True, exist_ok=True)
+
+    start = time.time()
+    installed = installed_hashes(args.database)
+    all_specs = lock_specs(args.lock)
+    specs = [spec for spec in all_specs if spec[0] not in installed]
+    total = fetched = missing = failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(prefetch, cache, args.path, *spec): spec for spec in specs}
+        for future in concurrent.futures.as_completed(futures):
+            dag_hash, name, version = futures[future]
+            try:
+                size = future.result()
+            except Exception as err:
+                failed += 1
+                print(f"prefetch: warning: {name}@{version}/{dag_hash[:7]} could not be downloaded: {err}", flush=True)
+                continue
+            if size is None:
+                missing += 1
+            else:
+                fetched += 1
+                total += size
+
+    elapsed = time.time() - start
+    print(
+        f"prefetch: {fetched} packages downloaded ({total / 2**20:.1f} MiB in {elapsed:.1f}s, "
+        f"{total / 2**20 / max(elapsed, 1e-3):.1f} MiB/s), {missing} not in the build cache, "
+        f"{len(all_specs) - len(specs)} already installed, {failed} failed"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Remove the packages that are not in the concretized environment from the
+package repositories that are installed in the store. Intended to be run as:
+
+    prune-repos.py [--pruned DIR] ENV_ROOT/spack.lock STORE/repos/spack_repo
+    prune-repos.py --restore DIR STORE/repos/spack_repo
+
+A package is kept if it is a node in the DAG of spack.lock (in any repository,
+so that the packages that it overrides or inherits from are kept too), or the
+provider of a virtual dependency of a node, or if it is imported by a package
+that is kept. The other providers of the virtuals are removed. Everything outside of the packages
+directory of each repository (repo.yaml, build_systems, ...) is kept.
+
+With --pruned, the packages are moved to DIR/<repository>/<package> instead of
+being deleted: DIR exists if packages were removed, which tells stack-config
+that the repositories have to be installed again in full before they are pruned
+again, and --restore moves the packages back into the repositories, for make
+clean.
+"""
+
+import argparse
+import json
+import keyword
+import os
+import pathlib
+import re
+import shutil
+import sys
+
+# absolute imports of another package: spack_repo.<namespace>.packages.<package>
+_ABSOLUTE_IMPORT = re.compile(r"spack_repo\.(\w+)\.packages\.(\w+)")
+# relative imports of a package in the same repository: from ..<package>.package import
+_RELATIVE_IMPORT = re.compile(r"from\s+\.\.(\w+)\.package\s+import")
+
+
+def package_dir_names(name):
+    """The names of the directory of a package in a v1 and a v2 package repository."""
+    v2 = name.replace("-", "_")
+    if re.match(r"^[0-9]", v2) or v2 in keyword.kwlist:
+        v2 = "_" + v2
+    return {name, v2}
+
+
+def lock_package_names(lock_path):
+    """The names of all packages in the DAG of a spack.lock file, and of the providers of its virtuals.
+
+    The providers are nodes of the DAG too, but are also collected from the
+    dependency edges, which name the virtuals that they provide.
+    """
+    with open(lock_path) as fid:
+        lock = json.load(fid)
+    names = set()
+    for spec in lock.get("concrete_specs", {}).values():
+        # lockfile v1 nests the spec under the package name
+        if "name" not in spec and len(spec) == 1:
+            spec = next(iter(spec.values()))
+        if "name" in spec:
+            names.add(spec["name"])
+        for dep in spec.get("dependencies", []):
+            if isinstance(dep, dict) and dep.get("parameters", {}).get("virtuals") and "name" in dep:
+                names.add(dep["name"])
+    return names
+
+
+def prune(lock_path, repos_path, dry_run=False, pruned=None):
+    repos = {
+        path.name: path / "packages"
+        for path in sorted(pathlib.Path(repos_path).iterdir())
+        if (path / "packages").is_dir()
+    }
+
+    keep_dirs = set()
+    for name in lock_package_names(lock_path):
+        keep_dirs |= package_dir_names(name)
+
+    # (repo, package directory) of every package that is kept
+    kept = set()
+    todo = [(repo, d) for repo, packages in repos.items() for d in keep_dirs if (packages / d).is_dir()]
+    while todo:
+        repo, pkg = todo.pop()
+        if (repo, pkg) in kept:
+            continue
+        kept.add((repo, pkg))
+        for source in (repos[repo] / pkg).glob("*.py"):
+            text = source.read_text(errors="replace")
+            imports = [(r, p) for r, p in _ABSOLUTE_IMPORT.findall(text)]
+            imports += [(repo, p) for p in _RELATIVE_IMPORT.findall(text)]
+            for r, p in imports:
+                if r in repos and (repos[r] / p).is_dir() and (r, p) not in kept:
+                    todo.append((r, p))
+
+    removed = 0
+    removed_bytes = 0
+    for repo, packages in repos.items():
+        for path in packages.iterdir():
+            if not path.is_dir() or path.name == "__pycache__" or (repo, path.name) in kept:
+                continue
+            for dirpath, _, filenames in os.walk(path):
+                removed_bytes += sum(os.lstat(os.path.join(dirpath, f)).st_size for f in filenames)
+            if dry_run:
+                pass
+            elif pruned is None:
+                shutil.rmtree(path)
+            else:
+                dst = pathlib.Path(pruned) / repo / path.name
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                shutil.move(path, dst)
+            removed += 1
+
+    return len(kept), removed, removed_bytes
+
+
+def restore(pruned, repos_path):
+    """Move the packages in pruned back into the repositories, and remove pruned. Returns their number."""
+    restored = 0
+    for path in sorted(pathlib.Path(pruned).glob("*/*")):
+        dst = pathlib.Path(repos_path) / path.parent.name / "packages" / path.name
+        if dst.exists():
+            shutil.rmtree(path)
+        else:
+            shutil.move(path, dst)
+            restored += 1
+    shutil.rmtree(pruned)
+    return restored
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="the spack.lock file of the environment, and the repositories")
+    parser.add_argument("--dry-run", action="store_true", help="only print what would be removed")
+    parser.add_argument("--pruned", help="the directory that the removed packages are moved to")
+    parser.add_argument("--restore", metavar="DIR", help="move the packages that were removed back from DIR")
+    args = parser.parse_args()
+
+    if args.restore is not None:
+        if len(args.paths) != 1:
+            parser.error("--restore takes the directory of the repositories only")
+        restored = restore(args.restore, args.paths[0]) if os.path.isdir(args.restore) else 0
+        print(f"prune-repos: restored {restored} packages")
+        sys.exit(0)
+
+    if len(args.paths) != 2:
+        parser.error("the spack.lock file and the directory of the repositories are required")
+    kept, removed, removed_bytes = prune(*args.paths, dry_run=args.dry_run, pruned=args.pruned)
+    print(
+        f"prune-repos: kept {kept} packages, {'would remove' if args.dry_run else 'removed'} {removed} "
+        f"packages ({removed_bytes / 1024**2:.1f} MiB)"
+    )
+    sys.exit(0)
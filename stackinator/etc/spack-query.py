@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Make the read-only queries of spack that the build needs in one spack process,
+instead of starting spack once for every query, and write their results to
+files that the Makefile reads. Intended to be run as:
+
+    spack [-e ENV_ROOT] python spack-query.py [--arch] [--version] [--mirrors]
+        [--prefix NAME ...] [--activate VIEW ...]
+        [--compiler-config OUTPUT_YAML [--compilers NAMES] [--system-packages PATH]] OUTPUT
+
+The results are written to the directory OUTPUT:
+
+    arch              the output of `spack arch`
+    version           the output of `spack --version`
+    mirrors           the output of `spack mirror list`
+    prefix-NAME       the prefix of the installed package NAME of the environment,
+                      as `spack -e ENV_ROOT find --format {prefix} NAME | head -n1`
+    activate-VIEW.sh  the output of `spack env activate -d ENV_ROOT --with-view VIEW --sh`
+    environment-VIEW.json
+                      the modifications of the variables that the activation of
+                      VIEW makes, in order, as (op, name, value), which
+                      `envvars.py view --environment` reads instead of activate.sh
+
+--compiler-config writes the compilers of the environment to OUTPUT_YAML, as
+compiler-config.py, which is found next to this script. --prefix, --activate and
+--compiler-config need the environment.
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import sys
+
+
+def write(path, text):
+    """Write text to path, replacing the previous result only once it is complete."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as fid:
+        fid.write(text)
+    os.replace(tmp, path)
+
+
+def arch():
+    import spack.spec
+
+    return str(spack.spec.ArchSpec.default_arch())
+
+
+def version():
+    import spack
+
+    return spack.get_version()
+
+
+def mirrors():
+    import spack.mirrors.mirror
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        spack.mirrors.mirror.MirrorCollection().display()
+    return output.getvalue()
+
+
+def prefix(env, name):
+    """The prefix of the first installed spec of the environment named name, or None."""
+    import spack.store
+
+    with spack.store.STORE.db.read_transaction():
+        for spec in env.all_specs():
+            if spec.name == name and spec.installed:
+                return str(spec.prefix)
+    return None
+
+
+# the spack environment modifications that envvars.py maps onto its updates
+MODIFICATION_OPS = {
+    "SetEnv": "set",
+    "SetPath": "set",
+    "UnsetEnv": "unset",
+    "PrependPath": "prepend",
+    "AppendPath": "append",
+}
+
+
+# the spack environment modifications that remove paths that were added before
+REMOVE_OPS = {"RemovePath", "RemoveFirstPath", "RemoveLastPath"}
+
+
+def modification_ops(modifications):
+    """The op, name and value of every environment modification, in order.
+
+    The value is that of a set, the path that is prepended or appended, or None
+    for an unset. A remove_path removes the path from the modifications of the
+    variable before it, so that only the paths that the activation adds are
+    recorded, and not those of the environment that it is computed in. The
+    other modifications, which have no update, are ignored with a warning.
+    """
+    ops = []
+    for m in modifications:
+        kind = type(m).__name__
+        if kind in REMOVE_OPS:
+            removed = set(m.value.split(m.separator)) if isinstance(m.value, str) else set(m.value)
+            for op in ops:
+                if op["name"] == m.name and op["value"] is not None:
+                    op["value"] = ":".join(p for p in op["value"].split(":") if p not in removed)
+            ops = [op for op in ops if op["value"] or op["op"] in ("set", "unset")]
+            continue
+        if kind not in MODIFICATION_OPS:
+            print(f"spack-query: warning: ignoring {kind} of {m.name}, which has no update", file=sys.stderr)
+            continue
+        op = MODIFICATION_OPS[kind]
+        value = None
+        if op != "unset":
+            value = m.value if isinstance(m.value, str) else m.separator.join(m.value)
+        ops.append({"op": op, "name": m.name, "value": value})
+    return ops
+
+
+def activate(env, view):
+    """The sh commands that activate the environment with view, and the modifications that they make.
+
+    The modifications are those of shell_modifications(), as modification_ops.
+    """
+    import spack.environment.shell
+
+    if not env.has_view(view):
+        raise ValueError(f"the environment {env.path} has no view named {view}")
+    commands = spack.environment.shell.activate_header(env=env, shell="sh", prompt=None, view=view)
+    modifications = spack.environment.shell.activate(env=env, view=view)
+    ops = modification_ops(modifications.env_modifications)
+    return commands + modifications.shell_modifications("sh"), ops
+
+
+def compiler_config():
+    """The compiler-config.py script next to this one, as a module."""
+    # spack python does not set __file__, but sets sys.argv to the script and its arguments
+    path = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), "compiler-config.py")
+    spec = importlib.util.spec_from_file_location("compiler_config", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query spack once for the results that the build needs.")
+    parser.add_argument("output", help="the directory that the results are written to")
+    parser.add_argument("--arch", action="store_true", help="the output of spack arch")
+    parser.add_argument("--version", action="store_true", help="the output of spack --version")
+    parser.add_argument("--mirrors", action="store_true", help="the output of spack mirror list")
+    parser.add_argument("--prefix", action="append", default=[], help="the prefix of an installed package")
+    parser.add_argument("--activate", action="append", default=[], help="the activation of the view")
+    parser.add_argument("--compiler-config", help="the packages.yaml that the compilers are written to")
+    parser.add_argument("--compilers", default="", help="comma separated names of the compilers")
+    parser.add_argument("--system-packages", help="a packages.yaml with system compilers")
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+
+    def output(name, text):
+        write(os.path.join(args.output, name), text if text.endswith("\n") else text + "\n")
+
+    if args.arch:
+        output("arch", arch())
+    if args.version:
+        output("version", version())
+    if args.mirrors:
+        output("mirrors", mirrors())
+
+    if not (args.prefix or args.activate or args.compiler_config):
+        return 0
+
+    import spack.environment
+
+    env = spack.environment.active_environment()
+    if env is None:
+        raise RuntimeError("--prefix, --activate and --compiler-config need a spack environment: spack -e ENV_ROOT")
+    for name in args.prefix:
+        path = prefix(env, name)
+        if path is None:
+            print(f"spack-query: {name} is not installed in {env.path}", file=sys.stderr)
+            return 1
+        output(f"prefix-{name}", path)
+    for view in args.activate:
+        script, ops = activate(env, view)
+        output(f"activate-{view}.sh", script)
+        output(f"environment-{view}.json", json.dumps({"version": 2, "modifications": ops}, indent=2))
+    if args.compiler_config:
+        compilers = list(filter(None, args.compilers.split(",")))
+        compiler_config().write_compiler_config(args.compiler_config, compilers, args.system_packages)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
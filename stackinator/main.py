@@ -7,9 +7,8 @@ import time
 import tempfile
 import traceback
 
-from . import VERSION, root_logger
-from .builder import Builder
-from .recipe import Recipe
+from . import VERSION, root_logger, trace
+from .cache import default_git_cache, default_image_cache
 
 
 def generate_logfile_name(name=""):
@@ -79,6 +78,17 @@ def log_header(args):
     root_logger.info(f"  develop    : {args.develop}")
 
 
+def log_trace(logfile):
+    """Write the timing trace of the run next to the log file, and log a summary."""
+
+    trace_file = f"{logfile}.trace.json"
+    trace.tracer.write(trace_file)
+    root_logger.info("\ntime per phase:")
+    for line in trace.tracer.summary():
+        root_logger.info(f"  {line}")
+    root_logger.info(f"timing trace (open in https://ui.perfetto.dev): {trace_file}")
+
+
 def make_argparser():
     parser = argparse.ArgumentParser(description=("Generate a build configuration for a spack stack from a recipe."))
     parser.add_argument("--version", action="version", version=f"stackinator version {VERSION}")
@@ -114,17 +124,59 @@ def make_argparser():
         help="Legacy build cache configuration file (deprecated; use --mirror).",
     )
     parser.add_argument("--develop", action="store_true", required=False)
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        required=False,
+        type=int,
+        help="Maximum number of concurrent workers used during configuration, e.g. to clone repositories.",
+    )
+    parser.add_argument(
+        "--git-cache",
+        required=False,
+        default=default_git_cache(),
+        type=str,
+        help="Path of a persistent cache of git mirrors shared between build paths (default: $STACKINATOR_GIT_CACHE).",
+    )
+    parser.add_argument(
+        "--image-cache",
+        required=False,
+        default=default_image_cache(),
+        type=str,
+        help="Path of a persistent cache of the images built from the same inputs, which are restored instead of "
+        "being built again (default: $STACKINATOR_IMAGE_CACHE).",
+    )
+    parser.add_argument(
+        "--image-cache-max-size",
+        required=False,
+        default=os.environ.get("STACKINATOR_IMAGE_CACHE_MAX_SIZE"),
+        type=str,
+        help="Size above which the least recently used images are deleted from the image cache "
+        "(default: $STACKINATOR_IMAGE_CACHE_MAX_SIZE, or 100G).",
+    )
 
     return parser
 
 
 def main():
+    # stack-config batch MATRIX validates or configures many recipes at once
+    if sys.argv[1:2] == ["batch"]:
+        from .batch import main as batch_main
+
+        return batch_main(sys.argv[2:])
+
+    # --help, --version and errors in the arguments exit here, before a log file
+    # is created or any of the modules that generate the configuration are loaded
+    args = make_argparser().parse_args()
+
     logfile = generate_logfile_name("_config")
     configure_logging(logfile)
 
     try:
-        parser = make_argparser()
-        args = parser.parse_args()
+        # imported here because they pull in jinja2, jsonschema and yaml
+        from .builder import Builder
+        from .recipe import Recipe
+
         root_logger.debug(f"Command line arguments: {args}")
         log_header(args)
 
@@ -133,6 +185,7 @@ def main():
 
         builder.generate(recipe)
 
+        log_trace(logfile)
         root_logger.info("\nConfiguration finished, run the following to build the environment:\n")
         root_logger.info(f"cd {builder.path}")
         root_logger.info(
@@ -141,6 +194,7 @@ def main():
         root_logger.info(f"see logfile for more information {logfile}")
         return 0
     except Exception as e:
+        log_trace(logfile)
         root_logger.info(traceback.format_exc())
         root_logger.error(str(e))
         root_logger.info(f"see {logfile} for more information")
@@ -5,9 +5,7 @@ import pathlib
 import urllib.parse
 import yaml
 
-import magic
-
-from . import schema, root_logger
+from . import schema, root_logger, trace
 from .spack_util import Version
 
 
@@ -28,6 +26,18 @@ GPG_KEY_MIME_TYPES = (
 )
 
 
+def _mime_type(data: bytes) -> str:
+    """The libmagic mime type of data.
+
+    python-magic loads libmagic and its database when it is imported, so it is
+    only imported when a key is not ASCII-armored.
+    """
+
+    import magic
+
+    return magic.from_buffer(data, mime=True)
+
+
 def _supports_concretization_cache(spack_version: Version) -> bool:
     """Whether the given spack version supports the concretizer cache.
 
@@ -83,7 +93,9 @@ class Mirrors:
     CONFIG_YAML = "config.yaml"
     BOOTSTRAP_YAML = "bootstrap.yaml"
     CONCRETIZER_YAML = "concretizer.yaml"
+    PREFETCH_DIR = "prefetch"
 
+    @trace.traced("mirrors")
     def __init__(
         self,
         system_config_root: pathlib.Path,
@@ -254,6 +266,20 @@ class Mirrors:
                 (key_store / f"{name}.priv.gpg", self._read_key(self.buildcache["private_key"], name))
             )
 
+        # autopush is implemented by the Makefile rather than passed on to spack,
+        # so that the packages that are excluded from the build cache are not
+        # pushed: it needs a signing key, unless the build cache is not signed.
+        if (
+            self.buildcache is not None
+            and self.buildcache.get("autopush")
+            and self.buildcache["private_key"] is None
+            and self.buildcache.get("signed", True)
+        ):
+            raise MirrorError(
+                f"The build cache '{self.buildcache['name']}' sets autopush, but has no private_key to sign "
+                "the packages that are pushed to it (set signed: false to push them unsigned)."
+            )
+
         # The build cache may provide a public key, used to verify the packages
         # fetched from it. It is the only mirror with keys at all: sources (and
         # bootstrap binaries) are checksum-verified, and spack consults the gpg
@@ -277,13 +303,57 @@ class Mirrors:
         """The build cache mirror name to push built packages to, or None.
 
         Pushing requires a private signing key; a build cache configured without one
-        is read-only - fetched from but never pushed to.
+        is read-only - fetched from but never pushed to, unless it is not signed and
+        sets autopush.
         """
 
-        if self.buildcache is not None and self.buildcache["private_key"] is not None:
+        if self.buildcache is None:
+            return None
+        if self.buildcache["private_key"] is not None:
+            return self.buildcache["name"]
+        if self.buildcache.get("autopush") and not self.sign_build_cache:
             return self.buildcache["name"]
         return None
 
+    @property
+    def sign_build_cache(self) -> bool:
+        """Whether the packages pushed to the build cache are signed.
+
+        Like spack, they are signed unless the build cache sets signed: false.
+        """
+
+        return self.buildcache is not None and self.buildcache.get("signed", True)
+
+    @property
+    def autopush_to_build_cache(self) -> Optional[str]:
+        """The build cache mirror name to push packages to while they are being built, or None.
+
+        With autopush set on a build cache that is pushed to, every package is
+        pushed as soon as it is installed, instead of after the whole install.
+        """
+
+        if self.push_to_build_cache is not None and self.buildcache.get("autopush"):
+            return self.push_to_build_cache
+        return None
+
+    def prefetch_mirror(self, config_root: pathlib.Path) -> Optional[Dict]:
+        """The local mirror that the binaries in the build cache are prefetched to, or None.
+
+        Returns a dict with the name and path of the local mirror, and the url of
+        the build cache that it is filled from. The local mirror is configured
+        before the build cache, so that spack installs the prefetched binaries
+        from it.
+        """
+
+        if self.buildcache is None:
+            return None
+        mount = self._mount_path if self.buildcache["mount_specific"] else None
+        return {
+            "name": f"{self.buildcache['name']}-prefetch",
+            "path": config_root / self.PREFETCH_DIR,
+            "url": self._connection(self.buildcache, "fetch", mount)["url"],
+        }
+
     @staticmethod
     def _is_remote_url(url: str) -> bool:
         """True if url is a remote url (has a non-file scheme and a host)."""
@@ -333,14 +403,14 @@ class Mirrors:
         return conn
 
     @staticmethod
-    def _add_optional_flags(entry: Dict, mirror: Dict):
+    def _add_optional_flags(entry: Dict, mirror: Dict, flags: Tuple[str, ...] = ("signed", "autopush")):
         """Pass the optional spack mirror flags (signed, autopush) through if set.
 
         These have no default in the schema, so they are present only when the user set
         them; they are copied verbatim into the emitted spack mirror entry.
         """
 
-        for flag in ("signed", "autopush"):
+        for flag in flags:
             if flag in mirror:
                 entry[flag] = mirror[flag]
 
@@ -370,9 +440,7 @@ class Mirrors:
                     f"Check the key listed in mirrors.yaml in system config."
                 )
 
-        is_gpg_key = binary_key.startswith(ASCII_PGP_HEADERS) or (
-            magic.from_buffer(binary_key, mime=True) in GPG_KEY_MIME_TYPES
-        )
+        is_gpg_key = binary_key.startswith(ASCII_PGP_HEADERS) or _mime_type(binary_key) in GPG_KEY_MIME_TYPES
         if not is_gpg_key:
             raise MirrorError(
                 f"Key for mirror {name} is not a valid GPG key. \n"
@@ -402,6 +470,16 @@ class Mirrors:
         # the spack mirrors.yaml
         spack_mirrors: Dict[str, Dict] = {"mirrors": {}}
 
+        prefetch = self.prefetch_mirror(config_root)
+        if prefetch is not None:
+            # the local copy of the binaries of the build cache, which are
+            # prefetched by the Makefile (see prefetch_mirror). It is signed (or
+            # not) like the build cache that it copies.
+            url = f"file://{prefetch['path']}"
+            entry = {"source": False, "binary": True, "fetch": {"url": url}, "push": {"url": url}}
+            self._add_optional_flags(entry, self.buildcache, flags=("signed",))
+            spack_mirrors["mirrors"][prefetch["name"]] = entry
+
         if self.buildcache is not None:
             # a mount-specific build cache lives in a sub-directory named after the
             # mount point: spack binaries embed the install prefix, so each mount
@@ -417,7 +495,10 @@ class Mirrors:
                 "fetch": self._connection(self.buildcache, "fetch", mount),
                 "push": self._connection(self.buildcache, "push", mount),
             }
-            self._add_optional_flags(entry, self.buildcache)
+            # autopush is not passed on: spack would push every package that it
+            # builds, including those excluded from the cache (see
+            # autopush_to_build_cache).
+            self._add_optional_flags(entry, self.buildcache, flags=("signed",))
             spack_mirrors["mirrors"][self.buildcache["name"]] = entry
 
         for name, mirror in self.source_mirrors.items():
@@ -0,0 +1,356 @@
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import os
+import pathlib
+import queue
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .report import format_time
+
+# the task graph of a build path, written by stack-config
+PIPELINE = "pipeline.json"
+# the state of the last stack-build run in a build path
+STATE = "stack-build.json"
+# runs a command in one sandbox session, written by stack-config
+SESSION = "sandbox-session"
+
+
+class PipelineError(RuntimeError):
+    """Exception class for errors in the task graph of a build path."""
+
+
+def makefile_rules(text: str) -> Dict[str, Tuple[List[str], str]]:
+    """The prerequisites and the recipe of every rule in a generated Makefile, by target."""
+
+    rules = {}
+    target = None
+    for line in text.splitlines():
+        if line.startswith("\t"):
+            if target is not None:
+                rules[target][1].append(line)
+        elif line and not line.startswith("#"):
+            head, sep, rest = line.partition(":")
+            # a rule, rather than a variable assignment
+            target = head if sep and " " not in head and not rest.startswith("=") else None
+            if target is not None:
+                rules[target] = (rest.split(), [])
+    return {
+        target: (prerequisites, "".join(f"{line}\n" for line in recipe))
+        for target, (prerequisites, recipe) in rules.items()
+    }
+
+
+def make_pipeline(makefile: str, target: str = "store.squashfs") -> Dict:
+    """The task graph of the build of a build path, from its generated Makefile.
+
+    Every task is a target of the Makefile that target depends on, and depends on
+    the prerequisites of the target that are tasks too, rather than files such as
+    env/spack.yaml or the fingerprints. A task whose recipe runs a recursive make
+    is phony, because make -q would run the recursive make.
+    """
+
+    rules = makefile_rules(makefile)
+    if target not in rules:
+        raise PipelineError(f"the Makefile has no rule for '{target}'")
+
+    # the tasks that target depends on, in the order of the Makefile
+    required = set()
+    todo = [target]
+    while todo:
+        name = todo.pop()
+        if name not in required:
+            required.add(name)
+            todo += [dep for dep in rules[name][0] if dep in rules]
+
+    return {
+        "version": 1,
+        "target": target,
+        "tasks": {
+            name: {"deps": [dep for dep in deps if dep in rules], "phony": "$(MAKE)" in recipe}
+            for name, (deps, recipe) in rules.items()
+            if name in required
+        },
+    }
+
+
+def required_tasks(tasks: Dict[str, Dict], target: str) -> List[str]:
+    """The tasks that target depends on, and target itself, in an order in which
+    every task comes after its dependencies."""
+
+    if target not in tasks:
+        raise PipelineError(f"'{target}' is not a task of the build: choose one of {', '.join(tasks)}")
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise PipelineError(f"the task graph has a cycle through '{name}'")
+        visiting.add(name)
+        for dep in tasks[name]["deps"]:
+            visit(dep)
+        visiting.discard(name)
+        order.append(name)
+
+    visit(target)
+    return order
+
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+
+
+class Scheduler:
+    """Runs the tasks of a build path with a bounded pool of workers.
+
+    A task is started as soon as all of the tasks that it depends on have
+    finished, so that independent tasks (e.g. the bootstrap of spack and the
+    trust of the build cache keys, or the views and the modules) overlap. Every
+    task runs `make TARGET`, so the make targets remain the single description
+    of each step, and a task is skipped if make reports that its target is up
+    to date: a build that was interrupted resumes where it stopped.
+
+    The output of each task is written to logs/TARGET.log in the build path, and
+    the status, number of attempts and duration of every task is kept in
+    stack-build.json.
+
+    If session is set, the tasks share one sandbox session, that is open while
+    the tasks run, so that the sandboxed commands enter the same namespace
+    instead of starting a new sandbox each.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        jobs: int = 4,
+        retries: int = 0,
+        make_args: Optional[List[str]] = None,
+        session: bool = True,
+    ):
+        self.path = path
+        self.jobs = jobs
+        self.retries = retries
+        self.make_args = make_args or []
+        self.session = session
+        with (path / PIPELINE).open() as fid:
+            self.pipeline = json.load(fid)
+        self.tasks = self.pipeline["tasks"]
+        self.state = {}
+        # the same environment as the recommended `env --ignore-environment ... make`
+        self.env = {
+            "PATH": f"/usr/bin:/bin:{path / 'spack' / 'bin'}",
+            "HOME": os.environ.get("HOME", "/"),
+            "STACKINATOR_BUILD_ID": os.environ.get("STACKINATOR_BUILD_ID")
+            or f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{os.getpid()}",
+        }
+
+    def log_path(self, name: str) -> pathlib.Path:
+        return self.path / "logs" / f"{name.replace('/', '-')}.log"
+
+    def _make(self, target: str, *flags: str, **kwargs) -> subprocess.CompletedProcess:
+        command = ["make", "--no-print-directory", "-C", str(self.path), *flags, target, *self.make_args]
+        return subprocess.run(command, env=self.env, stdin=subprocess.DEVNULL, **kwargs)
+
+    def up_to_date(self, name: str) -> bool:
+        return self._make(name, "-q", stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+    def run_task(self, name: str) -> str:
+        """Run the task name in a worker, and return its final status."""
+
+        self.state[name].update(status="running", start=_now())
+        if not self.tasks[name].get("phony") and self.up_to_date(name):
+            return "up-to-date"
+        log = self.log_path(name)
+        log.parent.mkdir(exist_ok=True)
+        with log.open("w") as fid:
+            for attempt in range(1, self.retries + 2):
+                self.state[name]["attempts"] = attempt
+                fid.write(f"==> [stack-build] make {name} (attempt {attempt}, {_now()})\n")
+                fid.flush()
+                if self._make(name, stdout=fid, stderr=subprocess.STDOUT).returncode == 0:
+                    return "done"
+        return "failed"
+
+    @contextlib.contextmanager
+    def sandbox_session(self):
+        """Keep a sandbox session open in the build path, for the make processes started in the context."""
+
+        session = self.path / SESSION
+        if not self.session or not session.is_file():
+            yield
+            return
+        # the session lasts as long as the command, which prints the pid of the session and waits for stdin to close
+        command = [str(session), "sh", "-c", 'echo "${STACKINATOR_SANDBOX_SESSION:-}"; exec cat > /dev/null']
+        proc = subprocess.Popen(command, env=self.env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        try:
+            pid = proc.stdout.readline().strip()
+            if pid:
+                self.env["STACKINATOR_SANDBOX_SESSION"] = pid
+            yield
+        finally:
+            self.env.pop("STACKINATOR_SANDBOX_SESSION", None)
+            proc.stdin.close()
+            proc.stdout.close()
+            proc.wait()
+
+    def save(self):
+        tmp = self.path / f"{STATE}.tmp"
+        with tmp.open("w") as fid:
+            json.dump({"build": self.env["STACKINATOR_BUILD_ID"], "tasks": self.state}, fid, indent=2)
+        os.replace(tmp, self.path / STATE)
+
+    def print(self, message: str):
+        print(f"[{time.strftime('%H:%M:%S')}] {message}", flush=True)
+
+    def run(self, target: str) -> bool:
+        """Run target and the tasks that it depends on. Returns True on success."""
+
+        order = required_tasks(self.tasks, target)
+        self.state = {
+            name: {"status": "pending", "attempts": 0, "start": None, "duration": None, "log": None} for name in order
+        }
+        # the number of unfinished dependencies of each task
+        waiting = {name: len(set(self.tasks[name]["deps"])) for name in order}
+        dependents = {name: [] for name in order}
+        for name in order:
+            for dep in set(self.tasks[name]["deps"]):
+                dependents[dep].append(name)
+
+        # finished tasks are put on a queue by a callback, as in install_trees()
+        finished = queue.SimpleQueue()
+        failed = False
+
+        def timed(name):
+            start = time.monotonic()
+            return self.run_task(name), time.monotonic() - start
+
+        def submit(pool, name):
+            pool.submit(timed, name).add_done_callback(lambda future: finished.put((name, future)))
+
+        with self.sandbox_session(), concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.jobs)) as pool:
+            running = 0
+            for name in order:
+                if waiting[name] == 0:
+                    submit(pool, name)
+                    running += 1
+            self.save()
+            try:
+                while running:
+                    name, future = finished.get()
+                    running -= 1
+                    try:
+                        status, duration = future.result()
+                    except Exception as err:
+                        self.print(f"error running {name}: {err}")
+                        status, duration = "failed", None
+                    self.state[name].update(status=status, duration=duration and round(duration, 3))
+                    if status == "up-to-date":
+                        self.print(f"{name}: up to date")
+                    else:
+                        log = self.log_path(name)
+                        self.state[name]["log"] = str(log.relative_to(self.path))
+                        self.print(f"{name}: {status} in {format_time(duration)}, see {log}")
+                    if status == "failed":
+                        failed = True
+                    if not failed:
+                        for dependent in dependents[name]:
+                            waiting[dependent] -= 1
+                            if waiting[dependent] == 0:
+                                submit(pool, dependent)
+                                running += 1
+                    self.save()
+            except KeyboardInterrupt:
+                # the make processes receive the interrupt from the terminal too
+                for state in self.state.values():
+                    if state["status"] == "running":
+                        state["status"] = "interrupted"
+                self.save()
+                raise
+        return not failed
+
+    def summary(self) -> List[str]:
+        width = max([len("task")] + [len(name) for name in self.state])
+        lines = [f"  {'task':<{width}}  {'status':<11}  {'attempts':>8}  {'time':>8}"]
+        for name, state in self.state.items():
+            duration = format_time(state["duration"]) if state["status"] in ("done", "failed") else "-"
+            lines.append(f"  {name:<{width}}  {state['status']:<11}  {state['attempts']:>8}  {duration:>8}")
+        return lines
+
+
+def make_argparser():
+    parser = argparse.ArgumentParser(
+        description="Build a build path generated by stack-config, running the independent steps of the build "
+        "concurrently. The Makefile in the build path can still be used instead."
+    )
+    parser.add_argument(
+        "-b", "--build", type=pathlib.Path, default=pathlib.Path.cwd(), help="the build path (default: cwd)"
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="the number of steps run concurrently (default 4)")
+    parser.add_argument("--retries", type=int, default=0, help="the number of times a failed step is retried")
+    parser.add_argument(
+        "--no-session", action="store_true", help="start a new sandbox for every command, instead of one per build"
+    )
+    parser.add_argument("-n", "--dry-run", action="store_true", help="print the steps of the build in order")
+    parser.add_argument("--status", action="store_true", help="print the state of the last run")
+    parser.add_argument("target", nargs="?", help="the step to build (default: store.squashfs)")
+    parser.add_argument(
+        "variables", nargs="*", metavar="VAR=VALUE", help="variables passed to make, e.g. NJOBS=64", default=[]
+    )
+    return parser
+
+
+def main():
+    args = make_argparser().parse_args()
+    # a target of the form VAR=VALUE is a make variable
+    if args.target is not None and "=" in args.target:
+        args.variables.insert(0, args.target)
+        args.target = None
+    path = args.build.absolute()
+
+    if args.status:
+        try:
+            with (path / STATE).open() as fid:
+                state = json.load(fid)
+        except OSError:
+            print(f"stack-build has not been run in {path}")
+            return 1
+        print(f"build {state['build']}")
+        for name, task in state["tasks"].items():
+            print(f"  {name:<24} {task['status']:<11} {format_time(task['duration'])}")
+        return 0
+
+    if not (path / PIPELINE).is_file():
+        print(f"error: {path} has no {PIPELINE}: configure it with a version of stack-config that provides stack-build")
+        return 1
+    try:
+        scheduler = Scheduler(
+            path, jobs=args.jobs, retries=args.retries, make_args=args.variables, session=not args.no_session
+        )
+        target = args.target or scheduler.pipeline["target"]
+        if args.dry_run:
+            for name in required_tasks(scheduler.tasks, target):
+                print(name)
+            return 0
+        start = time.monotonic()
+        ok = scheduler.run(target)
+    except PipelineError as err:
+        print(f"error: {err}")
+        return 1
+    except KeyboardInterrupt:
+        print("\nstack-build: interrupted, run it again to resume the build")
+        return 130
+
+    print(f"\n{'build finished' if ok else 'build failed'} in {format_time(time.monotonic() - start)}:")
+    print("\n".join(scheduler.summary()))
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,29 @@
 import copy
 import pathlib
 import re
+from typing import Dict
 
-import jinja2
-import yaml
-
-from . import root_logger, schema, spack_util, mirror
+from . import root_logger, schema, spack_util, mirror, render, trace
 from .etc.envvars import EnvVarSet
 
 
+# parsed yaml files of system configurations, see Recipe.system_yaml()
+_system_yaml_cache: Dict[tuple, object] = {}
+
+
+def load_system_yaml(path: pathlib.Path):
+    """Load the yaml file path of a system configuration, see Recipe.system_yaml()."""
+
+    if not path.is_file():
+        return None
+    stat = path.stat()
+    key = (str(path.resolve()), stat.st_mtime_ns, stat.st_size)
+    if key not in _system_yaml_cache:
+        root_logger.debug(f"opening {path}")
+        _system_yaml_cache[key] = schema.load_yaml(path)
+    return copy.deepcopy(_system_yaml_cache[key])
+
+
 class Recipe:
     @property
     def path(self):
@@ -26,6 +41,7 @@ class Recipe:
 
         self._path = path
 
+    @trace.traced("recipe")
     def __init__(self, args):
         self._logger = root_logger
         self._logger.debug("Generating recipe")
@@ -41,7 +57,8 @@ class Recipe:
         self.template_path = pathlib.Path(__file__).parent.resolve() / "templates"
 
         # required config.yaml file
-        self.config = self.path / "config.yaml"
+        with trace.span("config.yaml"):
+            self.config = self.path / "config.yaml"
 
         # override the mount point if defined as a CLI argument
         if args.mount:
@@ -57,9 +74,8 @@ class Recipe:
         if not compiler_path.is_file():
             raise FileNotFoundError(f"The recipe path '{compiler_path}' does not contain compilers.yaml")
 
-        with compiler_path.open() as fid:
-            raw = yaml.load(fid, Loader=yaml.Loader)
-            schema.CompilersValidator.validate(raw)
+        with trace.span("compilers.yaml"):
+            raw = schema.load_yaml(compiler_path, schema.CompilersValidator)
             self.generate_compiler_specs(raw)
 
         # optional modules.yaml file
@@ -67,9 +83,8 @@ class Recipe:
         modules_path = self.path / "modules.yaml"
         self._logger.debug(f"opening {modules_path}")
         if modules_path.is_file():
-            with modules_path.open() as fid:
-                self.modules = yaml.load(fid, Loader=yaml.Loader)
-                schema.ModulesValidator.validate(self.modules)
+            with trace.span("modules.yaml"):
+                self.modules = schema.load_yaml(modules_path, schema.ModulesValidator)
 
                 # Note:
                 # modules root should match MODULEPATH set by envvars and used by uenv view "modules"
@@ -113,33 +128,27 @@ class Recipe:
         recipe_packages = {}
         recipe_packages_path = self.path / "packages.yaml"
         if recipe_packages_path.is_file():
-            with recipe_packages_path.open() as fid:
-                raw = yaml.load(fid, Loader=yaml.Loader)
-                recipe_packages = raw["packages"]
+            raw = schema.load_yaml(recipe_packages_path)
+            recipe_packages = raw["packages"]
 
         # load system/packages.yaml -> system_packages (if it exists)
         system_packages = {}
-        system_packages_path = self.system_config_path / "packages.yaml"
-        if system_packages_path.is_file():
-            with system_packages_path.open() as fid:
-                raw = yaml.load(fid, Loader=yaml.Loader)
-                system_packages = raw["packages"]
+        raw = self.system_yaml("packages.yaml")
+        if raw is not None:
+            system_packages = raw["packages"]
 
         if "gcc" not in system_packages:
             raise RuntimeError("The system packages.yaml file does not provide gcc")
 
         # load the optional network.yaml from system config
-        network_path = self.system_config_path / "network.yaml"
         network_packages = {}
         mpi_templates = {}
-        if network_path.is_file():
-            self._logger.debug(f"opening {network_path}")
-            with network_path.open() as fid:
-                raw = yaml.load(fid, Loader=yaml.Loader)
-                if "packages" in raw:
-                    network_packages = raw["packages"]
-                if "mpi" in raw:
-                    mpi_templates = raw["mpi"]
+        raw = self.system_yaml("network.yaml")
+        if raw is not None:
+            if "packages" in raw:
+                network_packages = raw["packages"]
+            if "mpi" in raw:
+                mpi_templates = raw["mpi"]
         self.mpi_templates = mpi_templates
 
         # note that the order that package sets are specified in is significant.
@@ -162,9 +171,8 @@ class Recipe:
         if not environments_path.is_file():
             raise FileNotFoundError(f"The recipe path '{environments_path}' does not contain environments.yaml")
 
-        with environments_path.open() as fid:
-            raw = yaml.load(fid, Loader=yaml.Loader)
-            schema.EnvironmentsValidator.validate(raw)
+        with trace.span("environments.yaml"):
+            raw = schema.load_yaml(environments_path, schema.EnvironmentsValidator)
             self._check_environments_v3(raw)
             self.generate_environment_specs(raw)
 
@@ -270,11 +278,24 @@ class Recipe:
 
     # Returns:
     #   str:  the build cache mirror name to push built packages to
-    #   None: if there is no build cache, or it is read-only (no signing key)
+    #   None: if there is no build cache, or it is read-only (no signing key, and not unsigned with autopush)
     @property
     def push_to_build_cache(self):
         return self.mirrors.push_to_build_cache
 
+    # Returns:
+    #   str:  the build cache mirror name to push packages to as soon as they are installed
+    #   None: if autopush is not set, or the build cache is not pushed to
+    @property
+    def autopush_to_build_cache(self):
+        return self.mirrors.autopush_to_build_cache
+
+    # Returns:
+    #   bool: whether the packages pushed to the build cache are signed
+    @property
+    def sign_build_cache(self):
+        return self.mirrors.sign_build_cache
+
     # Returns:
     #   Path: of the recipe extra path if it exists
     #   None: if there is no user-provided extra path in the recipe
@@ -315,10 +336,7 @@ class Recipe:
         if not config_path.is_file():
             raise FileNotFoundError(f"The recipe path '{config_path}' does not contain config.yaml")
 
-        with config_path.open() as fid:
-            raw = yaml.load(fid, Loader=yaml.Loader)
-            schema.ConfigValidator.validate(raw)
-            self._config = raw
+        self._config = schema.load_yaml(config_path, schema.ConfigValidator)
 
     @property
     def with_modules(self) -> bool:
@@ -543,6 +561,17 @@ class Recipe:
 
         self._system_path = system_path
 
+    def system_yaml(self, name):
+        """The content of the yaml file name in the system configuration, or None
+        if the file does not exist.
+
+        The files of a system configuration are shared by every recipe that is
+        built for the system, so each one is parsed at most once per process.
+        A copy is returned, because the recipe modifies its contents.
+        """
+
+        return load_system_yaml(self.system_config_path / name)
+
     @property
     def mount(self):
         return pathlib.Path(self.config["store"])
@@ -550,17 +579,10 @@ class Recipe:
     @property
     def spack_yaml(self):
         """Render the unified spack.yaml for this recipe."""
-        env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(self.template_path),
-            trim_blocks=True,
-            lstrip_blocks=True,
-        )
-        env.filters["py2yaml"] = schema.py2yaml
-
         has_views = any(env_cfg["views"] for env_cfg in self.environments.values())
 
-        template = env.get_template("spack.yaml")
-        return template.render(
+        return render.render(
+            "spack.yaml",
             compilers=self.compilers,
             environments=self.environments,
             store=self.mount,
@@ -0,0 +1,76 @@
+import pathlib
+import threading
+
+from . import root_logger, schema
+from .cache import private_dir, user_cache_dir
+
+template_path = pathlib.Path(__file__).parent.resolve() / "templates"
+
+_lock = threading.Lock()
+_environment = None
+_hook_environments = {}
+
+
+def _bytecode_cache():
+    """A persistent cache of compiled templates in the user cache dir, if only the user can write to it.
+
+    Jinja checks the source of a template against the checksum stored with its
+    bytecode, so a template that has changed is compiled again. The bytecode is
+    loaded as code, so the cache is not used if other users can modify it.
+    """
+
+    import jinja2
+
+    path = user_cache_dir() / "jinja"
+    if not private_dir(path):
+        root_logger.debug("the jinja bytecode cache is disabled")
+        return None
+    return jinja2.FileSystemBytecodeCache(str(path))
+
+
+def environment():
+    """The jinja environment for the templates of stackinator.
+
+    It is created on first use and shared by the recipe and the builder, so
+    that every template is loaded and compiled at most once per process, and
+    the compiled templates are cached on disk between runs.
+    """
+
+    global _environment
+    with _lock:
+        if _environment is None:
+            import jinja2
+
+            _environment = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(template_path),
+                trim_blocks=True,
+                lstrip_blocks=True,
+                bytecode_cache=_bytecode_cache(),
+            )
+            _environment.filters["py2yaml"] = schema.py2yaml
+        return _environment
+
+
+def hook_environment(path: pathlib.Path):
+    """The jinja environment for the hook scripts in a recipe path.
+
+    It is an overlay of environment() that loads templates from path, and shares
+    its bytecode cache. Hooks are rendered without trim_blocks and lstrip_blocks.
+    """
+
+    base = environment()
+    with _lock:
+        key = pathlib.Path(path).resolve()
+        if key not in _hook_environments:
+            import jinja2
+
+            _hook_environments[key] = base.overlay(
+                loader=jinja2.FileSystemLoader(key), trim_blocks=False, lstrip_blocks=False
+            )
+        return _hook_environments[key]
+
+
+def render(name: str, **context) -> str:
+    """Render the stackinator template name with context."""
+
+    return environment().get_template(name).render(**context)
@@ -0,0 +1,196 @@
+import argparse
+import datetime
+import json
+import pathlib
+import sys
+from typing import Dict, List
+
+
+def load_ledgers(paths: List[pathlib.Path]) -> List[Dict]:
+    """Read the records of one or more ledgers written by ledger.py.
+
+    Lines that are not valid records (e.g. a line that was truncated when a
+    build was killed) are skipped.
+    """
+
+    records = []
+    for path in paths:
+        with open(path) as fid:
+            for lineno, line in enumerate(fid, start=1):
+                try:
+                    record = json.loads(line)
+                    record["target"], record["wall"]
+                except (ValueError, KeyError, TypeError):
+                    print(f"warning: {path}:{lineno} is not a ledger record", file=sys.stderr)
+                    continue
+                records.append(record)
+    return records
+
+
+def summarise(records: List[Dict]) -> Dict[str, Dict]:
+    """Combine the records of each build per make target.
+
+    Returns {build id: {"spack", "start", "elapsed", "targets"}}, where targets
+    maps each target, in the order that it started, to the number of commands,
+    their total wall, user and system time, the largest peak RSS, and the
+    first non-zero exit status.
+    """
+
+    builds = {}
+    for record in sorted(records, key=lambda r: r.get("start", "")):
+        build = builds.setdefault(
+            record.get("build", ""),
+            {"spack": record.get("spack", ""), "start": record.get("start", ""), "end": None, "targets": {}},
+        )
+        target = build["targets"].setdefault(
+            record["target"], {"calls": 0, "wall": 0.0, "user": 0.0, "sys": 0.0, "maxrss": 0, "status": 0}
+        )
+        target["calls"] += 1
+        target["wall"] += record["wall"]
+        target["user"] += record.get("user", 0.0)
+        target["sys"] += record.get("sys", 0.0)
+        target["maxrss"] = max(target["maxrss"], record.get("maxrss", 0))
+        target["status"] = target["status"] or record.get("status", 0)
+        try:
+            end = datetime.datetime.fromisoformat(record["start"]) + datetime.timedelta(seconds=record["wall"])
+            build["end"] = max(build["end"], end) if build["end"] else end
+        except (KeyError, ValueError):
+            pass
+
+    for build in builds.values():
+        try:
+            build["elapsed"] = (build.pop("end") - datetime.datetime.fromisoformat(build["start"])).total_seconds()
+        except (TypeError, ValueError):
+            build["elapsed"] = None
+    return builds
+
+
+def format_time(seconds) -> str:
+    if seconds is None:
+        return "-"
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    minutes, seconds = divmod(int(seconds), 60)
+    if minutes < 60:
+        return f"{minutes}m{seconds:02d}s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m"
+
+
+def format_memory(size: int) -> str:
+    return f"{size / 1024**3:.1f}G" if size >= 1024**3 else f"{size / 1024**2:.0f}M"
+
+
+def report_build(build_id: str, build: Dict) -> List[str]:
+    """A table of the time and memory used by each target of a build."""
+
+    lines = [f"build {build_id} (spack {build['spack'][:12] or 'unknown'}), {format_time(build['elapsed'])} elapsed"]
+    width = max([len("target")] + [len(t) for t in build["targets"]])
+    lines.append(f"  {'target':<{width}}  {'calls':>5}  {'wall':>8}  {'cpu':>8}  {'max rss':>8}  status")
+    for name, target in build["targets"].items():
+        cpu = target["user"] + target["sys"]
+        status = "ok" if target["status"] == 0 else f"failed ({target['status']})"
+        lines.append(
+            f"  {name:<{width}}  {target['calls']:>5}  {format_time(target['wall']):>8}  {format_time(cpu):>8}  "
+            f"{format_memory(target['maxrss']):>8}  {status}"
+        )
+    return lines
+
+
+def report_comparison(builds: Dict[str, Dict], threshold: float) -> List[str]:
+    """A table of the wall time and peak memory of each target across builds.
+
+    The change of each target relative to the first build is given, and changes
+    larger than threshold percent are flagged.
+    """
+
+    ids = list(builds)
+    lines = ["builds:"]
+    for i, build_id in enumerate(ids):
+        build = builds[build_id]
+        lines.append(f"  [{i}] {build_id} (spack {build['spack'][:12] or 'unknown'})")
+
+    targets = []
+    for build in builds.values():
+        targets += [t for t in build["targets"] if t not in targets]
+    width = max([len("target")] + [len(t) for t in targets])
+
+    header = f"  {'target':<{width}}"
+    for i in range(len(ids)):
+        header += f"  {f'wall[{i}]':>9}"
+    header += f"  {'change':>8}  "
+    for i in range(len(ids)):
+        header += f"  {f'rss[{i}]':>8}"
+    lines.append("")
+    lines.append(header)
+
+    def row(name, walls, rsss):
+        line = f"  {name:<{width}}"
+        for wall in walls:
+            line += f"  {format_time(wall):>9}"
+        first, last = walls[0], walls[-1]
+        if first and last is not None:
+            change = 100 * (last - first) / first
+            flag = " !" if abs(change) > threshold else "  "
+            line += f"  {change:+7.0f}%{flag}"
+        else:
+            line += f"  {'-':>8}  "
+        for rss in rsss:
+            line += f"  {format_memory(rss) if rss is not None else '-':>8}"
+        return line
+
+    for name in targets:
+        walls = [b["targets"][name]["wall"] if name in b["targets"] else None for b in builds.values()]
+        rsss = [b["targets"][name]["maxrss"] if name in b["targets"] else None for b in builds.values()]
+        lines.append(row(name, walls, rsss))
+    lines.append(row("elapsed", [b["elapsed"] for b in builds.values()], [None] * len(ids)))
+    return lines
+
+
+def make_argparser():
+    parser = argparse.ArgumentParser(
+        description="Summarise the time and memory used by each step of one or more builds, "
+        "from the ledger.jsonl files written in the build path."
+    )
+    parser.add_argument("ledgers", nargs="+", type=pathlib.Path, help="ledger files (BUILD_PATH/ledger.jsonl)")
+    parser.add_argument("-b", "--build", action="append", help="the id of a build to report (can be repeated)")
+    parser.add_argument(
+        "-n", "--last", type=int, default=2, help="compare the last N builds if no build is given (default 2)"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=10, help="flag changes in wall time larger than this percentage"
+    )
+    parser.add_argument("--json", action="store_true", help="print the summary as json")
+    return parser
+
+
+def main():
+    args = make_argparser().parse_args()
+    try:
+        builds = summarise(load_ledgers(args.ledgers))
+    except OSError as err:
+        print(f"error: {err}", file=sys.stderr)
+        return 1
+
+    if args.build:
+        missing = [b for b in args.build if b not in builds]
+        if missing:
+            print(f"error: no records for the builds {', '.join(missing)}", file=sys.stderr)
+            return 1
+        builds = {b: builds[b] for b in args.build}
+    else:
+        builds = dict(list(builds.items())[-args.last :])
+
+    if args.json:
+        print(json.dumps(builds, indent=2))
+    elif not builds:
+        print("the ledger is empty")
+    elif len(builds) == 1:
+        print("\n".join(report_build(*next(iter(builds.items())))))
+    else:
+        print("\n".join(report_comparison(builds, args.threshold)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
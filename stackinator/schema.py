@@ -1,17 +1,29 @@
+import functools
+import hashlib
+import importlib.metadata
 import json
+import os
 import pathlib
+import tempfile
 from textwrap import dedent
+from typing import Optional
 
 import jsonschema
 import yaml
 
-from . import root_logger
+from . import VERSION, root_logger, trace
+from .cache import parse_size, private_dir, user_cache_dir
 
 prefix = pathlib.Path(__file__).parent.resolve()
 
+# the libyaml loader and dumper are an order of magnitude faster than the pure
+# python implementations, and are used when pyyaml was built with libyaml.
+Loader = getattr(yaml, "CLoader", yaml.Loader)
+Dumper = getattr(yaml, "CDumper", yaml.Dumper)
+
 
 def py2yaml(data, indent):
-    dump = yaml.dump(data)
+    dump = yaml.dump(data, Dumper=Dumper)
     lines = [ln for ln in dump.split("\n") if ln != ""]
     res = ("\n" + " " * indent).join(lines)
     return res
@@ -64,20 +76,141 @@ class ValidationError(jsonschema.ValidationError):
 
 
 class SchemaValidator:
+    """Validates instances against a json schema, and sets their defaults.
+
+    The schema is read and its validator class is built the first time that
+    it is used, so that the validators that a run doesn't need cost nothing.
+    """
+
     def __init__(self, schema_filepath: pathlib.Path, precheck=None):
-        self._validator = validator(json.load(open(schema_filepath)))
+        self._schema_filepath = schema_filepath
         self._precheck = precheck
 
+    @functools.cached_property
+    def _validator(self):
+        with open(self._schema_filepath) as fid:
+            return validator(json.load(fid))
+
+    @functools.cached_property
+    def digest(self) -> str:
+        """A hash of the schema, that changes if the schema is modified."""
+        return hashlib.sha256(self._schema_filepath.read_bytes()).hexdigest()
+
     def validate(self, instance: dict):
         if self._precheck:
             self._precheck(instance)
 
-        errors = [error for error in self._validator.iter_errors(instance)]
+        with trace.span("validate", schema=self._validator.schema.get("title", "no-title")):
+            errors = [error for error in self._validator.iter_errors(instance)]
 
         if len(errors) != 0:
             raise ValidationError(self._validator.schema.get("title", "no-title"), errors)
 
 
+class DocumentCache:
+    """A persistent cache of parsed and validated yaml files.
+
+    The documents are stored as JSON, keyed by a hash of the content of the file,
+    of the schema that it is validated against and of this module, which fills
+    in the defaults, so a file is parsed and validated again when any of them
+    changes. A document is only cached if it is valid, with the defaults of the
+    schema filled in, and if JSON represents it exactly.
+
+    The cache is not used if its directory is not owned by the user, or can be
+    written by others. When an entry is added, the least recently used entries
+    are deleted until the cache is at most max_size bytes.
+    """
+
+    # the default maximum size of the cache
+    DEFAULT_MAX_SIZE = "64M"
+
+    # the code that validates the documents and fills in their defaults
+    _code = f"{pathlib.Path(__file__).read_bytes().hex()}:{importlib.metadata.version('jsonschema')}"
+    _code_digest = hashlib.sha256(_code.encode()).hexdigest()
+
+    def __init__(self, root: pathlib.Path, max_size: Optional[int] = None):
+        self.root = root
+        self.max_size = parse_size(self.DEFAULT_MAX_SIZE) if max_size is None else max_size
+
+    def _key(self, data: bytes, validator: Optional[SchemaValidator]) -> str:
+        digest = hashlib.sha256(f"{VERSION}:{Loader.__name__}:".encode())
+        digest.update(self._code_digest.encode())
+        digest.update(validator.digest.encode() if validator else b"-")
+        digest.update(data)
+        return digest.hexdigest()
+
+    def _prune(self):
+        """Delete the least recently used entries until the cache is at most max_size bytes."""
+
+        entries = []
+        for entry in self.root.glob("*.json"):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            entry.unlink(missing_ok=True)
+            total -= size
+
+    def load(self, path: pathlib.Path, validator: Optional[SchemaValidator] = None):
+        """Load and validate the yaml file path.
+
+        The precheck of the validator is run on cached documents too, so that its
+        warnings are reported every time.
+        """
+
+        data = path.read_bytes()
+        usable = private_dir(self.root)
+        entry = self.root / f"{self._key(data, validator)}.json"
+        if usable:
+            try:
+                with entry.open("rb") as fid:
+                    document = json.load(fid)
+                # the mtime of an entry records when it was last used
+                os.utime(entry)
+                if validator is not None and validator._precheck:
+                    validator._precheck(document)
+                return document
+            except (OSError, ValueError):
+                pass
+
+        with trace.span("parse", path=path):
+            document = yaml.load(data, Loader=Loader)
+        if validator is not None:
+            validator.validate(document)
+
+        if not usable:
+            return document
+        try:
+            text = json.dumps(document)
+        except (TypeError, ValueError):
+            return document
+        # e.g. yaml dates, or keys that are not strings, are not represented exactly
+        if json.loads(text) != document:
+            return document
+        try:
+            with tempfile.NamedTemporaryFile("w", dir=self.root, suffix=".tmp", delete=False) as fid:
+                fid.write(text)
+            os.replace(fid.name, entry)
+            self._prune()
+        except OSError as err:
+            root_logger.debug(f"unable to cache {path} in {self.root}: {err}")
+        return document
+
+
+def load_yaml(path: pathlib.Path, validator: Optional[SchemaValidator] = None):
+    """Load the yaml file path, and validate it if a validator is given.
+
+    The result is cached in the user cache dir, see DocumentCache.
+    """
+
+    return DocumentCache(user_cache_dir() / "yaml").load(path, validator)
+
+
 def check_config_version(instance):
     rversion = instance.get("version", 1)
     if rversion != 3:
@@ -121,3 +254,4 @@ EnvironmentsValidator = SchemaValidator(prefix / "schema/environments.json")
 CacheValidator = SchemaValidator(prefix / "schema/cache.json")
 ModulesValidator = SchemaValidator(prefix / "schema/modules.json", check_module_paths)
 MirrorsValidator = SchemaValidator(prefix / "schema/mirror.json")
+BatchValidator = SchemaValidator(prefix / "schema/batch.json")
@@ -0,0 +1,168 @@
+import contextlib
+import functools
+import itertools
+import json
+import os
+import pathlib
+import threading
+import time
+from typing import Dict, List
+
+
+class Tracer:
+    """Records named timing spans, for a Chrome trace and a summary of a run.
+
+    Spans are opened with span(), and nest per thread. Work that is not bound to
+    a thread (e.g. a tree that is copied by a pool of workers) is recorded with
+    add_async(). The trace written by write() can be opened in Perfetto
+    (ui.perfetto.dev) or chrome://tracing.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._start = time.perf_counter_ns()
+        self._events: List[Dict] = []
+        self._spans: List[Dict] = []
+        self._tids: Dict[int, int] = {}
+        self._async_ids = itertools.count(1)
+
+    def now(self) -> int:
+        """The time since the tracer was created in ns, for add_async()."""
+        return time.perf_counter_ns() - self._start
+
+    def _tid(self) -> int:
+        ident = threading.get_ident()
+        with self._lock:
+            if ident not in self._tids:
+                self._tids[ident] = len(self._tids) + 1
+                self._events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": os.getpid(),
+                        "tid": self._tids[ident],
+                        "args": {"name": threading.current_thread().name},
+                    }
+                )
+            return self._tids[ident]
+
+    @contextlib.contextmanager
+    def span(self, name: str, **args):
+        """Record the time spent in the context as a span called name.
+
+        The keyword arguments are attached to the span in the trace.
+        """
+
+        stack = self._local.__dict__.setdefault("stack", [])
+        depth = len(stack)
+        stack.append(name)
+        start = self.now()
+        try:
+            yield
+        finally:
+            end = self.now()
+            stack.pop()
+            event = {
+                "name": name,
+                "cat": "stackinator",
+                "ph": "X",
+                "ts": start / 1000,
+                "dur": (end - start) / 1000,
+                "pid": os.getpid(),
+                "tid": self._tid(),
+            }
+            if args:
+                event["args"] = {k: str(v) for k, v in args.items()}
+            with self._lock:
+                self._events.append(event)
+                self._spans.append({"name": name, "start": start, "duration": end - start, "depth": depth})
+
+    def context(self) -> List[str]:
+        """The names of the spans that are open in this thread, see attach()."""
+        return list(self._local.__dict__.get("stack", []))
+
+    @contextlib.contextmanager
+    def attach(self, context: List[str]):
+        """Nest the spans of a worker thread inside the spans that were open when
+        context() was called in the thread that submitted the work."""
+
+        saved = self._local.__dict__.get("stack", [])
+        self._local.stack = list(context)
+        try:
+            yield
+        finally:
+            self._local.stack = saved
+
+    def add_async(self, name: str, start: int, end: int, **args):
+        """Record a span that started and ended at the given times, see now()."""
+
+        common = {"name": name, "cat": "stackinator", "pid": os.getpid(), "tid": self._tid()}
+        with self._lock:
+            aid = next(self._async_ids)
+            args = {k: str(v) for k, v in args.items()}
+            self._events.append(dict(common, ph="b", id=aid, ts=start / 1000, args=args))
+            self._events.append(dict(common, ph="e", id=aid, ts=end / 1000))
+
+    def write(self, path: pathlib.Path):
+        """Write the trace in the Chrome trace event format."""
+
+        with self._lock:
+            events = list(self._events)
+        with open(path, "w") as fid:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fid)
+
+    def totals(self, max_depth: int = 1) -> Dict[tuple, List[int]]:
+        """The number of spans and their total duration in ns, per (depth, name),
+        up to a nesting depth of max_depth, in the order that they first started."""
+
+        totals: Dict[tuple, List[int]] = {}
+        with self._lock:
+            spans = sorted(self._spans, key=lambda s: s["start"])
+        for s in spans:
+            if s["depth"] > max_depth:
+                continue
+            entry = totals.setdefault((s["depth"], s["name"]), [0, 0])
+            entry[0] += 1
+            entry[1] += s["duration"]
+        return totals
+
+    def summary(self, max_depth: int = 1) -> List[str]:
+        """A table of the time spent in each span, up to a nesting depth of max_depth.
+
+        Spans with the same name are combined, and listed in the order that they
+        first started.
+        """
+
+        totals = self.totals(max_depth)
+        if not totals:
+            return []
+        width = max(2 * depth + len(name) for depth, name in totals)
+        lines = [f"{'phase':<{width}}  {'count':>5}  {'time':>8}"]
+        for (depth, name), (count, duration) in totals.items():
+            label = "  " * depth + name
+            lines.append(f"{label:<{width}}  {count:>5}  {duration / 1e9:7.2f}s")
+        return lines
+
+
+# the tracer of the running stack-config
+tracer = Tracer()
+
+
+def span(name: str, **args):
+    """Record the time spent in the context in the global tracer, see Tracer.span()."""
+    return tracer.span(name, **args)
+
+
+def traced(name: str):
+    """Decorator that records every call of a function as a span called name."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,9 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def user_cache_dir(tmp_path_factory, monkeypatch):
+    """Keep the caches that stackinator writes in the user cache dir out of the home of the user."""
+    path = tmp_path_factory.mktemp("cache")
+    monkeypatch.setenv("STACKINATOR_CACHE_DIR", str(path))
+    return path
@@ -0,0 +1,134 @@
+import importlib.util
+import json
+import pathlib
+import subprocess
+import sys
+import textwrap
+
+script = pathlib.Path(__file__).parent.parent / "stackinator" / "etc" / "autopush.py"
+
+
+def write_database(path, packages):
+    """Write a spack database with the (hash, name, version) packages as installed."""
+    installs = {
+        dag_hash: {"spec": {"name": name, "version": version}, "installed": True}
+        for dag_hash, name, version in packages
+    }
+    installs["ext"] = {"spec": {"name": "slurm", "version": "23", "external": {"path": "/usr"}}, "installed": True}
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps({"database": {"version": "8", "installs": installs}}))
+    tmp.replace(path)
+
+
+def test_autopush(tmp_path):
+    """Packages are pushed while the install runs, except the excluded ones."""
+    database = tmp_path / "index.json"
+    pushes = tmp_path / "pushes"
+
+    # a fake spack, that records the packages that it pushes
+    spack = tmp_path / "spack"
+    spack.write_text(
+        textwrap.dedent(
+            f"""\
+            #!/bin/sh
+            shift 2
+            echo "$@" >> {pushes}
+            echo "gpg: signing"
+            """
+        )
+    )
+    spack.chmod(0o755)
+
+    # an install that installs a package, waits for it to be pushed, then installs the others and fails
+    install = tmp_path / "install.py"
+    install.write_text(
+        textwrap.dedent(
+            f"""\
+            import json, pathlib, sys, time
+            sys.path.insert(0, {str(pathlib.Path(__file__).parent)!r})
+            from test_autopush import write_database
+            database = pathlib.Path({str(database)!r})
+            write_database(database, [("aaa", "zlib", "1.3")])
+            deadline = time.time() + 30
+            while not pathlib.Path({str(pushes)!r}).exists() and time.time() < deadline:
+                time.sleep(0.05)
+            write_database(database, [
+                ("aaa", "zlib", "1.3"), ("bbb", "cuda", "12.4"), ("ccc", "arbor", "git.abc=0.10"), ("ddd", "fmt", "11"),
+            ])
+            sys.exit(3)
+            """
+        )
+    )
+
+    gpg_log = tmp_path / "gpg.log"
+    result = subprocess.run(
+        [sys.executable, script, "--spack", str(spack), "--env", "env", "--mirror", "cache"]
+        + ["--database", str(database), "--exclude", "nvhpc,cuda,perl", "--interval", "0.1"]
+        + ["--gpg-log", str(gpg_log), "--", sys.executable, str(install)],
+        capture_output=True,
+        text=True,
+    )
+
+    # the exit code of the install is returned, after the last push
+    assert result.returncode == 3
+    assert pushes.read_text().splitlines() == [
+        "buildcache create --only=package cache /aaa",
+        "buildcache create --only=package cache /ddd",
+    ]
+    assert "pushed 2 packages to cache" in result.stdout
+    assert "gpg:" not in result.stdout
+    assert gpg_log.read_text() == "gpg: signing\ngpg: signing\n"
+
+
+def test_autopush_unsigned(tmp_path):
+    """The packages are pushed to a build cache that is not signed with --unsigned."""
+    database = tmp_path / "index.json"
+    pushes = tmp_path / "pushes"
+    spack = tmp_path / "spack"
+    spack.write_text(f'#!/bin/sh\nshift 2\necho "$@" >> {pushes}\n')
+    spack.chmod(0o755)
+    install = f"import sys; sys.path.insert(0, {str(pathlib.Path(__file__).parent)!r}); import test_autopush, pathlib; "
+    install += f"test_autopush.write_database(pathlib.Path({str(database)!r}), [('aaa', 'zlib', '1.3')])"
+
+    result = subprocess.run(
+        [sys.executable, script, "--spack", str(spack), "--env", "env", "--mirror", "cache"]
+        + ["--database", str(database), "--unsigned", "--", sys.executable, "-c", install],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    assert pushes.read_text().splitlines() == ["buildcache create --only=package --unsigned cache /aaa"]
+
+
+def test_installed_packages(tmp_path):
+    """The packages installed before the install started, or from a build cache, are not pushed."""
+    spec = importlib.util.spec_from_file_location("autopush", script)
+    autopush = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(autopush)
+
+    binary = tmp_path / "zlib-binary"
+    (binary / ".spack").mkdir(parents=True)
+    (binary / ".spack" / "binary_distribution").touch()
+    built = tmp_path / "fmt-built"
+    (built / ".spack").mkdir(parents=True)
+    database = tmp_path / "index.json"
+    database.write_text(
+        json.dumps(
+            {
+                "database": {
+                    "installs": {
+                        "old": {"spec": {"name": "cmake", "version": "3"}, "installed": True, "installation_time": 10},
+                        "bin": {"spec": {"name": "zlib", "version": "1"}, "installed": True, "path": str(binary)},
+                        "new": {
+                            "spec": {"name": "fmt", "version": "11"},
+                            "installed": True,
+                            "installation_time": 30,
+                            "path": str(built),
+                        },
+                    }
+                }
+            }
+        )
+    )
+    assert autopush.installed_packages(database, since=20) == [("new", "fmt", "11")]
+    assert autopush.installed_packages(database) == [("old", "cmake", "3"), ("new", "fmt", "11")]
@@ -0,0 +1,53 @@
+import argparse
+import pathlib
+import shutil
+
+import pytest
+
+from stackinator import batch
+
+RECIPES = pathlib.Path(__file__).parent / "recipes"
+
+
+@pytest.fixture
+def matrix_path(tmp_path):
+    """A matrix of one valid and one invalid recipe, for two systems."""
+    shutil.copytree(RECIPES / "host-recipe", tmp_path / "recipes" / "host")
+    shutil.copytree(RECIPES / "host-recipe", tmp_path / "recipes" / "broken")
+    (tmp_path / "recipes" / "broken" / "environments.yaml").write_text("gcc-env:\n  compiler: 3\n")
+    for name in ("daint", "clariden"):
+        (tmp_path / "systems" / name).mkdir(parents=True)
+        (tmp_path / "systems" / name / "packages.yaml").write_text(
+            "packages:\n  gcc:\n    externals:\n    - spec: gcc@12\n      prefix: /usr\n"
+        )
+        (tmp_path / "systems" / name / "network.yaml").write_text("mpi:\n  cray-mpich:\n    specs: [libfabric]\n")
+    matrix = tmp_path / "matrix.yaml"
+    matrix.write_text(
+        "recipes: [recipes/host, recipes/broken]\n"
+        "systems: [systems/daint, systems/clariden]\n"
+        "exclude:\n"
+        "  - {recipe: broken, system: systems/clariden}\n"
+    )
+    return matrix
+
+
+def test_load_matrix(matrix_path):
+    jobs = batch.load_matrix(matrix_path)
+    assert [job["name"] for job in jobs] == ["host@daint", "host@clariden", "broken@daint"]
+    assert jobs[0]["recipe"] == matrix_path.parent / "recipes" / "host"
+    assert jobs[0]["system"] == matrix_path.parent / "systems" / "daint"
+
+
+def test_run_job(matrix_path, tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, "_log_path", tmp_path)
+    options = argparse.Namespace(
+        mount=str(tmp_path), mirror=None, develop=False, no_bwrap=False, jobs=1, configure=None, git_cache=None
+    )
+    batch.warm(batch.load_matrix(matrix_path), None, 1)
+    good, _, broken = (batch.run_job(job, options) for job in batch.load_matrix(matrix_path))
+
+    assert good["status"] == "pass" and good["error"] is None
+    assert [p["name"] for p in good["phases"] if p["depth"] == 0] == ["recipe", "spack.yaml"]
+    assert broken["status"] == "fail"
+    assert "environments.yaml" in pathlib.Path(broken["log"]).read_text()
+    assert broken["error"].startswith("ValidationError")
@@ -0,0 +1,420 @@
+import logging
+import os
+import pathlib
+import shutil
+import stat
+import subprocess
+import sys
+
+import pytest
+
+from stackinator.builder import BuildOutputs, Builder, _makefile_recipes, _write_outputs, install
+from stackinator.cache import GitCache
+
+
+@pytest.fixture
+def build_path(tmp_path):
+    path = tmp_path / "build"
+    path.mkdir()
+    return path
+
+
+def make_package_tree(root, packages=3):
+    for i in range(packages):
+        pkg = root / "packages" / f"pkg{i}"
+        pkg.mkdir(parents=True)
+        (pkg / "package.py").write_text(f"# package {i}\n")
+        (pkg / "fix.patch").write_text("patch\n")
+    script = root / "packages" / "pkg0" / "build.sh"
+    script.write_text("#!/bin/sh\n")
+    script.chmod(0o700)
+    (root / "packages" / "pkg1" / "package.py").chmod(0o600)
+    (root / ".git").mkdir()
+    (root / ".git" / "HEAD").write_text("ref\n")
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+@pytest.mark.parametrize("link", [False, True])
+def test_install_tree(tmp_path, jobs, link):
+    """A tree is copied with a+rX permissions, mtimes, and the ignored entries left out."""
+    src = tmp_path / "src"
+    make_package_tree(src)
+    dst = tmp_path / "store" / "repo"
+
+    install(src, dst, ignore=shutil.ignore_patterns(".git"), link=link, jobs=jobs)
+
+    assert not (dst / ".git").exists()
+    for path in src.rglob("*"):
+        if ".git" in path.parts:
+            continue
+        copy = dst / path.relative_to(src)
+        if path.is_file():
+            assert copy.read_text() == path.read_text()
+            assert copy.stat().st_mtime_ns == path.stat().st_mtime_ns
+            assert copy.stat().st_mode & 0o444 == 0o444
+    assert stat.S_IMODE((dst / "packages" / "pkg0" / "build.sh").stat().st_mode) == 0o755
+    assert stat.S_IMODE((dst / "packages" / "pkg1" / "package.py").stat().st_mode) == 0o644
+    assert stat.S_IMODE((dst / "packages").stat().st_mode) & 0o555 == 0o555
+
+    # only files whose permissions are unchanged are hard linked, so that src is never modified
+    package = pathlib.Path("packages", "pkg2", "package.py")
+    assert ((dst / package).stat().st_ino == (src / package).stat().st_ino) == link
+    assert stat.S_IMODE((src / "packages" / "pkg1" / "package.py").stat().st_mode) == 0o600
+
+
+def test_install_file(tmp_path):
+    src = tmp_path / "script"
+    src.write_text("#!/bin/sh\n")
+    src.chmod(0o700)
+    install(src, tmp_path / "copy")
+    assert (tmp_path / "copy").read_text() == "#!/bin/sh\n"
+    assert stat.S_IMODE((tmp_path / "copy").stat().st_mode) == 0o755
+
+
+def make_outputs(build_path):
+    return BuildOutputs(build_path / BuildOutputs.MANIFEST)
+
+
+def test_outputs_written(build_path):
+    """Files, executables, trees and directories are all written on the first pass."""
+    src = build_path.parent / "src"
+    (src / "sub").mkdir(parents=True)
+    (src / "sub" / "package.py").write_text("pass\n")
+
+    outputs = make_outputs(build_path)
+    outputs.add_file(build_path / "Makefile", "all:\n")
+    outputs.add_file(build_path / "sandbox", "#!/bin/sh\n", executable=True)
+    outputs.add_tree(src, build_path / "repo")
+    outputs.add_dir(build_path / "empty")
+    stats = outputs.write()
+
+    assert stats == {"written": 3, "unchanged": 0, "removed": 0}
+    assert (build_path / "Makefile").read_text() == "all:\n"
+    assert os.access(build_path / "sandbox", os.X_OK)
+    assert (build_path / "repo" / "sub" / "package.py").read_text() == "pass\n"
+    assert (build_path / "empty").is_dir()
+    assert (build_path / BuildOutputs.MANIFEST).is_file()
+
+
+def test_unchanged_outputs_keep_mtime(build_path):
+    """Re-generating identical outputs does not touch the files on disk."""
+    src = build_path.parent / "src"
+    src.mkdir()
+    (src / "package.py").write_text("pass\n")
+
+    def generate(makefile):
+        outputs = make_outputs(build_path)
+        outputs.add_file(build_path / "Makefile", makefile)
+        outputs.add_file(build_path / "env" / "spack.yaml", "spack: {}\n")
+        outputs.add_tree(src, build_path / "repo")
+        return outputs.write()
+
+    generate("all:\n")
+    spack_yaml = build_path / "env" / "spack.yaml"
+    os.utime(spack_yaml, ns=(0, 0))
+    os.utime(build_path / "repo" / "package.py", ns=(0, 0))
+
+    stats = generate("all: store.squashfs\n")
+    assert stats == {"written": 1, "unchanged": 2, "removed": 0}
+    assert (build_path / "Makefile").read_text() == "all: store.squashfs\n"
+    assert spack_yaml.stat().st_mtime_ns == 0
+    assert (build_path / "repo" / "package.py").stat().st_mtime_ns == 0
+
+
+def test_changed_tree_is_reinstalled(build_path):
+    """A tree is copied again when a file in its source changes."""
+    src = build_path.parent / "src"
+    src.mkdir()
+    (src / "package.py").write_text("pass\n")
+    (src / "old.patch").write_text("")
+
+    outputs = make_outputs(build_path)
+    outputs.add_tree(src, build_path / "repo")
+    outputs.write()
+
+    (src / "package.py").write_text("version = 2\n")
+    (src / "old.patch").unlink()
+    outputs = make_outputs(build_path)
+    outputs.add_tree(src, build_path / "repo")
+    assert outputs.write()["written"] == 1
+    assert (build_path / "repo" / "package.py").read_text() == "version = 2\n"
+    assert not (build_path / "repo" / "old.patch").exists()
+
+
+def test_stale_outputs_removed(build_path):
+    """Outputs of a previous run that are no longer generated are removed."""
+    src = build_path.parent / "src"
+    src.mkdir()
+    (src / "package.py").write_text("pass\n")
+
+    outputs = make_outputs(build_path)
+    outputs.add_file(build_path / "Makefile", "all:\n")
+    outputs.add_file(build_path / "store" / "post-install-hook", "#!/bin/sh\n", executable=True)
+    outputs.add_tree(src, build_path / "packages" / "removed")
+    outputs.write()
+
+    outputs = make_outputs(build_path)
+    outputs.add_file(build_path / "Makefile", "all:\n")
+    stats = outputs.write()
+
+    assert stats == {"written": 0, "unchanged": 1, "removed": 2}
+    assert not (build_path / "store" / "post-install-hook").exists()
+    assert not (build_path / "packages" / "removed").exists()
+
+
+def test_tree_replaced_by_dir(build_path):
+    """The extra files of a recipe that are removed leave an empty meta/extra, as they are configured again."""
+    extra = build_path.parent / "extra"
+    extra.mkdir()
+    (extra / "notes.md").write_text("notes\n")
+    meta_extra = build_path / "store" / "meta" / "extra"
+
+    outputs = make_outputs(build_path)
+    outputs.add_tree(extra, meta_extra)
+    outputs.write()
+    assert (meta_extra / "notes.md").is_file()
+
+    for _ in range(2):
+        outputs = make_outputs(build_path)
+        outputs.add_dir(meta_extra)
+        outputs.write()
+        assert meta_extra.is_dir()
+        assert list(meta_extra.iterdir()) == []
+
+    outputs = make_outputs(build_path)
+    assert outputs.write()["removed"] == 1
+    assert not meta_extra.exists()
+
+
+def test_pruned_repos_are_kept(build_path):
+    """The packages pruned by the build are not installed again until the inputs of prune-repos change."""
+    src = build_path.parent / "src"
+    for name in ("zlib", "unused"):
+        (src / name).mkdir(parents=True)
+        (src / name / "package.py").write_text("pass\n")
+    repos = build_path / "store" / "repos"
+    packages = repos / "spack_repo" / "alps" / "packages"
+
+    def configure(digest):
+        outputs = make_outputs(build_path)
+        outputs.add_file(build_path / "fingerprints" / "prune-repos", digest + "\n")
+        for name in ("zlib", "unused"):
+            outputs.add_tree(src / name, packages / name)
+        return _write_outputs(outputs, build_path, repos, digest)
+
+    configure("a")
+    # the build prunes the package that is not in the environment
+    lock = build_path / "spack.lock"
+    lock.write_text('{"concrete_specs": {"hash": {"name": "zlib"}}}')
+    marker = build_path / "repos-pruned"
+    prune = pathlib.Path(__file__).parent.parent / "stackinator" / "etc" / "prune-repos.py"
+    subprocess.run([sys.executable, prune, "--pruned", marker, lock, repos / "spack_repo"], check=True)
+    assert marker.exists() and not (packages / "unused").exists()
+
+    # an unchanged configure leaves the repos as they were pruned
+    assert configure("a") == {"written": 0, "unchanged": 3, "removed": 0}
+    assert marker.exists() and not (packages / "unused").exists()
+    assert (packages / "zlib" / "package.py").is_file()
+
+    # the repos are installed again in full when the inputs of prune-repos change
+    assert configure("b")["written"] == 3
+    assert not marker.exists()
+    assert (packages / "unused" / "package.py").is_file()
+
+
+def test_file_edited_on_disk_is_restored(build_path):
+    """A generated file that was modified by hand is rewritten."""
+    outputs = make_outputs(build_path)
+    outputs.add_file(build_path / "Make.user", "NJOBS ?= 32\n")
+    outputs.write()
+
+    pathlib.Path(build_path / "Make.user").write_text("NJOBS ?= 64\n")
+    outputs = make_outputs(build_path)
+    outputs.add_file(build_path / "Make.user", "NJOBS ?= 32\n")
+    assert outputs.write()["written"] == 1
+    assert (build_path / "Make.user").read_text() == "NJOBS ?= 32\n"
+
+
+def test_fingerprint(build_path):
+    """A fingerprint only changes with the outputs below its paths and its values."""
+    src = build_path.parent / "src"
+    src.mkdir()
+    (src / "package.py").write_text("pass\n")
+
+    def fingerprint(modules_yaml, spack_yaml="spack: {}\n", **values):
+        outputs = make_outputs(build_path)
+        outputs.add_file(build_path / "modules" / "modules.yaml", modules_yaml)
+        outputs.add_file(build_path / "env" / "spack.yaml", spack_yaml)
+        outputs.add_tree(src, build_path / "modules" / "repo")
+        return outputs.fingerprint(build_path / "modules", **values)
+
+    reference = fingerprint("modules: {}\n", commit="abc")
+    assert fingerprint("modules: {}\n", spack_yaml="spack: {specs: []}\n", commit="abc") == reference
+    assert fingerprint("modules: {tcl: {}}\n", commit="abc") != reference
+    assert fingerprint("modules: {}\n", commit="def") != reference
+
+    (src / "package.py").write_text("version = 2\n")
+    assert fingerprint("modules: {}\n", commit="abc") != reference
+
+
+def test_digest(tmp_path):
+    """The key of an image does not depend on the build path, or on the mtimes of the sources."""
+    recipe = tmp_path / "recipe"
+    recipe.mkdir()
+    (recipe / "environments.yaml").write_text("env: {}\n")
+    clone = tmp_path / "clone"
+    clone.mkdir()
+    (clone / "package.py").write_text("pass\n")
+
+    def digest(build_path, **values):
+        outputs = make_outputs(build_path)
+        outputs.add_file(build_path / "Make.user", f"BUILD_ROOT := {build_path}\n")
+        outputs.add_file(build_path / "meta" / "configure.json", f'{{"time": "{os.urandom(4).hex()}"}}\n')
+        outputs.add_tree(recipe, build_path / "meta" / "recipe")
+        outputs.add_tree(clone, build_path / "repos" / "builtin", link=True)
+        return outputs.digest(exclude=(build_path / "meta" / "configure.json",), **values)
+
+    reference = digest(tmp_path / "build")
+    os.utime(recipe / "environments.yaml", ns=(0, 0))
+    assert digest(tmp_path / "other") == reference
+
+    # the content of linked trees is identified by the values, e.g. the commit of a clone
+    (clone / "package.py").write_text("version = 2\n")
+    assert digest(tmp_path / "build") == reference
+    assert digest(tmp_path / "build", commit="abc") != reference
+
+    (recipe / "environments.yaml").write_text("env: {specs: [zlib]}\n")
+    assert digest(tmp_path / "build") != reference
+
+
+def test_makefile_recipes():
+    recipes = _makefile_recipes(
+        "-include Make.user\n"
+        "NJOBS := 16\n"
+        "all: store.squashfs\n"
+        "\n"
+        "# a comment\n"
+        "env/spack.lock: mirror-setup fingerprints/concretize\n"
+        "\t$(SPACK) concretize\n"
+        "\n"
+        "views: view-default\n"
+        "\n"
+        "\ttouch views\n"
+    )
+    assert recipes == {"all": "", "env/spack.lock": "\t$(SPACK) concretize\n", "views": "\ttouch views\n"}
+
+
+def make_git_repo(path, content, files=None):
+    """Create a git repository with a single commit, and return the commit hash."""
+    path.mkdir(parents=True)
+    (path / "README").write_text(content)
+    for name, text in (files or {}).items():
+        (path / name).parent.mkdir(parents=True, exist_ok=True)
+        (path / name).write_text(text)
+    env = dict(
+        os.environ,
+        GIT_AUTHOR_NAME="test",
+        GIT_AUTHOR_EMAIL="test@example.com",
+        GIT_COMMITTER_NAME="test",
+        GIT_COMMITTER_EMAIL="test@example.com",
+    )
+
+    def git(*args):
+        return subprocess.run(["git", "-C", str(path), *args], check=True, env=env, capture_output=True, text=True)
+
+    git("init", "-q", "-b", "main")
+    git("config", "uploadpack.allowFilter", "true")
+    git("add", ".")
+    git("commit", "-q", "-m", "init")
+    return git("rev-parse", "HEAD").stdout.strip()
+
+
+def make_builder(build_path, jobs=2, git_cache=None):
+    """A Builder for build_path, bypassing the checks on the build path in __init__."""
+    builder = Builder.__new__(Builder)
+    builder._logger = logging.getLogger("test_builder")
+    builder.path = build_path
+    builder.jobs = jobs
+    builder.git_cache = GitCache(git_cache) if git_cache else None
+    return builder
+
+
+def test_git_clone_all(tmp_path, build_path):
+    """All repositories are cloned, and their commits are returned in order."""
+    spack = make_git_repo(tmp_path / "upstream" / "spack", "spack")
+    builtin = make_git_repo(tmp_path / "upstream" / "builtin", "builtin")
+
+    builder = make_builder(build_path)
+    commits = builder._git_clone_all(
+        [
+            ("spack", str(tmp_path / "upstream" / "spack"), "main", build_path / "spack"),
+            ("builtin", str(tmp_path / "upstream" / "builtin"), None, build_path / "repos" / "builtin"),
+        ]
+    )
+    assert commits == [spack, builtin]
+    assert (build_path / "repos" / "builtin" / "README").read_text() == "builtin"
+
+
+def test_git_clone_all_failure(tmp_path, build_path):
+    """A repository that can't be cloned raises an error."""
+    make_git_repo(tmp_path / "upstream" / "spack", "spack")
+
+    builder = make_builder(build_path)
+    with pytest.raises(subprocess.CalledProcessError):
+        builder._git_clone_all(
+            [
+                ("spack", str(tmp_path / "upstream" / "spack"), "main", build_path / "spack"),
+                ("missing", str(tmp_path / "upstream" / "missing"), None, build_path / "repos" / "missing"),
+            ]
+        )
+
+
+def test_git_clone_from_cache(tmp_path, build_path):
+    """Build paths are cloned from the git cache, with origin set to the upstream url."""
+    upstream = tmp_path / "upstream" / "spack"
+    commit = make_git_repo(upstream, "spack")
+
+    builder = make_builder(build_path, git_cache=tmp_path / "cache")
+    assert builder._git_clone_all([("spack", str(upstream), "main", build_path / "spack")]) == [commit]
+    assert builder.git_cache.mirror_path(str(upstream)).is_dir()
+
+    origin = subprocess.run(
+        ["git", "-C", str(build_path / "spack"), "remote", "get-url", "origin"], capture_output=True, text=True
+    )
+    assert origin.stdout.strip() == str(upstream)
+
+    # a second build path is cloned from the cache, even if upstream is gone
+    (upstream / ".git").rename(tmp_path / "moved.git")
+    other = tmp_path / "other"
+    other.mkdir()
+    builder = make_builder(other, git_cache=tmp_path / "cache")
+    assert builder._git_clone_all([("spack", str(upstream), commit, other / "spack")]) == [commit]
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_git_clone_sparse(tmp_path, build_path, cached):
+    """Only the sparse directory of a package repository is checked out, and no other blobs are fetched."""
+    upstream = tmp_path / "upstream" / "packages"
+    files = {
+        "repos/spack_repo/builtin/packages/zlib/package.py": "zlib",
+        "docs/index.md": "docs",
+    }
+    make_git_repo(upstream, "packages", files)
+
+    builder = make_builder(build_path, git_cache=tmp_path / "cache" if cached else None)
+    path = build_path / "repos" / "builtin"
+    builder._git_clone_all([("builtin", f"file://{upstream}", None, path, "repos/spack_repo/builtin")])
+    assert (path / "repos/spack_repo/builtin/packages/zlib/package.py").read_text() == "zlib"
+    assert not (path / "docs").exists()
+
+    if not cached:
+        missing = subprocess.run(
+            ["git", "-C", str(path), "rev-list", "--objects", "--all", "--missing=print"],
+            capture_output=True,
+            text=True,
+        ).stdout.splitlines()
+        assert len([line for line in missing if line.startswith("?")]) == 1
+
+    # reconfiguring without a sparse path checks out the whole repository
+    builder._git_clone_all([("builtin", f"file://{upstream}", "main", path)])
+    assert (path / "docs" / "index.md").read_text() == "docs"
@@ -0,0 +1,148 @@
+import os
+import pathlib
+import subprocess
+import sys
+
+import pytest
+
+from stackinator.cache import CacheError, GitCache, ImageCache, file_lock, parse_size
+
+
+def run(args):
+    return subprocess.run(["git"] + args, capture_output=True)
+
+
+def make_git_repo(path):
+    path.mkdir(parents=True)
+    (path / "README").write_text(path.name)
+    env = dict(
+        os.environ,
+        GIT_AUTHOR_NAME="test",
+        GIT_AUTHOR_EMAIL="test@example.com",
+        GIT_COMMITTER_NAME="test",
+        GIT_COMMITTER_EMAIL="test@example.com",
+    )
+    for args in (["init", "-q", "-b", "main"], ["add", "."], ["commit", "-q", "-m", "init"]):
+        subprocess.run(["git", "-C", str(path)] + args, check=True, env=env, capture_output=True)
+    return str(path)
+
+
+def test_parse_size():
+    assert parse_size("512") == 512
+    assert parse_size("1K") == 1024
+    assert parse_size("20G") == 20 * 1024**3
+    assert parse_size("1.5m") == 3 * 512 * 1024
+    assert parse_size("2GiB") == 2 * 1024**3
+    with pytest.raises(CacheError):
+        parse_size("lots")
+
+
+def test_mirror_path_keyed_by_url(tmp_path):
+    cache = GitCache(tmp_path)
+    a = cache.mirror_path("https://github.com/spack/spack.git")
+    b = cache.mirror_path("https://github.com/eth-cscs/spack.git")
+    assert a != b
+    assert a.name.startswith("spack-") and a.suffix == ".git"
+    assert a == cache.mirror_path("https://github.com/spack/spack.git")
+
+
+def test_mirror_created_and_reused(tmp_path):
+    url = make_git_repo(tmp_path / "upstream")
+    cache = GitCache(tmp_path / "cache")
+
+    with cache.mirror(url, "main", run) as mirror:
+        assert (mirror / "HEAD").is_file()
+    commit = run(["-C", str(mirror), "rev-parse", "main"]).stdout.decode().strip()
+
+    # a commit that is already in the mirror does not need the upstream
+    (tmp_path / "upstream").rename(tmp_path / "moved")
+    with cache.mirror(url, commit, run) as again:
+        assert again == mirror
+
+
+def test_prune_removes_least_recently_used(tmp_path):
+    cache = GitCache(tmp_path / "cache")
+    urls = [make_git_repo(tmp_path / name) for name in ("old", "new")]
+    for url in urls:
+        with cache.mirror(url, None, run):
+            pass
+    old, new = (cache.mirror_path(url) for url in urls)
+    os.utime(old.with_suffix(".lock"), (0, 0))
+
+    # the old mirror is skipped while it is in use
+    with file_lock(old.with_suffix(".lock"), shared=True):
+        assert cache.prune(0) == [new]
+    assert old.exists()
+
+    assert cache.prune(0) == [old]
+    assert cache.entries() == []
+
+
+def test_mirror_not_refreshed(tmp_path):
+    """With refresh=False, a branch that is already in the mirror is not fetched again."""
+    url = make_git_repo(tmp_path / "upstream")
+    with GitCache(tmp_path / "cache").mirror(url, "main", run) as mirror:
+        before = run(["-C", str(mirror), "rev-parse", "main"]).stdout
+    env = dict(
+        os.environ, GIT_AUTHOR_NAME="t", GIT_AUTHOR_EMAIL="t@t", GIT_COMMITTER_NAME="t", GIT_COMMITTER_EMAIL="t@t"
+    )
+    subprocess.run(["git", "-C", url, "commit", "-q", "--allow-empty", "-m", "next"], check=True, env=env)
+
+    with GitCache(tmp_path / "cache", refresh=False).mirror(url, "main", run):
+        assert run(["-C", str(mirror), "rev-parse", "main"]).stdout == before
+    with GitCache(tmp_path / "cache").mirror(url, "main", run):
+        assert run(["-C", str(mirror), "rev-parse", "main"]).stdout != before
+
+
+image_cache_script = pathlib.Path(__file__).parent.parent / "stackinator" / "etc" / "image-cache.py"
+
+
+def image_cache(*args):
+    return subprocess.run([sys.executable, image_cache_script, *map(str, args)], capture_output=True, text=True)
+
+
+def test_image_cache(tmp_path):
+    """Images are added to the cache by the build, looked up by stack-config, and restored by the build."""
+    cache = ImageCache(tmp_path / "images")
+    assert cache.lookup("key1") is None
+
+    image = tmp_path / "store.squashfs"
+    meta = tmp_path / "store" / "meta"
+    meta.mkdir(parents=True)
+    image.write_bytes(b"image 1")
+    (meta / "env.json").write_text("{}\n")
+    assert image_cache("store", cache.root, "key1", image, meta).returncode == 0
+    assert cache.lookup("key1") == cache.entry_path("key1")
+
+    image.unlink()
+    (meta / "env.json").unlink()
+    result = image_cache("restore", cache.root, "key1", image, meta)
+    assert result.returncode == 0, result.stderr
+    assert image.read_bytes() == b"image 1"
+    assert (meta / "env.json").read_text() == "{}\n"
+
+    result = image_cache("restore", cache.root, "key2", image, meta)
+    assert result.returncode == 1
+    assert "run stack-config again" in result.stderr
+    assert not cache._lock_path(cache.entry_path("key2")).exists()
+
+
+def test_image_cache_evicts_least_recently_used(tmp_path):
+    cache = ImageCache(tmp_path / "images")
+    image = tmp_path / "store.squashfs"
+    meta = tmp_path / "meta"
+    meta.mkdir()
+    image.write_bytes(b"x" * 100000)
+
+    assert image_cache("store", cache.root, "old", image, meta).returncode == 0
+    assert image_cache("store", cache.root, "used", image, meta).returncode == 0
+    os.utime(cache._lock_path(cache.entry_path("old")), (0, 0))
+    os.utime(cache._lock_path(cache.entry_path("used")), (1, 1))
+    # looking up an image marks it as used
+    cache.lookup("used")
+
+    size = cache.entries()[0][2]
+    assert image_cache("store", "--max-size", 2 * size, cache.root, "new", image, meta).returncode == 0
+    assert [entry.name for entry, _, _ in cache.entries()] == ["used.image", "new.image"]
+
+    assert cache.prune(0) == [cache.entry_path("used"), cache.entry_path("new")]
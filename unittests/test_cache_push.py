@@ -0,0 +1,44 @@
+import importlib.util
+import pathlib
+
+script = pathlib.Path(__file__).parent.parent / "stackinator" / "etc" / "cache-push.py"
+
+
+def load_script():
+    spec = importlib.util.spec_from_file_location("cache_push", script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Spec:
+    def __init__(self, name, version, dag_hash):
+        self.name = name
+        self.version = version
+        self._hash = dag_hash
+
+    def dag_hash(self):
+        return self._hash
+
+
+def test_select_missing():
+    """Only the packages that are not excluded and not in the build cache are pushed."""
+    cache_push = load_script()
+    specs = [
+        Spec("zlib", "1.3", "aaa"),
+        Spec("fmt", "11.0", "bbb"),
+        Spec("cuda", "12.4", "ccc"),
+        Spec("arbor", "git.abc=0.10", "ddd"),
+        Spec("boost", "1.86", "eee"),
+        # a spec that appears twice in the environment is only counted once
+        Spec("zlib", "1.3", "aaa"),
+    ]
+    missing, excluded, in_cache = cache_push.select_missing(specs, {"bbb", "ccc"}, {"nvhpc", "cuda", "perl"})
+    assert [spec.name for spec in missing] == ["boost", "zlib"]
+    assert excluded == 2
+    assert in_cache == 1
+
+    # packages with a git version are never pushed
+    missing, excluded, _ = cache_push.select_missing(specs, {"aaa", "bbb", "eee"}, set())
+    assert [spec.name for spec in missing] == ["cuda"]
+    assert excluded == 1
@@ -0,0 +1,236 @@
+import argparse
+import importlib.util
+import json
+import pathlib
+import random
+import re
+import shutil
+import subprocess
+
+import pytest
+
+script = pathlib.Path(__file__).parent.parent / "stackinator" / "etc" / "envvars.py"
+
+
+def load_script():
+    spec = importlib.util.spec_from_file_location("envvars", script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_environment(path, modifications):
+    ops = [{"op": op, "name": name, "value": value} for op, name, value in modifications]
+    path.write_text(json.dumps({"version": 2, "modifications": ops}))
+    return path
+
+
+def test_read_environment(tmp_path):
+    """Every modification made by the activation of a view, written by spack-query.py, is one update."""
+    envvars = load_script()
+    environment = write_environment(
+        tmp_path / "env.json",
+        [
+            ("set", "SPACK_ENV", "/build/env"),
+            ("prepend", "PATH", "/view/bin"),
+            ("prepend", "PATH", "/usr/bin"),
+            ("append", "PATH", "/opt/tools/bin"),
+            ("prepend", "MANPATH", "/view/share/man"),
+            ("set", "MANPATH", ""),
+            ("set", "GREETING", "it's a 'view'"),
+            ("unset", "OLD", None),
+            ("unset", "PYTHONPATH", None),
+            # a path variable that is not a known list variable
+            ("prepend", "XDG_DATA_DIRS", "/view/share"),
+        ],
+    )
+    assert envvars.read_environment(str(environment)).as_dict() == {
+        "list": {
+            # /usr/bin is ignored in PATH, and the current value of PATH is not part of the updates
+            "PATH": [
+                {"op": "prepend", "value": ["/view/bin"]},
+                {"op": "prepend", "value": []},
+                {"op": "append", "value": ["/opt/tools/bin"]},
+            ],
+            "MANPATH": [{"op": "prepend", "value": ["/view/share/man"]}, {"op": "set", "value": []}],
+            "PYTHONPATH": [{"op": "set", "value": []}],
+            "XDG_DATA_DIRS": [{"op": "prepend", "value": ["/view/share"]}],
+        },
+        "scalar": {"GREETING": "it's a 'view'", "OLD": None},
+    }
+
+
+def test_read_environment_version(tmp_path):
+    """The variables written by an older spack-query.py are not read."""
+    envvars = load_script()
+    environment = tmp_path / "env.json"
+    environment.write_text(json.dumps({"version": 1, "variables": {"PATH": "/view/bin:/usr/bin"}}))
+    with pytest.raises(envvars.EnvVarError, match="install-query"):
+        envvars.read_environment(str(environment))
+
+    write_environment(environment, [("remove", "PATH", "/view/bin")])
+    with pytest.raises(envvars.EnvVarError, match="remove"):
+        envvars.read_environment(str(environment))
+
+
+def unique(value):
+    """value, with the paths that occur more than once only kept the first time."""
+    if value is None:
+        return None
+    return ":".join(dict.fromkeys(value.split(":")))
+
+
+def test_compact():
+    """The compacted updates give the value of the updates without the repeated paths."""
+    envvars = load_script()
+    ops = list(envvars.EnvVarOp)
+    paths = [f"/view/{name}" for name in ("bin", "lib", "lib64", "share", "include")]
+    rng = random.Random(0)
+    for _ in range(2000):
+        var = None
+        for _ in range(rng.randint(1, 6)):
+            value = rng.sample(paths, rng.randint(0, 3))
+            op = rng.choice(ops)
+            if var is None:
+                var = envvars.ListEnvVar("PATH", value, op)
+            else:
+                var.update(value, op)
+        # compacting does not change the updates that are compared against
+        expected = {
+            (current, dirty): unique(var.get_value(current, dirty))
+            for current in (None, "", "/usr/bin:/bin")
+            for dirty in (False, True)
+        }
+
+        var.compact()
+        assert len(var.updates) <= 2
+        for (current, dirty), value in expected.items():
+            assert var.get_value(current, dirty) == value, (current, dirty)
+        assert var.clean_value == expected[(None, False)]
+
+
+def test_meta(tmp_path):
+    """meta/env.json has the compacted updates of the views, with the recipe updates, and their clean values."""
+    envvars = load_script()
+    view = tmp_path / "env" / "default"
+    view.mkdir(parents=True)
+    (tmp_path / "meta").mkdir()
+
+    prepend = [{"op": "prepend", "value": [f"/pkg/{i}/bin"]} for i in range(3)]
+    values = {"list": {"PATH": prepend + prepend, "CPATH": [{"op": "set", "value": []}]}, "scalar": {"CC": "gcc"}}
+    (view / "env.json").write_text(json.dumps({"version": 1, "values": values}))
+    recipe = {
+        "list": {"PATH": [{"op": "append", "value": ["/pkg/0/bin", "/extra/bin"]}]},
+        "scalar": {"CC": "clang"},
+    }
+    meta = {"views": {"default": {"root": str(view), "recipe_variables": recipe}}}
+    (tmp_path / "meta" / "env.json.in").write_text(json.dumps(meta))
+
+    args = argparse.Namespace(mount=str(tmp_path), modules=True, spack=None, spack_package_repo=None)
+    envvars.meta_impl(args)
+    meta = json.loads((tmp_path / "meta" / "env.json").read_text())
+
+    assert meta["views"]["default"]["env"] == {
+        "version": 2,
+        "values": {
+            "list": {
+                "PATH": [
+                    {"op": "prepend", "value": ["/pkg/2/bin", "/pkg/1/bin", "/pkg/0/bin"]},
+                    {"op": "append", "value": ["/extra/bin"]},
+                ],
+                "CPATH": [{"op": "set", "value": []}],
+            },
+            "scalar": {"CC": "clang"},
+        },
+        "clean": {"PATH": "/pkg/2/bin:/pkg/1/bin:/pkg/0/bin:/extra/bin", "CPATH": ""},
+    }
+    assert meta["views"]["modules"]["env"]["type"] == "augment"
+    assert meta["views"]["modules"]["env"]["clean"] == {"MODULEPATH": f"{tmp_path}/modules"}
+
+
+def activate(shell, script, deactivate, environment, names):
+    """The values of the variables names after the script is sourced in environment, and after deactivate."""
+    source = "." if shell in ("bash", "zsh") else "source"
+    printenv = "; ".join(f"printenv {name} || echo '<unset>'" for name in names)
+    command = f"{source} {script}; {source} {script}; {printenv}; {source} {deactivate}; {printenv}"
+    output = subprocess.run(
+        [shell, "-c", command], env=environment, check=True, capture_output=True, text=True
+    ).stdout.splitlines()
+    values = [None if value == "<unset>" else value for value in output]
+    return dict(zip(names, values[: len(names)])), dict(zip(names, values[len(names) :]))
+
+
+def test_activation_scripts_structure():
+    """The scripts start no processes, and the csh and fish blocks are balanced, without running the shells."""
+    envvars = load_script()
+    env = envvars.EnvVarSet()
+    env.set_list("PATH", ["/view/bin"], envvars.EnvVarOp.PREPEND)
+    env.set_list("PATH", ["/view/sbin"], envvars.EnvVarOp.APPEND)
+    env.set_list("MODULEPATH", [], envvars.EnvVarOp.SET)
+    env.set_scalar("CC", "gcc")
+    scripts = envvars.activation_scripts(env, "default")
+
+    for filename, script in scripts.items():
+        assert "`" not in script and "$(" not in script, filename
+        # the paths of the view are only compared by the shell
+        assert not re.search(r"\b(tr|sed|awk|echo|printf|cut)\b", script), filename
+
+    def words(script, first):
+        return [line.split()[0] for line in script.splitlines() if line.split() and line.split()[0] in first]
+
+    for filename in ("activate.csh", "deactivate.csh"):
+        blocks = words(scripts[filename], ("if", "endif", "foreach", "end"))
+        opened = [line for line in scripts[filename].splitlines() if re.match(r"\s*if \(.*\) then$", line)]
+        assert len(opened) == blocks.count("endif"), filename
+        assert blocks.count("foreach") == blocks.count("end"), filename
+    assert "foreach _uenv_path ( ${_uenv_rest:gs/:/ /} '/view/sbin' )" in scripts["activate.csh"]
+
+    for filename in ("activate.fish", "deactivate.fish"):
+        blocks = words(scripts[filename], ("if", "for", "end"))
+        assert blocks.count("if") + blocks.count("for") == blocks.count("end"), filename
+
+
+@pytest.mark.parametrize("shell,extension", [("bash", "bash"), ("zsh", "zsh"), ("fish", "fish"), ("tcsh", "csh")])
+def test_activation_scripts(tmp_path, shell, extension):
+    """The script sets the deduplicated values of the updates, and the deactivation restores the variables."""
+    if shutil.which(shell) is None:
+        pytest.skip(f"requires {shell}")
+    envvars = load_script()
+    env = envvars.EnvVarSet()
+    env.set_list("PATH", ["/view/bin", "/usr/bin"], envvars.EnvVarOp.PREPEND)
+    env.set_list("PATH", ["/view/sbin"], envvars.EnvVarOp.APPEND)
+    env.set_list("MANPATH", ["/view/share/man"], envvars.EnvVarOp.PREPEND)
+    env.set_list("MODULEPATH", ["/old/modules"], envvars.EnvVarOp.PREPEND)
+    env.set_list("MODULEPATH", [], envvars.EnvVarOp.SET)
+    env.set_list("MODULEPATH", ["/view/modules"], envvars.EnvVarOp.PREPEND)
+    env.set_scalar("CC", "it's gcc")
+    env.set_scalar("CUDA_HOME", None)
+    names = ["PATH", "MANPATH", "MODULEPATH", "CC", "CUDA_HOME"]
+    environments = [
+        {"PATH": "/usr/bin:/view/sbin:/bin", "MANPATH": "", "MODULEPATH": "/site/modules", "CUDA_HOME": "/cuda"},
+        {"PATH": "/usr/bin:/bin"},
+    ]
+    # the values of the updates, before they are compacted
+    expected = [
+        {name: unique(var.get_value(environment.get(name))) for name, var in env.lists.items()}
+        for environment in environments
+    ]
+
+    scripts = envvars.activation_scripts(env, "default-view")
+    assert sorted(scripts) == [
+        f"{a}.{shell}" for a in ("activate", "deactivate") for shell in ("bash", "csh", "fish", "zsh")
+    ]
+    assert scripts["activate.bash"] == scripts["activate.zsh"]
+    for filename, script in scripts.items():
+        (tmp_path / filename).write_text(script)
+
+    for environment, values in zip(environments, expected):
+        active, inactive = activate(
+            shell, tmp_path / f"activate.{extension}", tmp_path / f"deactivate.{extension}", environment, names
+        )
+        for name in ("PATH", "MANPATH", "MODULEPATH"):
+            assert active[name] == values[name], name
+        assert active["CC"] == "it's gcc"
+        assert active["CUDA_HOME"] is None
+        assert inactive == {name: environment.get(name) for name in names}
+    assert active["PATH"] == "/view/bin:/usr/bin:/bin:/view/sbin"
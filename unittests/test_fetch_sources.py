@@ -0,0 +1,34 @@
+import importlib.util
+import pathlib
+
+script = pathlib.Path(__file__).parent.parent / "stackinator" / "etc" / "fetch-sources.py"
+
+
+def load_script():
+    spec = importlib.util.spec_from_file_location("fetch_sources", script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_batches():
+    fetch_sources = load_script()
+    assert fetch_sources.batches([], 8) == []
+    # small environments get one package per batch
+    assert fetch_sources.batches(list(range(5)), 8) == [[0], [1], [2], [3], [4]]
+    # about four batches per job
+    batches = fetch_sources.batches(list(range(100)), 4)
+    assert len(batches) == 15
+    assert sum(batches, []) == list(range(100))
+
+
+def test_count_hits():
+    fetch_sources = load_script()
+    output = "\n".join(
+        [
+            "==> Using cached archive: /scratch/sources/_source-cache/archive/ab/ab12.tar.gz",
+            "==> Fetching https://mirror.example.com/zlib-1.3.tar.gz",
+            "==> Using cached archive: /scratch/sources/_source-cache/archive/cd/cd34.tar.gz",
+        ]
+    )
+    assert fetch_sources.count_hits(output) == 2
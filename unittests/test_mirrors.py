@@ -225,6 +225,13 @@ def test_spack_mirrors_yaml(tmp_path, clean_root, mount_path, mirror_ok):
 
     valid_spack_yaml = {
         "mirrors": {
+            # the local mirror of prefetched binaries comes before the build cache
+            "buildcache-prefetch": {
+                "source": False,
+                "binary": True,
+                "fetch": {"url": f"file://{tmp_path}/prefetch"},
+                "push": {"url": f"file://{tmp_path}/prefetch"},
+            },
             "buildcache": {
                 "source": False,
                 "binary": True,
@@ -251,6 +258,7 @@ def test_spack_mirrors_yaml(tmp_path, clean_root, mount_path, mirror_ok):
     data = yaml.safe_load(files[tmp_path / "mirrors.yaml"])
 
     assert data == valid_spack_yaml
+    assert list(data["mirrors"]) == ["buildcache-prefetch", "buildcache", "mirror1", "mirror2"]
 
 
 def test_mount_specific_buildcache(tmp_path, clean_root, mount_path, mirror_ok):
@@ -505,3 +513,66 @@ def test_bad_config(clean_root, mount_path, systems_path, system_name):
 
     with pytest.raises(mirror.MirrorError):
         mirror.Mirrors(clean_root, mount_path, Version(1, 1), mirror_file=systems_path / system_name / "mirrors.yaml")
+
+
+def test_autopush_buildcache(tmp_path, clean_root, mount_path, test_path):
+    """autopush on a build cache with a signing key is handled by the Makefile, not passed to spack."""
+
+    mirror_file = tmp_path / "mirrors.yaml"
+    mirror_file.write_text(
+        "buildcache:\n"
+        "  url: file:///scratch/cache\n"
+        f"  private_key: {test_path / 'data' / 'test-gpg-priv.asc'}\n"
+        "  autopush: true\n"
+        "  signed: true\n"
+    )
+    mirrors_obj = mirror.Mirrors(clean_root, mount_path, Version(1, 1), mirror_file=mirror_file)
+    assert mirrors_obj.autopush_to_build_cache == "buildcache"
+
+    # spack itself must not push, because it would also push the excluded packages
+    data = yaml.safe_load(mirrors_obj.config_files(tmp_path / "config")[tmp_path / "config" / "mirrors.yaml"])
+    assert "autopush" not in data["mirrors"]["buildcache"]
+    assert data["mirrors"]["buildcache"]["signed"] is True
+
+
+def test_autopush_without_key(tmp_path, clean_root, mount_path, mirror_ok):
+    """autopush needs a build cache that is pushed to."""
+
+    mirror_file = tmp_path / "mirrors.yaml"
+    mirror_file.write_text("buildcache:\n  url: file:///scratch/cache\n  autopush: true\n")
+    with pytest.raises(mirror.MirrorError, match="autopush"):
+        mirror.Mirrors(clean_root, mount_path, Version(1, 1), mirror_file=mirror_file)
+
+    # an unsigned build cache is pushed to without a key
+    mirror_file.write_text("buildcache:\n  url: file:///scratch/cache\n  autopush: true\n  signed: false\n")
+    mirrors_obj = mirror.Mirrors(clean_root, mount_path, Version(1, 1), mirror_file=mirror_file)
+    assert mirrors_obj.autopush_to_build_cache == "buildcache"
+    assert mirrors_obj.push_to_build_cache == "buildcache"
+    assert not mirrors_obj.sign_build_cache
+
+    # autopush is off by default
+    mirrors_obj = mirror.Mirrors(clean_root, mount_path, Version(1, 1), mirror_file=mirror_ok)
+    assert mirrors_obj.push_to_build_cache == "buildcache"
+    assert mirrors_obj.autopush_to_build_cache is None
+    assert mirrors_obj.sign_build_cache
+
+
+def test_prefetch_mirror(tmp_path, clean_root, mount_path, systems_path):
+    """The binaries are prefetched from the fetch url of the build cache, which is mount specific."""
+
+    mirror_file = tmp_path / "mirrors.yaml"
+    mirror_file.write_text("buildcache:\n  url: file:///scratch/cache\n  mount_specific: true\n  signed: false\n")
+    mirrors_obj = mirror.Mirrors(clean_root, mount_path, Version(1, 1), mirror_file=mirror_file)
+    assert mirrors_obj.prefetch_mirror(tmp_path / "config") == {
+        "name": "buildcache-prefetch",
+        "path": tmp_path / "config" / "prefetch",
+        "url": "file:///scratch/cache/user-environment",
+    }
+
+    # the prefetched binaries are verified like those of the build cache
+    data = yaml.safe_load(mirrors_obj.config_files(tmp_path / "config")[tmp_path / "config" / "mirrors.yaml"])
+    assert data["mirrors"]["buildcache-prefetch"]["signed"] is False
+
+    # there is nothing to prefetch without a build cache
+    mirrors_obj = mirror.Mirrors(clean_root, mount_path, Version(1, 1))
+    assert mirrors_obj.prefetch_mirror(tmp_path / "config") is None
@@ -0,0 +1,211 @@
+import json
+import re
+import shutil
+
+import pytest
+
+from stackinator import pipeline, render
+
+pytestmark = pytest.mark.skipif(shutil.which("make") is None, reason="requires make")
+
+
+def render_makefile(views, module_types, compiler_views=(), image_cache=None):
+    environments = {
+        "env": {
+            "views": [
+                {"name": view, "extra": {"prefix_string": "", "add_compilers": view in compiler_views}}
+                for view in views
+            ],
+            "compiler": ["gcc"],
+        }
+    }
+    return (
+        render.environment()
+        .get_template("Makefile")
+        .render(
+            modules=bool(module_types),
+            module_types=module_types,
+            environments=environments,
+            spack_meta={"url": "", "ref": "", "commit": "", "packages": []},
+            gpg_keys=[],
+            exclude_from_cache=[],
+            cleanup=None,
+            compiler_names=["gcc"],
+            add_compilers=bool(compiler_views),
+            image_cache=image_cache,
+        )
+    )
+
+
+@pytest.mark.parametrize(
+    "views,module_types,compiler_views",
+    [([], [], []), (["default", "develop"], ["tcl", "lmod"], ["develop"])],
+)
+def test_pipeline_matches_makefile(views, module_types, compiler_views):
+    tasks = pipeline.make_pipeline(render_makefile(views, module_types, compiler_views))["tasks"]
+    rules = {}
+    for line in render_makefile(views, module_types, compiler_views).splitlines():
+        match = re.match(r"^([\w./-]+):(?!=)(.*)$", line)
+        if match:
+            rules[match.group(1)] = match.group(2).split()
+
+    for name, task in tasks.items():
+        assert name in rules, name
+        # prerequisites that are not tasks are files, e.g. env/spack.yaml
+        assert task["deps"] == [dep for dep in rules[name] if dep in tasks], name
+
+    assert tasks["env/spack.lock"]["deps"] == ["pre-install", "mirror-setup"]
+    # the upstream config is written to the store after the install
+    assert tasks["generate-config/.done"]["deps"] == ["install"]
+    # gpg is bootstrapped by spack-setup
+    assert tasks["gpg-trust"]["deps"] == ["spack-setup"]
+    assert tasks["install"]["deps"] == ["env/spack.lock", "prefetch", "gpg-trust"]
+    assert tasks["views"]["deps"] == ["cleanup"] + [f"view-{view}" for view in views]
+    assert tasks["modules-done"]["deps"] == ["generate-config/.done"] + [f"modules-{m}" for m in module_types]
+    assert tasks["store.squashfs"]["deps"] == ["install-query", "env-meta", "post-install", "cache-push", "prune-repos"]
+    # the recursive make of generate-config is always run
+    assert [name for name, task in tasks.items() if task["phony"]] == ["generate-config/.done"]
+
+
+@pytest.mark.parametrize("compiler_views", [[], ["develop"]])
+def test_clean_removes_every_stamp(compiler_views):
+    """make clean removes the stamp of every task, and the outputs of the queries, and restores the pruned repos."""
+    makefile = render_makefile(["default", "develop"], ["tcl", "lmod"], compiler_views)
+    tasks = pipeline.make_pipeline(makefile)["tasks"]
+    recipe = pipeline.makefile_rules(makefile)["clean"][1]
+    removed = set(recipe[recipe.index("rm -rf --") :].replace("\\", " ").split()[3:])
+    expected = set(tasks) | {"query", "spack-bootstrap-output"}
+    if compiler_views:
+        expected.add("compiler-config.yaml")
+    assert removed == expected
+    assert "prune-repos.py --restore $(BUILD_ROOT)/repos-pruned" in recipe
+
+
+def test_makefile_rules():
+    rules = pipeline.makefile_rules(
+        "# a comment: with a colon\nSHELL := /bin/bash\nall: a b\n\techo all\n\na:\n\t$(MAKE) -C a\n\ttouch $@\n"
+    )
+    assert rules == {"all": (["a", "b"], "\techo all\n"), "a": ([], "\t$(MAKE) -C a\n\ttouch $@\n")}
+
+    graph = pipeline.make_pipeline("all: a b\n\techo all\na:\n\t$(MAKE) -C a\n", target="all")
+    # b is a file rather than a task
+    assert graph["tasks"] == {"all": {"deps": ["a"], "phony": False}, "a": {"deps": [], "phony": True}}
+    with pytest.raises(pipeline.PipelineError, match="no rule"):
+        pipeline.make_pipeline("all: a\n")
+
+
+def test_install_query_makefile():
+    """One spack process queries the activation of every view and the compilers."""
+    makefile = render_makefile(["default", "develop"], [], ["develop"])
+    recipe = makefile[makefile.index("install-query:") :].split("\n\n")[0]
+    assert recipe.count("spack-query.py") == 1
+    assert "--activate default" in recipe and "--activate develop" in recipe
+    assert "--compiler-config $(BUILD_ROOT)/compiler-config.yaml --compilers=gcc" in recipe
+    assert "env activate" not in makefile and "find --format" not in makefile
+
+    makefile = render_makefile(["default"], [])
+    assert "--compiler-config" not in makefile
+
+
+def test_required_tasks():
+    tasks = pipeline.make_pipeline(render_makefile(["default"], []))["tasks"]
+    order = pipeline.required_tasks(tasks, "mirror-setup")
+    assert order == ["spack-query", "mirror-setup"]
+    order = pipeline.required_tasks(tasks, "env/spack.lock")
+    assert set(order) == {"spack-query", "spack-setup", "pre-install", "mirror-setup", "env/spack.lock"}
+    assert order.index("spack-setup") < order.index("pre-install") < order.index("env/spack.lock")
+
+    with pytest.raises(pipeline.PipelineError, match="not a task"):
+        pipeline.required_tasks(tasks, "unknown")
+
+    cycle = {"a": {"deps": ["b"]}, "b": {"deps": ["a"]}}
+    with pytest.raises(pipeline.PipelineError, match="cycle"):
+        pipeline.required_tasks(cycle, "a")
+
+
+def make_build(path, rules, tasks):
+    """A build path with a Makefile of the given rules and its task graph."""
+    path.mkdir(exist_ok=True)
+    (path / "Makefile").write_text("\n".join(rules) + "\n")
+    graph = {"version": 1, "target": "all", "tasks": {name: {"deps": deps} for name, deps in tasks.items()}}
+    (path / pipeline.PIPELINE).write_text(json.dumps(graph))
+    return path
+
+
+def test_scheduler(tmp_path):
+    # a and b start together, and each waits for the other to have started
+    path = make_build(
+        tmp_path / "build",
+        [
+            "a:",
+            "\ttouch a.started; while [ ! -e b.started ]; do sleep 0.01; done; touch a",
+            "b:",
+            "\ttouch b.started; while [ ! -e a.started ]; do sleep 0.01; done; touch b",
+            "all: a b",
+            "\ttouch all",
+        ],
+        {"a": [], "b": [], "all": ["a", "b"]},
+    )
+
+    scheduler = pipeline.Scheduler(path, jobs=2)
+    assert scheduler.run("all")
+    assert {name: state["status"] for name, state in scheduler.state.items()} == {
+        "a": "done",
+        "b": "done",
+        "all": "done",
+    }
+    assert (path / "logs" / "a.log").read_text().startswith("==> [stack-build] make a (attempt 1")
+
+    state = json.loads((path / pipeline.STATE).read_text())
+    assert state["tasks"]["all"]["log"] == "logs/all.log"
+
+    # a second run finds that everything is up to date
+    scheduler = pipeline.Scheduler(path, jobs=2)
+    assert scheduler.run("all")
+    assert {state["status"] for state in scheduler.state.values()} == {"up-to-date"}
+
+
+def test_scheduler_failure(tmp_path):
+    path = make_build(
+        tmp_path / "build",
+        [
+            "flaky:",
+            "\tif [ -e tried ]; then touch flaky; else touch tried; exit 1; fi",
+            "broken:",
+            "\texit 1",
+            "all: flaky broken",
+            "\ttouch all",
+        ],
+        {"flaky": [], "broken": [], "all": ["flaky", "broken"]},
+    )
+
+    scheduler = pipeline.Scheduler(path, jobs=1, retries=1)
+    assert not scheduler.run("all")
+    assert scheduler.state["flaky"]["status"] == "done"
+    assert scheduler.state["flaky"]["attempts"] == 2
+    assert scheduler.state["broken"]["status"] == "failed"
+    assert scheduler.state["broken"]["attempts"] == 2
+    # the tasks that depend on a failed task are not started
+    assert scheduler.state["all"]["status"] == "pending"
+    assert not (path / "all").exists()
+
+
+def test_cached_pipeline():
+    """An image that is restored from the image cache does not depend on any other step."""
+    image_cache = {"root": "/cache", "key": "0123", "hit": True, "max_size": "1G", "meta": "/store/meta"}
+    graph = pipeline.make_pipeline(render_makefile(["default"], ["tcl"], image_cache=image_cache))
+    assert pipeline.required_tasks(graph["tasks"], graph["target"]) == ["store.squashfs"]
+
+
+def test_scheduler_session(tmp_path):
+    """The tasks run in the sandbox session of the build path, unless it is disabled."""
+    path = make_build(tmp_path / "build", ["a:", "\techo $$STACKINATOR_SANDBOX_SESSION > a"], {"a": []})
+    (path / pipeline.SESSION).write_text('#!/bin/sh\nexport STACKINATOR_SANDBOX_SESSION=1234\nexec "$@"\n')
+    (path / pipeline.SESSION).chmod(0o755)
+
+    assert pipeline.Scheduler(path).run("a")
+    assert (path / "a").read_text() == "1234\n"
+
+    (path / "a").unlink()
+    assert pipeline.Scheduler(path, session=False).run("a")
+    assert (path / "a").read_text() == "\n"
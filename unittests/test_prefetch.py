@@ -0,0 +1,84 @@
+import hashlib
+import json
+import pathlib
+import subprocess
+import sys
+
+script = pathlib.Path(__file__).parent.parent / "stackinator" / "etc" / "prefetch.py"
+
+
+def add_package(cache, dag_hash, name, version, blobs, signed=False):
+    """Add a package with the given blobs to a build cache with the layout of spack 1.0."""
+    data = []
+    for content in blobs:
+        checksum = hashlib.sha256(content).hexdigest()
+        path = cache / "blobs" / "sha256" / checksum[:2] / checksum
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+        data.append({"contentLength": len(content), "checksumAlgorithm": "sha256", "checksum": checksum})
+    manifest = json.dumps({"version": 3, "data": data})
+    if signed:
+        manifest = (
+            f"-----BEGIN PGP SIGNED MESSAGE-----\nHash: SHA512\n\n{manifest}\n-----BEGIN PGP SIGNATURE-----\nxyz\n"
+        )
+    path = cache / "v3" / "manifests" / "spec" / name / f"{name}-{version}-{dag_hash}.spec.manifest.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(manifest)
+    return path
+
+
+def run(*args):
+    return subprocess.run([sys.executable, script, *map(str, args)], capture_output=True, text=True, check=True)
+
+
+def test_prefetch(tmp_path):
+    """The packages of the lock file that are in the build cache are copied to the local mirror."""
+    cache = tmp_path / "cache"
+    zlib = add_package(cache, "aaa", "zlib", "1.3", [b"zlib spec", b"zlib tarball"])
+    fmt = add_package(cache, "bbb", "fmt", "11.0", [b"fmt spec", b"fmt tarball"], signed=True)
+    add_package(cache, "ccc", "boost", "1.86", [b"boost spec"])
+    # a blob that does not match its checksum
+    broken = add_package(cache, "ddd", "cmake", "3.30", [b"cmake tarball"])
+    checksum = hashlib.sha256(b"cmake tarball").hexdigest()
+    (cache / "blobs" / "sha256" / checksum[:2] / checksum).write_bytes(b"corrupt")
+
+    specs = {
+        "aaa": {"name": "zlib", "version": "1.3"},
+        "bbb": {"name": "fmt", "version": "11.0"},
+        "ccc": {"name": "boost", "version": "1.86"},
+        "ddd": {"name": "cmake", "version": "3.30"},
+        "eee": {"name": "hdf5", "version": "1.14"},
+        "fff": {"name": "slurm", "version": "23", "external": {"path": "/usr"}},
+    }
+    lock = tmp_path / "spack.lock"
+    lock.write_text(json.dumps({"concrete_specs": specs}))
+    # boost is already installed
+    database = tmp_path / "index.json"
+    database.write_text(json.dumps({"database": {"installs": {"ccc": {"installed": True}}}}))
+
+    mirror = tmp_path / "prefetch"
+    result = run("--jobs", 2, "--database", database, lock, f"file://{cache}", mirror)
+    assert "2 packages downloaded" in result.stdout
+    assert "1 not in the build cache, 1 already installed, 1 failed" in result.stdout
+    assert "cmake@3.30/ddd could not be downloaded" in result.stdout
+
+    # the local mirror has the same layout as the build cache
+    copied = {path.relative_to(mirror) for path in mirror.rglob("*") if path.is_file()}
+    expected = {zlib.relative_to(cache), fmt.relative_to(cache)}
+    for content in (b"zlib spec", b"zlib tarball", b"fmt spec", b"fmt tarball"):
+        checksum = hashlib.sha256(content).hexdigest()
+        expected.add(pathlib.Path("blobs", "sha256", checksum[:2], checksum))
+    assert copied == expected
+    assert not (mirror / broken.relative_to(cache)).exists()
+
+    # the packages that are in the mirror are not downloaded again
+    result = run("--database", database, lock, cache, mirror)
+    assert "0.0 MiB" in result.stdout
+
+
+def test_prefetch_unsupported(tmp_path):
+    """Build caches that are not files or http urls are skipped."""
+    lock = tmp_path / "spack.lock"
+    lock.write_text(json.dumps({"concrete_specs": {}}))
+    result = run(lock, "s3://bucket/cache", tmp_path / "prefetch")
+    assert "s3:// build caches is not supported" in result.stdout
@@ -0,0 +1,101 @@
+import json
+import pathlib
+import subprocess
+import sys
+
+import pytest
+
+script = pathlib.Path(__file__).parent.parent / "stackinator" / "etc" / "prune-repos.py"
+
+
+def add_package(repos, namespace, name, text="pass\n"):
+    path = repos / namespace / "packages" / name
+    path.mkdir(parents=True)
+    (path / "package.py").write_text(text)
+
+
+@pytest.fixture
+def repos(tmp_path):
+    repos = tmp_path / "repos" / "spack_repo"
+    (repos / "builtin" / "build_systems").mkdir(parents=True)
+    (repos / "builtin" / "repo.yaml").write_text("repo:\n  namespace: builtin\n  api: v2.0\n")
+    add_package(repos, "builtin", "zlib")
+    add_package(repos, "builtin", "py_numpy")
+    add_package(repos, "builtin", "_7zip")
+    add_package(repos, "builtin", "boost")
+    add_package(repos, "builtin", "mpich_base")
+    add_package(repos, "builtin", "unused")
+    add_package(repos, "alps", "cray_mpich", "from spack_repo.builtin.packages.mpich_base.package import MpichBase\n")
+    add_package(repos, "alps", "also_unused")
+    return repos
+
+
+def test_prune_repos(tmp_path, repos):
+    """Only packages in the DAG, and the packages they import, are kept."""
+    lock = tmp_path / "spack.lock"
+    specs = ["zlib", "py-numpy", "7zip", "cray-mpich"]
+    lock.write_text(json.dumps({"concrete_specs": {f"hash{i}": {"name": n} for i, n in enumerate(specs)}}))
+
+    result = subprocess.run([sys.executable, script, lock, repos], capture_output=True, text=True, check=True)
+    assert "kept 5 packages, removed 3 packages" in result.stdout
+
+    kept = sorted(str(p.relative_to(repos)) for p in repos.glob("*/packages/*"))
+    assert kept == [
+        "alps/packages/cray_mpich",
+        "builtin/packages/_7zip",
+        "builtin/packages/mpich_base",
+        "builtin/packages/py_numpy",
+        "builtin/packages/zlib",
+    ]
+    assert (repos / "builtin" / "repo.yaml").is_file()
+    assert (repos / "builtin" / "build_systems").is_dir()
+
+
+def test_prune_repos_dry_run(tmp_path, repos):
+    lock = tmp_path / "spack.lock"
+    lock.write_text(json.dumps({"concrete_specs": {}}))
+    subprocess.run([sys.executable, script, "--dry-run", lock, repos], capture_output=True, check=True)
+    assert (repos / "builtin" / "packages" / "unused").is_dir()
+
+
+def test_prune_repos_restore(tmp_path, repos):
+    """The removed packages are moved to --pruned, which only exists if packages were removed, and restored."""
+    lock = tmp_path / "spack.lock"
+    pruned = tmp_path / "repos-pruned"
+    specs = ["zlib", "py-numpy", "7zip", "boost", "mpich-base", "unused", "cray-mpich", "also-unused"]
+    lock.write_text(json.dumps({"concrete_specs": {f"hash{i}": {"name": n} for i, n in enumerate(specs)}}))
+    subprocess.run([sys.executable, script, "--pruned", pruned, lock, repos], capture_output=True, check=True)
+    assert not pruned.exists()
+
+    before = sorted(str(p.relative_to(repos)) for p in repos.glob("*/packages/*/package.py"))
+    lock.write_text(json.dumps({"concrete_specs": {}}))
+    subprocess.run(
+        [sys.executable, script, "--pruned", pruned, "--dry-run", lock, repos], capture_output=True, check=True
+    )
+    assert not pruned.exists()
+    subprocess.run([sys.executable, script, "--pruned", pruned, lock, repos], capture_output=True, check=True)
+    assert list(repos.glob("*/packages/*")) == []
+    assert (pruned / "alps" / "also_unused" / "package.py").is_file()
+
+    result = subprocess.run(
+        [sys.executable, script, "--restore", pruned, repos], capture_output=True, text=True, check=True
+    )
+    assert "restored 8 packages" in result.stdout
+    assert not pruned.exists()
+    assert sorted(str(p.relative_to(repos)) for p in repos.glob("*/packages/*/package.py")) == before
+
+
+def test_prune_repos_virtual(tmp_path, repos):
+    """The provider of a virtual dependency that was concretized is kept, and the other providers are removed."""
+    add_package(repos, "builtin", "openmpi")
+    lock = tmp_path / "spack.lock"
+    mpi = {"name": "cray-mpich", "hash": "hash1", "parameters": {"deptypes": ["build", "link"], "virtuals": ["mpi"]}}
+    specs = {
+        "hash0": {"name": "boost", "dependencies": [mpi]},
+        "hash1": {"name": "cray-mpich"},
+    }
+    lock.write_text(json.dumps({"lockfile-version": 6, "concrete_specs": specs}))
+    subprocess.run([sys.executable, script, lock, repos], capture_output=True, check=True)
+
+    kept = sorted(str(p.relative_to(repos)) for p in repos.glob("*/packages/*"))
+    assert kept == ["alps/packages/cray_mpich", "builtin/packages/boost", "builtin/packages/mpich_base"]
@@ -0,0 +1,43 @@
+import pytest
+
+from stackinator import render
+
+
+@pytest.fixture
+def fresh_environment(tmp_path, monkeypatch):
+    """A render module with no environment yet, that caches bytecode in tmp_path."""
+    monkeypatch.setenv("STACKINATOR_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(render, "_environment", None)
+    monkeypatch.setattr(render, "_hook_environments", {})
+    return tmp_path / "cache" / "jinja"
+
+
+def test_environment_is_shared(fresh_environment):
+    env = render.environment()
+    assert render.environment() is env
+    assert env.get_template("Makefile") is env.get_template("Makefile")
+    assert "py2yaml" in env.filters
+
+
+def test_bytecode_cache(fresh_environment):
+    render.environment().get_template("Make.user")
+    assert len(list(fresh_environment.glob("*.cache"))) == 1
+
+
+def test_unwritable_cache_dir(tmp_path, monkeypatch, fresh_environment):
+    (tmp_path / "cache").write_text("not a directory")
+    env = render.environment()
+    assert env.bytecode_cache is None
+    assert env.get_template("Make.user")
+
+
+def test_hook_environment(fresh_environment, tmp_path):
+    hooks = tmp_path / "recipe"
+    hooks.mkdir()
+    (hooks / "hook.sh").write_text("{% if true %}\nenv={{ env.name }}\n{% endif %}\n")
+
+    env = render.hook_environment(hooks)
+    assert render.hook_environment(hooks) is env
+    assert env.bytecode_cache is render.environment().bytecode_cache
+    # hooks are rendered without trim_blocks and lstrip_blocks
+    assert env.get_template("hook.sh").render(env={"name": "default"}) == "\nenv=default\n"
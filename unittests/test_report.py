@@ -0,0 +1,73 @@
+import json
+import pathlib
+import subprocess
+import sys
+
+from stackinator.report import load_ledgers, report_build, report_comparison, summarise
+
+ledger_script = pathlib.Path(__file__).parent.parent / "stackinator" / "etc" / "ledger.py"
+
+
+def run_ledger(ledger, target, command, build="b1", spack="abc123"):
+    env = {"STACKINATOR_BUILD_ID": build, "STACKINATOR_SPACK_COMMIT": spack, "PATH": "/usr/bin:/bin"}
+    return subprocess.run([sys.executable, ledger_script, ledger, target] + command, env=env, capture_output=True)
+
+
+def test_ledger_records_commands(tmp_path):
+    """Every command is recorded, and its output and exit status are passed through."""
+    ledger = tmp_path / "ledger.jsonl"
+    result = run_ledger(ledger, "spack-setup", ["echo", "hello"])
+    assert result.returncode == 0
+    assert result.stdout == b"hello\n"
+    assert run_ledger(ledger, "install", ["sh", "-c", "exit 3"]).returncode == 3
+
+    records = [json.loads(line) for line in ledger.read_text().splitlines()]
+    assert [r["target"] for r in records] == ["spack-setup", "install"]
+    assert records[0]["command"] == "echo hello"
+    assert records[0]["build"] == "b1" and records[0]["spack"] == "abc123"
+    assert records[1]["status"] == 3
+    for key in ("wall", "user", "sys", "maxrss", "start"):
+        assert key in records[0]
+
+
+def record(build, target, start, wall, maxrss=2**20, status=0):
+    return {
+        "build": build,
+        "spack": f"spack-{build}",
+        "target": target,
+        "start": f"2025-01-01T00:00:{start:02d}+00:00",
+        "wall": wall,
+        "user": wall / 2,
+        "sys": 0.5,
+        "maxrss": maxrss,
+        "status": status,
+    }
+
+
+def test_summarise_and_compare(tmp_path):
+    ledger = tmp_path / "ledger.jsonl"
+    records = [
+        record("b1", "spack-setup", 0, 2.0),
+        record("b1", "install", 2, 10.0, maxrss=2**30),
+        record("b1", "install", 12, 5.0),
+        record("b2", "spack-setup", 30, 2.1),
+        record("b2", "install", 33, 20.0, status=1),
+    ]
+    ledger.write_text("\n".join(json.dumps(r) for r in records) + "\n{truncated\n")
+
+    builds = summarise(load_ledgers([ledger]))
+    assert list(builds) == ["b1", "b2"]
+    install = builds["b1"]["targets"]["install"]
+    assert install["calls"] == 2 and install["wall"] == 15.0 and install["maxrss"] == 2**30
+    assert builds["b1"]["elapsed"] == 17.0
+    assert builds["b2"]["targets"]["install"]["status"] == 1
+
+    table = report_build("b1", builds["b1"])
+    assert "17.0s elapsed" in table[0]
+    assert table[-1].split()[:3] == ["install", "2", "15.0s"]
+
+    comparison = report_comparison(builds, threshold=10)
+    install_row = next(line for line in comparison if line.split()[:1] == ["install"])
+    assert "+33% !" in install_row
+    setup_row = next(line for line in comparison if line.split()[:1] == ["spack-setup"])
+    assert "+5%" in setup_row and "!" not in setup_row
@@ -0,0 +1,91 @@
+import os
+import subprocess
+import textwrap
+
+import pytest
+
+from stackinator import render
+
+# a stand-in for bwrap-mutable-root.sh, that runs the command in a new mount namespace
+FAKE_BWRAP = textwrap.dedent(
+    """\
+    #!/usr/bin/env bash
+    info=
+    while [ "${1#--}" != "$1" ]; do
+        case "$1" in
+            --info-fd) info=$2; shift 2 ;;
+            --tmpfs) shift 2 ;;
+            --bind) shift 3 ;;
+            *) shift ;;
+        esac
+    done
+    if [ -n "$info" ]; then
+        exec unshare --mount sh -c 'printf "{\\n    \\"child-pid\\": %s\\n}\\n" $$ >&'"$info"'; exec "$@"' sh "$@"
+    fi
+    exec unshare --mount "$@"
+    """
+)
+
+
+def can_unshare():
+    return subprocess.run(["unshare", "--mount", "true"], capture_output=True).returncode == 0
+
+
+@pytest.fixture
+def build_path(tmp_path):
+    env = render.environment()
+    for name in ["sandbox", "sandbox-session"]:
+        path = tmp_path / name
+        path.write_text(env.get_template(name).render(build_path=tmp_path, store=tmp_path / "mount", no_bwrap=False))
+        path.chmod(0o755)
+    (tmp_path / "bwrap-mutable-root.sh").write_text(FAKE_BWRAP)
+    (tmp_path / "bwrap-mutable-root.sh").chmod(0o755)
+    return tmp_path
+
+
+def run(build_path, script, **kwargs):
+    env = {"PATH": os.environ["PATH"], "NO_COLOR": "1", **kwargs}
+    return subprocess.run(["bash", "-c", script], cwd=build_path, env=env, capture_output=True, text=True)
+
+
+@pytest.mark.skipif(not can_unshare(), reason="mount namespaces can't be created")
+def test_sandbox_session(build_path):
+    """The sandbox calls in a session share its namespace, and keep their output and exit status."""
+    host = os.readlink("/proc/self/ns/mnt")
+
+    script = [
+        "echo $STACKINATOR_SANDBOX_SESSION",
+        "readlink /proc/$STACKINATOR_SANDBOX_SESSION/ns/mnt",
+        "./sandbox readlink /proc/self/ns/mnt",
+        "./sandbox readlink /proc/self/ns/mnt",
+        './sandbox sh -c "echo out; echo err >&2; exit 3"',
+        "echo $?",
+    ]
+    result = run(build_path, f"./sandbox-session sh -c '{'; '.join(script)}'")
+    assert result.returncode == 0, result.stderr
+    pid, session, first, second, out, status = result.stdout.split()
+    assert session == first == second != host
+    assert (out, status) == ("out", "3")
+    assert "err" in result.stderr
+    # the namespace ends with the session
+    assert not os.path.exists(f"/proc/{pid}")
+
+    # the exit status of the command is returned
+    assert run(build_path, "./sandbox-session sh -c 'exit 5'").returncode == 5
+
+    # without a session, every call starts a sandbox
+    result = run(build_path, "./sandbox readlink /proc/self/ns/mnt")
+    assert result.stdout.strip() != host
+
+
+def test_sandbox_session_fallback(build_path):
+    """If the session has ended or can't be started, every call starts a sandbox."""
+    (build_path / "bwrap-mutable-root.sh").write_text("#!/bin/sh\necho bwrap\nexit 1\n")
+
+    result = run(build_path, "./sandbox-session ./sandbox true")
+    assert "could not be started" in result.stderr
+    assert result.stdout == "bwrap\n"
+
+    # the pid of a session that has ended
+    result = run(build_path, "./sandbox true", STACKINATOR_SANDBOX_SESSION="999999999")
+    assert result.stdout == "bwrap\n"
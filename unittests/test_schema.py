@@ -82,6 +82,7 @@ def test_config_yaml(yaml_path):
     assert raw["spack"]["commit"] == "develop"
     assert raw["spack"]["packages"]["commit"] is None
     assert raw["description"] is None
+    assert not raw["prune-repos"]
 
     # full config
     with open(yaml_path / "config.full.yaml") as fid:
@@ -272,3 +273,69 @@ def test_valid_modules_yaml(recipe):
 def test_invalid_modules_yaml(recipe):
     with pytest.raises(Exception):
         schema.ModulesValidator.validate(yaml.load(recipe, Loader=yaml.Loader))
+
+
+def test_document_cache(tmp_path, yaml_path, monkeypatch):
+    cache = schema.DocumentCache(tmp_path / "cache")
+    config = tmp_path / "config.yaml"
+    config.write_text((yaml_path / "config.full.yaml").read_text())
+
+    first = cache.load(config, schema.ConfigValidator)
+    assert len(list((tmp_path / "cache").glob("*.json"))) == 1
+
+    # a cached document is neither parsed nor validated again
+    monkeypatch.setattr(yaml, "load", lambda *args, **kwargs: pytest.fail("parsed"))
+    monkeypatch.setattr(schema.ConfigValidator, "validate", lambda instance: pytest.fail("validated"))
+    second = cache.load(config, schema.ConfigValidator)
+    assert second == first and second is not first
+    monkeypatch.undo()
+
+    # the entry is keyed by the content of the file and the schema
+    config.write_text(config.read_text() + "\n# changed\n")
+    assert cache.load(config, schema.ConfigValidator) == first
+    assert cache.load(config) != first
+    assert len(list((tmp_path / "cache").glob("*.json"))) == 3
+
+
+def test_document_cache_invalid(tmp_path):
+    cache = schema.DocumentCache(tmp_path / "cache")
+    config = tmp_path / "config.yaml"
+    config.write_text("version: 3\nname: invalid\n")
+    for _ in range(2):
+        with pytest.raises(jsonschema.ValidationError):
+            cache.load(config, schema.ConfigValidator)
+    assert not list((tmp_path / "cache").glob("*.json"))
+
+
+def test_document_cache_not_json(tmp_path):
+    """Documents that JSON does not represent exactly are not cached."""
+    cache = schema.DocumentCache(tmp_path / "cache")
+    packages = tmp_path / "packages.yaml"
+    packages.write_text("date: 2024-01-01\n1: one\n")
+    assert cache.load(packages) == cache.load(packages)
+    assert not list((tmp_path / "cache").glob("*.json"))
+
+
+def test_document_cache_writable_by_others(tmp_path):
+    """A cache directory that other users can write to is not used."""
+    (tmp_path / "cache").mkdir(mode=0o777)
+    (tmp_path / "cache").chmod(0o777)
+    cache = schema.DocumentCache(tmp_path / "cache")
+    packages = tmp_path / "packages.yaml"
+    packages.write_text("packages: {}\n")
+    assert cache.load(packages) == {"packages": {}}
+    assert not list((tmp_path / "cache").glob("*.json"))
+
+
+def test_document_cache_size(tmp_path):
+    """The least recently used entries are deleted when the cache is larger than its maximum size."""
+    cache = schema.DocumentCache(tmp_path / "cache", max_size=1000)
+    paths = []
+    for i in range(8):
+        path = tmp_path / f"{i}.yaml"
+        path.write_text(f"value: {i}\ntext: {'x' * 200}\n")
+        paths.append(path)
+        cache.load(path)
+    entries = list((tmp_path / "cache").glob("*.json"))
+    assert 0 < len(entries) < 8
+    assert sum(entry.stat().st_size for entry in entries) <= 1000
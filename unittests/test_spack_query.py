@@ -0,0 +1,106 @@
+import importlib.util
+import json
+import pathlib
+import subprocess
+import sys
+
+import yaml
+
+script = pathlib.Path(__file__).parent.parent / "stackinator" / "etc" / "spack-query.py"
+
+
+def load_script():
+    spec = importlib.util.spec_from_file_location("spack_query", script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_compiler_config(tmp_path, monkeypatch):
+    """compiler-config.py is loaded from next to the script, without running it."""
+    monkeypatch.setattr(sys, "argv", [str(script), str(tmp_path / "query")])
+    compiler_config = load_script().compiler_config()
+
+    system = tmp_path / "packages.yaml"
+    gcc = {"spec": "gcc@12", "prefix": "/usr", "extra_attributes": {"compilers": {"c": "/usr/bin/gcc"}}}
+    system.write_text(yaml.dump({"packages": {"gcc": {"externals": [gcc]}, "cmake": {"externals": []}}}))
+    assert compiler_config.load_system_compiler_externals(system) == {"gcc": {"externals": [gcc], "buildable": False}}
+
+
+def test_no_queries(tmp_path):
+    """The output directory is created, and spack is only imported for the queries that need it."""
+    output = tmp_path / "query"
+    subprocess.run([sys.executable, script, output], check=True)
+    assert output.is_dir()
+    assert list(output.iterdir()) == []
+
+
+class SetEnv:
+    def __init__(self, name, value):
+        self.name, self.value = name, value
+
+
+class UnsetEnv:
+    def __init__(self, name):
+        self.name = name
+
+
+class PrependPath:
+    def __init__(self, name, value, separator=":"):
+        self.name, self.value, self.separator = name, value, separator
+
+
+class RemovePath(PrependPath):
+    pass
+
+
+class PruneDuplicatePaths:
+    def __init__(self, name, separator=":"):
+        self.name, self.separator = name, separator
+
+
+def test_modification_ops(capsys):
+    """The modifications of the activation are written in order, as (op, name, value)."""
+    modifications = [
+        SetEnv("SPACK_ENV", "/build/env"),
+        PrependPath("PATH", "/view/bin"),
+        PrependPath("MANPATH", ["/view/share/man", "/view/man"]),
+        UnsetEnv("OLD"),
+        PrependPath("PKG_CONFIG_PATH", "/view/lib/pkgconfig"),
+        PrependPath("PKG_CONFIG_PATH", "/view/share/pkgconfig"),
+        RemovePath("PKG_CONFIG_PATH", "/view/share/pkgconfig"),
+        RemovePath("LD_LIBRARY_PATH", "/usr/lib"),
+        PruneDuplicatePaths("PATH"),
+    ]
+    assert load_script().modification_ops(modifications) == [
+        {"op": "set", "name": "SPACK_ENV", "value": "/build/env"},
+        {"op": "prepend", "name": "PATH", "value": "/view/bin"},
+        {"op": "prepend", "name": "MANPATH", "value": "/view/share/man:/view/man"},
+        {"op": "unset", "name": "OLD", "value": None},
+        # a remove_path removes the path from the modifications before it
+        {"op": "prepend", "name": "PKG_CONFIG_PATH", "value": "/view/lib/pkgconfig"},
+    ]
+    assert "ignoring PruneDuplicatePaths of PATH" in capsys.readouterr().err
+
+
+def test_modification_ops_build_environment(monkeypatch, tmp_path):
+    """The values of the build environment are not recorded, even for the modifications that have no update."""
+    monkeypatch.setenv("PKG_CONFIG_PATH", "/build/lib/pkgconfig:/view/lib/pkgconfig")
+    monkeypatch.setenv("PATH", "/build/bin:/usr/bin")
+    modifications = [
+        PrependPath("PKG_CONFIG_PATH", "/view/lib/pkgconfig"),
+        RemovePath("PKG_CONFIG_PATH", "/build/lib/pkgconfig"),
+        PrependPath("PATH", "/view/bin"),
+        PruneDuplicatePaths("PATH"),
+    ]
+    ops = load_script().modification_ops(modifications)
+    assert "/build" not in json.dumps(ops)
+
+    path = tmp_path / "environment-default.json"
+    path.write_text(json.dumps({"version": 2, "modifications": ops}))
+    spec = importlib.util.spec_from_file_location("envvars", script.parent / "envvars.py")
+    envvars = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(envvars)
+    env = envvars.read_environment(str(path))
+    assert env.lists["PKG_CONFIG_PATH"].paths == ["/view/lib/pkgconfig"]
+    assert env.lists["PATH"].paths == ["/view/bin"]
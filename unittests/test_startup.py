@@ -0,0 +1,37 @@
+import subprocess
+import sys
+
+HEAVY_MODULES = ["jinja2", "jsonschema", "magic", "yaml", "stackinator.builder", "stackinator.recipe"]
+
+
+def imported_after(code):
+    """The heavy modules that have been imported after running code in a fresh interpreter."""
+    check = f"{code}\nimport sys\nprint(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", check], capture_output=True, text=True, check=True)
+    return result.stdout.splitlines()[-1].split()
+
+
+def test_main_import_is_light():
+    assert imported_after("import stackinator.main") == []
+
+
+def test_version_is_light():
+    code = "\n".join(
+        [
+            "from stackinator.main import make_argparser",
+            "try:",
+            "    make_argparser().parse_args(['--version'])",
+            "except SystemExit:",
+            "    print()",
+        ]
+    )
+    assert imported_after(code) == []
+
+
+def test_validators_are_built_on_first_use():
+    from stackinator import schema
+
+    validator = schema.SchemaValidator(schema.prefix / "schema/compilers.json")
+    assert "_validator" not in validator.__dict__
+    validator.validate({"gcc": {"version": "13"}})
+    assert "_validator" in validator.__dict__
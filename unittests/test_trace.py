@@ -0,0 +1,50 @@
+import json
+import threading
+
+from stackinator.trace import Tracer
+
+
+def test_spans_nest_and_summarise(tmp_path):
+    tracer = Tracer()
+    with tracer.span("generate"):
+        with tracer.span("git", url="https://github.com/spack/spack.git"):
+            pass
+        for _ in range(3):
+            with tracer.span("scan tree"):
+                with tracer.span("too deep"):
+                    pass
+
+    lines = tracer.summary()
+    assert lines[0].split() == ["phase", "count", "time"]
+    assert [line.split()[:2] for line in lines[1:]] == [["generate", "1"], ["git", "1"], ["scan", "tree"]]
+    assert lines[3].split()[2] == "3"
+
+    trace_file = tmp_path / "trace.json"
+    tracer.write(trace_file)
+    events = json.loads(trace_file.read_text())["traceEvents"]
+    spans = [e for e in events if e["ph"] == "X"]
+    assert len(spans) == 8
+    git = next(e for e in spans if e["name"] == "git")
+    assert git["args"] == {"url": "https://github.com/spack/spack.git"}
+    generate = next(e for e in spans if e["name"] == "generate")
+    assert generate["ts"] <= git["ts"] and git["ts"] + git["dur"] <= generate["ts"] + generate["dur"]
+
+
+def test_worker_threads_attach_to_context():
+    """Spans in a worker thread nest inside the span that submitted the work."""
+    tracer = Tracer()
+    with tracer.span("git"):
+        context = tracer.context()
+
+        def work():
+            with tracer.attach(context), tracer.span("git: spack"):
+                pass
+
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+
+    start = tracer.now()
+    tracer.add_async("install tree", start, start + 1000, dst="/store/repos")
+
+    assert [line.split()[0] for line in tracer.summary()[1:]] == ["git", "git:"]